@@ -0,0 +1,113 @@
+"""
+Columnar trade blotter of user executions
+* One NumPy array per column, preallocated and doubled when full. Recording a fill writes one row with no Python list
+    growth
+* End-of-day analytics are vectorized passes over the columns
+* Prices are in the units of the tape. Mark-to-market PnL of the day splits into
+    1. Spread capture: (mid - price) * shares at each fill
+    2. Inventory: fills valued at mid and the final position marked at the final mid
+"""
+from typing import Dict, Optional
+import numpy as np
+
+# Column name to dtype. Side is 1 for buy and -1 for sell. Action is -1 for liquidation. PnL is the realized PnL of the
+# fill in tape units like the other money columns, and NaN if it is not attributed to a single fill
+COLUMNS = {
+    'timestamp': np.int64,
+    'side': np.int8,
+    'price': np.int64,
+    'shares': np.int64,
+    'mid_price': np.int64,
+    'action': np.int16,
+    'position': np.int64,  # Position after the fill
+    'pnl': np.float64,
+}
+LIQUIDATION = -1
+
+
+class Blotter:
+    """ Append-only record of fills with one growable array per column """
+
+    def __init__(self, capacity: int = 1024) -> None:
+        self._capacity = max(capacity, 1)
+        self._columns = {name: np.zeros(self._capacity, dtype=dtype) for name, dtype in COLUMNS.items()}
+        self._size = 0
+
+    def reset(self) -> None:
+        """ Forget all fills. Buffers are kept """
+        self._size = 0
+
+    def record(self, timestamp: int, price: int, shares: int, mid_price: int, action: int, position: int,
+               pnl: float = np.nan) -> None:
+        """ Append a fill. Shares are signed, positive for buy """
+        if self._size == self._capacity:
+            self._grow()
+        idx = self._size
+        columns = self._columns
+        columns['timestamp'][idx] = timestamp
+        columns['side'][idx] = 1 if shares > 0 else -1
+        columns['price'][idx] = price
+        columns['shares'][idx] = shares
+        columns['mid_price'][idx] = mid_price
+        columns['action'][idx] = action
+        columns['position'][idx] = position
+        columns['pnl'][idx] = pnl
+        self._size = idx + 1
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        """ View of the recorded part of a column """
+        return self._columns[name][:self._size]
+
+    # ========== Analytics ==========
+    @property
+    def num_bids(self) -> int:
+        return int(np.count_nonzero(self['side'] > 0))
+
+    @property
+    def num_asks(self) -> int:
+        return int(np.count_nonzero(self['side'] < 0))
+
+    def spread_profits(self) -> np.ndarray:
+        """ Spread captured by each fill against the mid price right after it """
+        return (self['mid_price'] - self['price']) * self['shares']
+
+    def inventory_pnl(self, final_mid_price: int) -> int:
+        """ PnL of holding the position, from fills at mid to the final position marked at final_mid_price """
+        position = int(self['position'][-1]) if self._size else 0
+        return int(-(self['mid_price'] * self['shares']).sum()) + final_mid_price * position
+
+    def inventory_path(self) -> np.ndarray:
+        """ Timestamps and positions after each fill as rows """
+        return np.stack([self['timestamp'], self['position']], axis=1)
+
+    def action_fills(self, num_actions: int) -> np.ndarray:
+        """ Number of fills by action. Liquidation is not counted """
+        actions = self['action']
+        return np.bincount(actions[actions >= 0], minlength=num_actions)
+
+    def summary(self, final_mid_price: Optional[int]) -> Dict[str, float]:
+        """ End-of-day statistics. Inventory PnL is NaN if there is no final mid price """
+        spread_profits = self.spread_profits()
+        spread_capture = int(spread_profits.sum())
+        inventory = np.nan if final_mid_price is None else self.inventory_pnl(final_mid_price)
+        return {
+            'bids': self.num_bids,
+            'asks': self.num_asks,
+            'avg_spread_profit': float(spread_profits.mean()) if self._size else np.nan,
+            'spread_capture': spread_capture,
+            'inventory_pnl': inventory,
+            'total_pnl': spread_capture + inventory,
+            'realized_pnl': float(np.nansum(self['pnl'])),
+        }
+
+    # ========== Private Methods ==========
+    def _grow(self) -> None:
+        """ Double capacity of every column """
+        self._capacity *= 2
+        for name, column in self._columns.items():
+            grown = np.zeros(self._capacity, dtype=column.dtype)
+            grown[:self._size] = column[:self._size]
+            self._columns[name] = grown
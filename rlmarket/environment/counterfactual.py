@@ -0,0 +1,59 @@
+"""
+Counterfactual evaluation of all actions at a decision point
+* Every action places an order pair that reaches the market after latency. Where each order is first executed only
+    depends on the upcoming tape, so FillOracle answers it for all actions without replaying the tape once per action
+* The earlier of the two executions ends the step, like _wait_for_execution. Executions after the stopping point of
+    the step are ignored
+* Simplifications
+    * User orders already resting or still in flight are ignored. Outcomes are those of the new order pair alone
+    * Liquidation that may follow the execution is not included
+"""
+from bisect import bisect_right
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from rlmarket.environment.exchange_elements import Tape
+from rlmarket.environment.fill_oracle import FillOracle
+
+
+class ActionOutcome(NamedTuple):
+    """ Outcome of an action. Fill fields are None if neither order is executed before the step ends """
+    action: int
+    bid_price: int  # Order prices after adjustment on arrival
+    ask_price: int
+    fill_time: Optional[int]  # Nanoseconds from the decision to the execution
+    side: Optional[str]  # Side of the executed user order
+    price: Optional[int]
+    mid_price: Optional[int]  # Mid price right after the execution
+    reward: Optional[float] = None
+    pnl: Optional[float] = None
+
+
+def scan_actions(oracle: FillOracle, tape: Tape, end_time: int, latency: int,
+                 prices: Dict[int, Tuple[int, int]]) -> List[ActionOutcome]:
+    """ Return outcomes of actions given bid and ask prices of each. Reward is left for the exchange to fill in """
+    current_time = tape.current_time
+    arrival_time = current_time + latency
+    arrival = bisect_right(oracle.timestamps, arrival_time)
+
+    # User orders are released before end time only. Executions up to the first real order past end time still count
+    released = arrival_time < end_time and arrival < oracle.num_orders
+    last = max(tape.pointer, bisect_right(oracle.timestamps, end_time))
+
+    outcomes = []
+    for action, (bid_price, ask_price) in prices.items():
+        fill = None
+        if released:
+            bid_price = oracle.adjusted_price('B', bid_price, arrival)
+            ask_price = oracle.adjusted_price('S', ask_price, arrival)
+            for side, price in (('B', bid_price), ('S', ask_price)):
+                position = oracle.first_fill(side, price, arrival)
+                if position is not None and position <= last and (fill is None or position < fill[0]):
+                    fill = position, side, price
+
+        if fill is None:
+            outcomes.append(ActionOutcome(action, bid_price, ask_price, None, None, None, None))
+        else:
+            position, side, price = fill
+            outcomes.append(ActionOutcome(action, bid_price, ask_price, oracle.timestamps[position] - current_time,
+                                          side, price, oracle.mid_price(position)))
+    return outcomes
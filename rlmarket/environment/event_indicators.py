@@ -0,0 +1,229 @@
+"""
+Indicators updated by every real order event instead of at decision time
+* EventIndicator subscribes to the LevelDelta published by OrderBook. Every path that applies real orders (run,
+    fast forward, replay and warm-up) goes through the book, so no event is missed
+* Statistics are kept over rolling time windows updated in O(1) amortized per event. Value at a decision only evicts
+    expired events, there is no catch-up replay
+* Events before an exchange is attached are not seen. An exchange warm-started from a snapshot only sees the
+    catch-up from the snapshot, so windows should be shorter than the snapshot interval
+* User orders are phantom and do not publish. Windows are in nanoseconds and rates are per second
+"""
+from __future__ import annotations
+import abc
+from collections import deque
+import math
+from typing import Deque, List, Optional, Tuple, TYPE_CHECKING
+
+from rlmarket.environment.exchange_elements import Indicator
+from rlmarket.market import OrderBook, LevelDelta
+
+if TYPE_CHECKING:
+    from rlmarket.environment import Exchange
+
+
+class RollingWindow:
+    """ Sum of values pushed within the last window nanoseconds. Each value is appended and evicted once """
+
+    def __init__(self, window: int) -> None:
+        if window <= 0:
+            raise ValueError(f'Window {window} should be positive')
+        self.window = window
+        self.total = 0
+        self._items: Deque[Tuple[int, float]] = deque()
+
+    def clear(self) -> None:
+        self.total = 0
+        self._items.clear()
+
+    def push(self, timestamp: int, value: float) -> None:
+        self._items.append((timestamp, value))
+        self.total += value
+        self.evict(timestamp)
+
+    def evict(self, now: int) -> None:
+        """ Drop values at or before now - window """
+        cutoff = now - self.window
+        items = self._items
+        while items and items[0][0] <= cutoff:
+            self.total -= items.popleft()[1]
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class EventIndicator(Indicator):
+    """ Base class for indicators fed by book events. Value is read at decision time from the running statistics """
+
+    def __init__(self, dimension: int) -> None:
+        super().__init__(dimension=dimension)
+        self._book: Optional[OrderBook] = None
+
+    def attach(self, book: OrderBook) -> None:
+        """ Clear statistics and listen to book. Re-attaching to the same book only clears """
+        self.reset()
+        self._book = book
+        if self.on_delta not in book.subscribers:
+            book.subscribe(self.on_delta)
+
+    @abc.abstractmethod
+    def reset(self) -> None:
+        """ Clear running statistics """
+
+    @abc.abstractmethod
+    def on_delta(self, delta: LevelDelta) -> None:
+        """ Update running statistics with one book event """
+
+    @abc.abstractmethod
+    def values(self, now: int) -> Tuple:
+        """ Indicator value at time now """
+
+    def update(self, env: Exchange) -> Optional[Tuple]:
+        return self.values(env.tape.current_time)
+
+    def _quote_sum(self) -> Optional[int]:
+        """ Best bid plus best ask, i.e. twice the mid price. None if either side is empty """
+        bid, ask = self._book.bid_book.quote, self._book.ask_book.quote
+        if bid is None or ask is None:
+            return None
+        return bid + ask
+
+
+def attach_event_indicators(indicators: List[Indicator], book: OrderBook) -> None:
+    """ Attach event indicators among indicators to book. Called by exchanges before warm-up """
+    for ind in indicators:
+        if isinstance(ind, EventIndicator):
+            ind.attach(book)
+
+
+class RealizedVolatility(EventIndicator):
+    """ Square root of the sum of squared log mid price changes within window """
+
+    def __init__(self, window: int) -> None:
+        super().__init__(dimension=1)
+        self._squares = RollingWindow(window)
+        self._last_sum: Optional[int] = None
+
+    def reset(self) -> None:
+        self._squares.clear()
+        self._last_sum = None
+
+    def on_delta(self, delta: LevelDelta) -> None:
+        quote_sum = self._quote_sum()
+        if quote_sum is None:
+            return
+        if self._last_sum is not None and quote_sum != self._last_sum:
+            self._squares.push(delta.timestamp, math.log(quote_sum / self._last_sum) ** 2)
+        self._last_sum = quote_sum
+
+    def values(self, now: int) -> Tuple:
+        self._squares.evict(now)
+        return math.sqrt(max(self._squares.total, 0)),
+
+
+class TradeIntensity(EventIndicator):
+    """ Buy and sell executions per second within window. Execution against the bid book is a sell """
+
+    def __init__(self, window: int) -> None:
+        super().__init__(dimension=2)
+        self._buys = RollingWindow(window)
+        self._sells = RollingWindow(window)
+        self._per_second = 1e9 / window
+
+    def reset(self) -> None:
+        self._buys.clear()
+        self._sells.clear()
+
+    def on_delta(self, delta: LevelDelta) -> None:
+        if delta.cause == 'E':
+            (self._sells if delta.side == 'B' else self._buys).push(delta.timestamp, 1)
+
+    def values(self, now: int) -> Tuple:
+        self._buys.evict(now)
+        self._sells.evict(now)
+        return self._buys.total * self._per_second, self._sells.total * self._per_second
+
+
+class CancelRate(EventIndicator):
+    """ Bid and ask cancellations per second within window. Partial cancels and deletes both count """
+
+    def __init__(self, window: int) -> None:
+        super().__init__(dimension=2)
+        self._bids = RollingWindow(window)
+        self._asks = RollingWindow(window)
+        self._per_second = 1e9 / window
+
+    def reset(self) -> None:
+        self._bids.clear()
+        self._asks.clear()
+
+    def on_delta(self, delta: LevelDelta) -> None:
+        if delta.cause == 'X' or delta.cause == 'D':
+            (self._bids if delta.side == 'B' else self._asks).push(delta.timestamp, 1)
+
+    def values(self, now: int) -> Tuple:
+        self._bids.evict(now)
+        self._asks.evict(now)
+        return self._bids.total * self._per_second, self._asks.total * self._per_second
+
+
+class OrderFlowImbalance(EventIndicator):
+    """
+    Order flow imbalance of Cont, Kukanov and Stoikov within window, divided by scale
+    * Each event contributes the change of shares at the best bid minus the change at the best ask. A better price
+        counts its full shares and a worse price removes the shares of the old best level
+    """
+
+    def __init__(self, window: int, scale: float = 1.0) -> None:
+        super().__init__(dimension=1)
+        self._flows = RollingWindow(window)
+        self.scale = scale
+        self._last: Optional[Tuple[int, int, int, int]] = None  # Best bid, bid shares, best ask and ask shares
+
+    def reset(self) -> None:
+        self._flows.clear()
+        self._last = None
+
+    def on_delta(self, delta: LevelDelta) -> None:
+        bid_book, ask_book = self._book.bid_book, self._book.ask_book
+        bid, ask = bid_book.quote, ask_book.quote
+        if bid is None or ask is None:
+            self._last = None
+            return
+
+        bid_shares, ask_shares = bid_book.volume, ask_book.volume
+        if self._last is not None:
+            last_bid, last_bid_shares, last_ask, last_ask_shares = self._last
+            flow = ((bid_shares if bid >= last_bid else 0) - (last_bid_shares if bid <= last_bid else 0)
+                    - (ask_shares if ask <= last_ask else 0) + (last_ask_shares if ask >= last_ask else 0))
+            if flow:
+                self._flows.push(delta.timestamp, flow)
+        self._last = bid, bid_shares, ask, ask_shares
+
+    def values(self, now: int) -> Tuple:
+        self._flows.evict(now)
+        return self._flows.total / self.scale,
+
+
+class TimeSinceMidChange(EventIndicator):
+    """ Time since the mid price last changed, divided by scale. 0 before the first two-sided quote """
+
+    def __init__(self, scale: float = 1e9) -> None:
+        super().__init__(dimension=1)
+        self.scale = scale
+        self._last_sum: Optional[int] = None
+        self._last_change: Optional[int] = None
+
+    def reset(self) -> None:
+        self._last_sum = None
+        self._last_change = None
+
+    def on_delta(self, delta: LevelDelta) -> None:
+        quote_sum = self._quote_sum()
+        if quote_sum is not None and quote_sum != self._last_sum:
+            self._last_sum = quote_sum
+            self._last_change = delta.timestamp
+
+    def values(self, now: int) -> Tuple:
+        if self._last_change is None:
+            return 0.0,
+        return max(now - self._last_change, 0) / self.scale,
@@ -1,14 +1,18 @@
 from __future__ import annotations
-from typing import List, Deque, Tuple, Optional, DefaultDict
+from typing import List, Deque, Dict, Tuple, Optional, DefaultDict
 from math import ceil, floor
 from pandas import Timedelta
-import numpy as np
 from collections import defaultdict
 
-from rlmarket.environment.exchange_elements import Tape, Indicator
+from rlmarket.environment.blotter import Blotter, LIQUIDATION
+from rlmarket.environment.counterfactual import ActionOutcome, scan_actions
+from rlmarket.environment.event_indicators import attach_event_indicators
+from rlmarket.environment.exchange_elements import Tape, Indicator, StateBuffer
+from rlmarket.environment.fill_oracle import FillOracle
+from rlmarket.environment.replay_engine import ReplayEngine
+from rlmarket.environment.tape_metadata import clears_at_end, record_clearing
 from rlmarket.market import OrderBook
-from rlmarket.market import LimitOrder, MarketOrder, CancelOrder, DeleteOrder, UpdateOrder
-from rlmarket.market import UserLimitOrder, UserMarketOrder, Execution
+from rlmarket.market import UserLimitOrder, UserMarketOrder
 from rlmarket.environment import Environment, StateT
 
 
@@ -16,16 +20,19 @@ class Exchange(Environment):
     """ Exchange emulate the electronic trading venue """
 
     tape: Tape
+    engine: ReplayEngine
 
     def __init__(self, files: List[str], indicators: List[Indicator],
                  start_time: int, end_time: int, latency: int = 20_000_000,
-                 order_size: int = 100, position_limit: int = 10000, liquidation_ratio: float = 0.2) -> None:
+                 order_size: int = 100, position_limit: int = 10000, liquidation_ratio: float = 0.2,
+                 fast_forward: bool = False, fill_oracle: bool = False) -> None:
 
         # Data elements
         self._paths = [f'C:/Users/Albert/PycharmProjects/ReinforceMarketMaking/data/parsed/{file}.pickle'
                        for file in files]
 
         self._indicators = indicators
+        self._state = StateBuffer([ind.dimension for ind in indicators], dtype=float)
         self._path_pointer = -1  # Point to the file to use
 
         # Time elements
@@ -40,6 +47,10 @@ class Exchange(Environment):
         self._order_size = order_size
         self._position_limit = position_limit
         self._liquidation_ratio = liquidation_ratio  # The portion of position to neutralize when using MarketOrder
+        self._fast_forward = fast_forward  # Batch replay of orders that cannot execute user orders
+        self._fill_oracle = fill_oracle  # Jump to the next execution with FillOracle. Requires fast_forward
+        self._oracles: Dict[str, FillOracle] = {}  # Built once per file
+        self._oracle: Optional[FillOracle] = None
 
         # Set up market
         self.book = OrderBook()
@@ -47,31 +58,34 @@ class Exchange(Environment):
         # Book keeping stats
         self.bk_action_counts: DefaultDict[int, int] = defaultdict(int)
         self.bk_liquidation: int = 0
-        self.bk_bid_counts: int = 0
-        self.bk_ask_counts: int = 0
-        self.bk_spread_profits: List[int] = []
+        self.blotter = Blotter()  # Fills of the episode
+        self._last_action = LIQUIDATION  # Action of the last order sent. Fills are attributed to it
 
     def reset(self) -> StateT:
         """ Reset exchange status """
         print(f'Trading time is from {Timedelta(self._start_time, "ns")} to {Timedelta(self._end_time, "ns")}')
         self._path_pointer = (self._path_pointer + 1) % len(self._paths)
         self.tape = Tape(self._paths[self._path_pointer], latency=self._latency, end_time=self._end_time)
+        if self._fill_oracle:
+            path = self._paths[self._path_pointer]
+            if path not in self._oracles:
+                self._oracles[path] = FillOracle(self.tape.real_orders)
+            self._oracle = self._oracles[path]
 
         self._position = 0
         self._last_position_pnl = 0
         self._last_spread_profit = 0
         self.book.reset()
+        attach_event_indicators(self._indicators, self.book)
 
         # Reset training stats
         self.bk_action_counts.clear()
         self.bk_liquidation = 0
-        self.bk_bid_counts = 0
-        self.bk_ask_counts = 0
-        self.bk_spread_profits = []
+        self.blotter.reset()
 
         # Load market
-        while self.tape.current_time < self._start_time:
-            self._run_market()
+        self.engine = ReplayEngine(self.tape, self.book, self._end_time, self._fast_forward, self._oracle)
+        self.engine.warm_up(self._start_time)
 
         return self._get_state()
 
@@ -87,29 +101,10 @@ class Exchange(Environment):
             over-emphasize the spread profit because position PnL is discounted while spread profit is not in this case.
         """
         # Perform action
-        # if action < 5:
-        #     # Symmetric market making
-        #     self._place_order(action + 1, action + 1)
-        # elif action == 5:
-        #     self._place_order(3, 1)
-        # elif action == 6:
-        #     self._place_order(1, 3)
-        # elif action == 7:
-        #     self._place_order(5, 2)
-        # elif action == 8:
-        #     self._place_order(2, 5)
-        # else:
-        #     raise RuntimeError(f'Unrecognized action {action}')
-        if action == 0:
-            self._place_order(3, 3)
-        elif action == 1:
-            self._place_order(5, 2)
-        elif action == 2:
-            self._place_order(2, 5)
-        else:
-            raise RuntimeError(f'Unrecognized action {action}')
+        self._place_order(*self._order_distances(action))
 
         self.bk_action_counts[action] += 1
+        self._last_action = action
 
         # Wait for result
         reward_pair = self._wait_for_execution()
@@ -119,6 +114,7 @@ class Exchange(Environment):
             if abs(self._position) >= self._position_limit:
                 # Book keeping
                 self.bk_liquidation += 1
+                self._last_action = LIQUIDATION
 
                 # Calculate shares to cover
                 shares = int(self._position * self._liquidation_ratio)
@@ -139,17 +135,40 @@ class Exchange(Environment):
             return self._get_state(), reward_pair[0] / 10000, reward_pair[1] / 10000, False
         return (), 0, 0, True
 
-    def clean_up(self) -> None:
-        while not self.tape.done:
-            self._run_market()
+    def clean_up(self, strict: bool = False) -> None:
+        """
+        Check that the market clears at the end of the tape and print stats
+        * Drain of the rest of the tape is skipped if tape metadata records that the market clears, unless strict
+        """
+        if strict or not clears_at_end(self.tape):
+            self.engine.drain()
+            record_clearing(self.tape, self.book)
 
-        # Check if exchange finishes properly
-        if not self.book.empty:
-            raise RuntimeError('Market is not fully cleared')
+            # Check if exchange finishes properly
+            if not self.book.empty:
+                raise RuntimeError('Market is not fully cleared')
 
         tmp = {idx: self.bk_action_counts[idx] for idx in range(self.action_space)}
-        print(f'Actions: {tmp} | Bids: {self.bk_bid_counts} | Asks: {self.bk_ask_counts} '
-              f'| Cover: {self.bk_liquidation} | Avg Profit: {np.mean(self.bk_spread_profits) / 10000}')
+        stats = self.blotter.summary(None)  # Position is not marked here
+        print(f'Actions: {tmp} | Bids: {stats["bids"]} | Asks: {stats["asks"]} '
+              f'| Cover: {self.bk_liquidation} | Avg Profit: {stats["avg_spread_profit"] / 10000}')
+
+    def evaluate_actions(self) -> List[ActionOutcome]:
+        """
+        Outcome of every action at this decision point against the upcoming tape. Exchange is not changed
+        * Requires fill_oracle. See rlmarket/environment/counterfactual.py for what is simulated
+        """
+        if self._oracle is None:
+            raise RuntimeError('Counterfactual evaluation requires fill_oracle')
+
+        prices = {action: self._order_prices(*self._order_distances(action)) for action in range(self.action_space)}
+        outcomes = []
+        for outcome in scan_actions(self._oracle, self.tape, self._end_time, self._latency, prices):
+            if outcome.side is not None:
+                reward, pnl = self._preview_reward(outcome)
+                outcome = outcome._replace(reward=reward, pnl=pnl)
+            outcomes.append(outcome)
+        return outcomes
 
     def render(self, memory: Deque[Tuple[StateT, int, float, StateT]]):
         """ To do later """
@@ -169,7 +188,42 @@ class Exchange(Environment):
     # ========== Helpers ==========
     def _get_state(self) -> StateT:
         """ Define the state of exchange """
-        return sum((ind.update(self) for ind in self._indicators), ())
+        for ind, out in zip(self._indicators, self._state.slices):
+            ind.write(self, out)
+        return tuple(self._state.array.tolist())
+
+    def _order_distances(self, action: int) -> Tuple[int, int]:
+        """ Distances of bid and ask from the quote in price levels for action """
+        # if action < 5:
+        #     # Symmetric market making
+        #     return action + 1, action + 1
+        # elif action == 5:
+        #     return 3, 1
+        # elif action == 6:
+        #     return 1, 3
+        # elif action == 7:
+        #     return 5, 2
+        # elif action == 8:
+        #     return 2, 5
+        # else:
+        #     raise RuntimeError(f'Unrecognized action {action}')
+        if action == 0:
+            return 3, 3
+        elif action == 1:
+            return 5, 2
+        elif action == 2:
+            return 2, 5
+        else:
+            raise RuntimeError(f'Unrecognized action {action}')
+
+    def _preview_reward(self, outcome: ActionOutcome) -> Tuple[Optional[float], Optional[float]]:
+        """ Reward and pnl of the last episode returned on the execution in outcome. None if mid price is missing """
+        if outcome.mid_price is None:
+            return None, None
+
+        position_pnl = outcome.mid_price * self._position + self._last_position_pnl
+        scaled_pnl = position_pnl * 0.1 if position_pnl > 0 else position_pnl
+        return (self._last_spread_profit + scaled_pnl) / 10000, (self._last_spread_profit + position_pnl) / 10000
 
     def _place_order(self, bid_dist: int, ask_dist: int) -> None:
         """
@@ -179,68 +233,43 @@ class Exchange(Environment):
             hit the market, due to latency. This is fine. We just attribute the profit to the action that originates
             it.
         """
-        # We try not to place order inside the market
-        bid_depths, ask_depths = self.book.get_depth(num_levels=5)
-        bid_price = bid_depths[bid_dist - 1][0]
-        ask_price = ask_depths[ask_dist - 1][0]
+        bid_price, ask_price = self._order_prices(bid_dist, ask_dist)
 
         # "Fancy" LimitOrder will delete the existing one if it does exist when the new LimitOrder hits the market
         self.tape.add_user_order(UserLimitOrder(side='B', price=bid_price, shares=self._order_size))
         self.tape.add_user_order(UserLimitOrder(side='S', price=ask_price, shares=self._order_size))
 
-    def _run_market(self) -> Optional[Execution]:
-        """ Update OrderBook for an event """
-        order = self.tape.next()
-
-        if isinstance(order, LimitOrder):
-            return self.book.add_limit_order(order)
-        elif isinstance(order, MarketOrder):
-            return self.book.match_limit_order(order)
-        elif isinstance(order, CancelOrder):
-            return self.book.cancel_order(order)
-        elif isinstance(order, DeleteOrder):
-            return self.book.delete_order(order)
-        elif isinstance(order, UpdateOrder):
-            return self.book.modify_order(order)
-        elif isinstance(order, UserLimitOrder):
-            return self.book.add_user_limit_order(order)
-        elif isinstance(order, UserMarketOrder):
-            return self.book.match_limit_order_for_user(order)
-        else:
-            raise ValueError(f'Unrecognized order type {type(order)}')
+    def _order_prices(self, bid_dist: int, ask_dist: int) -> Tuple[int, int]:
+        """ Prices of the order pair at the given distances """
+        # We try not to place order inside the market
+        bid_depths, ask_depths = self.book.get_depth(num_levels=5)
+        bid_price = bid_depths[bid_dist - 1][0]
+        ask_price = ask_depths[ask_dist - 1][0]
+        return bid_price, ask_price
 
     def _wait_for_execution(self) -> Optional[Tuple[float, float, float]]:
         """ If tape runs out before order is executed, None is returned """
-        while not self.tape.done:
-            execution = self._run_market()
-
-            if execution:
-                # Calculate profit for last episode
-                mid_price = self.book.mid_price
-                # Calculate PnL before position update
-                position_pnl = mid_price * self._position + self._last_position_pnl
-                scaled_pnl = position_pnl * 0.1 if position_pnl > 0 else position_pnl
-                last_spread_profit = self._last_spread_profit
-                last_reward = (last_spread_profit + scaled_pnl)
-                last_profit = (last_spread_profit + position_pnl)
-
-                # Update for current episode
-                self._position += execution.shares
-                # Calculate pnl after position update
-                self._last_position_pnl = -mid_price * self._position
-                self._last_spread_profit = (self.book.mid_price - execution.price) * execution.shares
-
-                # Book keeping
-                self.bk_spread_profits.append(self._last_spread_profit)
-                if execution.shares > 0:
-                    self.bk_bid_counts += 1
-                else:
-                    self.bk_ask_counts += 1
-
-                return last_reward, last_profit, last_spread_profit
-
-            if self.tape.current_time > self._end_time:
-                # If no execution and end time is passed, return
-                return None
-
-        return None
+        execution = self.engine.wait_for_execution()
+        if execution is None:
+            return None
+
+        # Calculate profit for last episode
+        mid_price = self.book.mid_price
+        # Calculate PnL before position update
+        position_pnl = mid_price * self._position + self._last_position_pnl
+        scaled_pnl = position_pnl * 0.1 if position_pnl > 0 else position_pnl
+        last_spread_profit = self._last_spread_profit
+        last_reward = (last_spread_profit + scaled_pnl)
+        last_profit = (last_spread_profit + position_pnl)
+
+        # Update for current episode
+        self._position += execution.shares
+        # Calculate pnl after position update
+        self._last_position_pnl = -mid_price * self._position
+        self._last_spread_profit = (self.book.mid_price - execution.price) * execution.shares
+
+        # Book keeping. PnL is only known for the episode
+        self.blotter.record(self.tape.current_time, execution.price, execution.shares, mid_price, self._last_action,
+                            self._position)
+
+        return last_reward, last_profit, last_spread_profit
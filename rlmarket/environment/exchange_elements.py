@@ -1,6 +1,6 @@
 from __future__ import annotations
 import abc
-from typing import List, Deque, Optional, Union, Tuple, TYPE_CHECKING
+from typing import List, Deque, Dict, Optional, Union, Tuple, TYPE_CHECKING
 import pickle
 from collections import deque
 import numpy as np
@@ -15,6 +15,7 @@ class Tape:
     """ Provide efficient way to handle real order and user order flow """
 
     def __init__(self, path: str, latency: int = 500000, end_time: int = 57570000000000) -> None:
+        self.path = path
         with open(path, 'rb') as f:
             self._real_queue = pickle.load(f)
         self._num_real_messages = len(self._real_queue)
@@ -26,6 +27,8 @@ class Tape:
         self._real_pointer: int = 0
         self._curr_time: int = 0
         self._user_order_id: int = -1
+        # Resting user order ID to the number of real orders before its arrival. Kept up to date by ReplayEngine
+        self.user_arrivals: Dict[int, int] = {}
 
     def add_user_order(self, order: UserEvent) -> int:
         """ Put user order on tape with correct timestamp and order ID """
@@ -43,13 +46,42 @@ class Tape:
         if self._user_queue:
             ts = self._user_queue[0].timestamp
             if ts < self._real_queue[self._real_pointer].timestamp and ts < self._end_time:
-                return self._user_queue.popleft()
+                order = self._user_queue.popleft()
+                self.user_arrivals[order.id] = self._real_pointer
+                return order
 
         order = self._real_queue[self._real_pointer]
         self._curr_time = order.timestamp
         self._real_pointer += 1
         return order
 
+    def retain_user_arrivals(self, order_ids: List[int]) -> None:
+        """ Forget arrivals of user orders other than order_ids, e.g. those no longer resting in the book """
+        if len(self.user_arrivals) > len(order_ids):
+            arrivals = self.user_arrivals
+            self.user_arrivals = {order_id: arrivals[order_id] for order_id in order_ids if order_id in arrivals}
+
+    def pending_user_time(self) -> Optional[int]:
+        """ Timestamp of the next user order to be released. None if there is no such order """
+        if self._user_queue and self._user_queue[0].timestamp < self._end_time:
+            return self._user_queue[0].timestamp
+        return None
+
+    def seek(self, pointer: int) -> None:
+        """ Mark real orders before pointer as consumed. Used by batched replay that reads real_orders directly """
+        if pointer > self._real_pointer:
+            self._curr_time = self._real_queue[pointer - 1].timestamp
+            self._real_pointer = pointer
+
+    @property
+    def real_orders(self) -> List[Event]:
+        return self._real_queue
+
+    @property
+    def pointer(self) -> int:
+        """ Index of the next real order """
+        return self._real_pointer
+
     @property
     def current_time(self) -> int:
         return self._curr_time
@@ -69,11 +101,44 @@ class Indicator(abc.ABC):
     def update(self, env: Exchange) -> Optional[Tuple]:
         """ Update the internal state and return indicator value """
 
+    def write(self, env: Exchange, out: np.ndarray) -> None:
+        """
+        Update the internal state and write indicator value into out, a slice of size dimension of the observation
+        * Override to skip the intermediate tuple
+        """
+        out[:] = self.update(env)
+
     @property
     def dimension(self):
         return self._dimension
 
 
+class StateBuffer:
+    """
+    Observation buffer of indicators. Indicator i writes into slices[i], a view of array
+    * out is used as the array if given, e.g. a row of the stacked observations of a vectorized exchange
+    * Copies and pickles rebuild the views on the copied array
+    """
+
+    def __init__(self, dimensions: List[int], dtype: type = np.float32, out: Optional[np.ndarray] = None) -> None:
+        size = sum(dimensions, 0)
+        if out is None:
+            out = np.zeros(size, dtype=dtype)
+        elif out.shape != (size,):
+            raise ValueError(f'State buffer of shape {out.shape} does not fit dimension {size}')
+
+        self.dimensions = list(dimensions)
+        self.array = out
+        self.slices: List[np.ndarray] = []
+        offset = 0
+        for dimension in dimensions:
+            self.slices.append(out[offset:offset + dimension])
+            offset += dimension
+
+    def __reduce__(self):
+        return StateBuffer, (self.dimensions, self.array.dtype, self.array.copy())
+
+
 class MidPrice(Indicator):
     """ Return the mid price """
 
@@ -83,33 +148,62 @@ class MidPrice(Indicator):
     def update(self, env: Exchange) -> Optional[Tuple]:
         return (env.book.mid_price,)
 
+    def write(self, env: Exchange, out: np.ndarray) -> None:
+        out[0] = env.book.mid_price
+
+
+class RingBufferIndicator(Indicator):
+    """
+    Last dimension values of a scalar observed at every decision, oldest first
+    * Values are kept in a NumPy ring buffer of twice the window. Each value is written at the cursor and at its
+        mirror one window later, so the window is always the contiguous slice after the cursor
+    * Update is O(1) and output is one slice copy
+    """
+
+    def __init__(self, dimension: int, dtype: type = np.float64) -> None:
+        super().__init__(dimension=dimension)
+        self._buffer = np.zeros(2 * dimension, dtype=dtype)
+        self._cursor = 0
+
+    @abc.abstractmethod
+    def observe(self, env: Exchange) -> Union[int, float]:
+        """ Update the internal state and return the newest value """
+
+    def update(self, env: Exchange) -> Optional[Tuple]:
+        self.push(self.observe(env))
+        return tuple(self.window.tolist())
+
+    def write(self, env: Exchange, out: np.ndarray) -> None:
+        self.push(self.observe(env))
+        out[:] = self.window
+
+    def push(self, value: Union[int, float]) -> None:
+        cursor = self._cursor
+        self._buffer[cursor] = self._buffer[cursor + self._dimension] = value
+        self._cursor = cursor + 1 if cursor + 1 < self._dimension else 0
 
-class MidPriceDeltaSign(Indicator):
+    @property
+    def window(self) -> np.ndarray:
+        """ View of the last values. Only valid until the next push """
+        return self._buffer[self._cursor:self._cursor + self._dimension]
+
+
+class MidPriceDeltaSign(RingBufferIndicator):
     """ Return the signs of mid price changes """
 
     def __init__(self, lags: int) -> None:
-        super().__init__(dimension=lags)
+        super().__init__(dimension=lags, dtype=np.int8)
         self.lags = lags
-        self.store: Deque[int] = deque([0] * lags)
         self.last_price: Optional[int] = None
 
-    def update(self, env: Exchange) -> Optional[Tuple]:
-        book = env.book
-
+    def observe(self, env: Exchange) -> int:
+        mid_price = env.book.mid_price
         if self.last_price is None:
-            self.last_price = book.mid_price
+            self.last_price = mid_price
 
-        mid_price = book.mid_price
-        self.store.append(np.sign(mid_price - self.last_price))
+        sign = (mid_price > self.last_price) - (mid_price < self.last_price)
         self.last_price = mid_price
-
-        if len(self.store) > self.lags:
-            self.store.popleft()
-
-        if len(self.store) == self.lags:
-            return tuple(self.store)
-
-        return None
+        return sign
 
 
 class HalfSpread(Indicator):
@@ -120,6 +214,9 @@ class HalfSpread(Indicator):
     def update(self, env: Exchange) -> Optional[Tuple]:
         return (int(env.book.spread / 2),)
 
+    def write(self, env: Exchange, out: np.ndarray) -> None:
+        out[0] = int(env.book.spread / 2)
+
 
 class Position(Indicator):
     """ Return the current accumulative position """
@@ -130,6 +227,9 @@ class Position(Indicator):
     def update(self, env: Exchange) -> Optional[Tuple]:
         return (env.position,)
 
+    def write(self, env: Exchange, out: np.ndarray) -> None:
+        out[0] = env.position
+
 
 class NormalizedPosition(Indicator):
     """ Return the current accumulative position """
@@ -141,6 +241,9 @@ class NormalizedPosition(Indicator):
     def update(self, env: Exchange) -> Optional[Tuple]:
         return (env.position / self.position_limit,)
 
+    def write(self, env: Exchange, out: np.ndarray) -> None:
+        out[0] = env.position / self.position_limit
+
 
 class Imbalance(Indicator):
     """ Return the bia-ask imbalance """
@@ -148,22 +251,61 @@ class Imbalance(Indicator):
     def __init__(self, num_levels: int = 3, decay: float = 0.5) -> None:
         super().__init__(dimension=1)
         self.num_levels = num_levels
-        self.weights = [np.exp(-decay * idx) for idx in range(num_levels)]
+        self.weights = np.exp(-decay * np.arange(num_levels))
 
     def update(self, env: Exchange) -> Optional[Tuple]:
-        bid_depths, ask_depths = env.book.get_depth(self.num_levels)
-        bid_volume = sum(level[1] * weight for level, weight in zip(bid_depths, self.weights))
-        ask_volume = sum(level[1] * weight for level, weight in zip(ask_depths, self.weights))
-        return (bid_volume - ask_volume) / (bid_volume + ask_volume),
+        return self._imbalance(env),
+
+    def write(self, env: Exchange, out: np.ndarray) -> None:
+        out[0] = self._imbalance(env)
+
+    def _imbalance(self, env: Exchange) -> float:
+        bid_depths, ask_depths = env.book.get_depth_array(self.num_levels)
+        bid_volume = float(bid_depths[:, 1] @ self.weights[:len(bid_depths)])
+        ask_volume = float(ask_depths[:, 1] @ self.weights[:len(ask_depths)])
+        return (bid_volume - ask_volume) / (bid_volume + ask_volume)
+
+
+class QueuePosition(Indicator):
+    """ Real shares in front of user bid and ask. Side without resting user order returns 0 """
+
+    def __init__(self, scale: float = 1.0) -> None:
+        super().__init__(dimension=2)
+        self.scale = scale
+
+    def update(self, env: Exchange) -> Optional[Tuple]:
+        bid_ahead, ask_ahead = env.book.user_shares_ahead
+        return (bid_ahead or 0) / self.scale, (ask_ahead or 0) / self.scale
+
+    def write(self, env: Exchange, out: np.ndarray) -> None:
+        bid_ahead, ask_ahead = env.book.user_shares_ahead
+        out[0] = (bid_ahead or 0) / self.scale
+        out[1] = (ask_ahead or 0) / self.scale
 
 
 class RemainingTime(Indicator):
-    """ Remaining time in relation to end time in range of [0, 1] """
+    """
+    Remaining time in relation to end time in range of [0, 1]
+    * Without start_time and end_time, the window is the current episode of the exchange, which changes per episode
+        when episodes start at random
+    """
 
-    def __init__(self, start_time: int, end_time: int) -> None:
+    def __init__(self, start_time: Optional[int] = None, end_time: Optional[int] = None) -> None:
         super().__init__(dimension=1)
-        self.normalization = end_time - start_time
+        if (start_time is None) != (end_time is None):
+            raise ValueError('Start time and end time should be given together')
+        self.start_time = start_time
         self.end_time = end_time
 
     def update(self, env: Exchange) -> Optional[Tuple]:
-        return ((self.end_time - env.tape.current_time) / self.normalization,)
+        return (self._remaining(env),)
+
+    def write(self, env: Exchange, out: np.ndarray) -> None:
+        out[0] = self._remaining(env)
+
+    def _remaining(self, env: Exchange) -> float:
+        if self.end_time is None:
+            start_time, end_time = env._start_time, env._end_time
+        else:
+            start_time, end_time = self.start_time, self.end_time
+        return (end_time - env.tape.current_time) / (end_time - start_time)
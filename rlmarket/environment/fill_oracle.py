@@ -0,0 +1,187 @@
+"""
+Fill oracle answers when a phantom user LimitOrder will be executed without replaying the tape
+* Real order flow is exogenous. Whether a user order fills depends only on the tape and where the order is placed
+* The rules follow OrderBook. A user bid at price p placed after the first k real orders is executed by the first of
+    1. Run-over: a sell MarketOrder matched against a real bid below p
+    2. Crossing: a sell LimitOrder at or below p
+    3. Queue: a sell MarketOrder matched at p against the oldest order of the level, after all the orders that rested
+        at p when the user order arrived are gone
+  Ask side is symmetric
+"""
+from __future__ import annotations
+from bisect import bisect_left, bisect_right
+from copy import copy
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+import numpy as np
+
+from rlmarket.market import OrderBook, Event, LimitOrder, MarketOrder, CancelOrder, DeleteOrder, UpdateOrder
+
+if TYPE_CHECKING:
+    from rlmarket.environment.exchange_elements import Tape
+
+
+class _FirstBelow:
+    """ Sparse table to find the first position at or after k whose value is at most a bound """
+
+    def __init__(self, positions: List[int], values: List[int]) -> None:
+        self.positions = positions
+        self.tables = [np.array(values, dtype=np.int64)]
+        width = 1
+        while 2 * width <= len(values):
+            last = self.tables[-1]
+            self.tables.append(np.minimum(last[:-width], last[width:]))
+            width *= 2
+
+    def first(self, index: int, bound: int) -> Optional[int]:
+        """ Return the first position >= index with value <= bound """
+        i = bisect_left(self.positions, index)
+        size = len(self.positions)
+        for level in range(len(self.tables) - 1, -1, -1):
+            # Skip the whole block if all its values are above bound
+            if i + (1 << level) <= size and self.tables[level][i] > bound:
+                i += 1 << level
+        if i < size and self.tables[0][i] <= bound:
+            return self.positions[i]
+        return None
+
+
+class FillOracle:
+    """
+    Index of a tape for fill queries. Built once by replaying real orders on a private OrderBook
+    * Positions are indices of real orders in the tape. A user order placed at position k arrives after k real orders
+    """
+
+    def __init__(self, orders: List[Event]) -> None:
+        num_orders = len(orders)
+        self.timestamps = [order.timestamp for order in orders]
+        self.num_orders = num_orders
+        self.bid_quotes = np.zeros(num_orders, dtype=np.int64)  # 0 if no quote
+        self.ask_quotes = np.zeros(num_orders, dtype=np.int64)
+
+        arrivals: Dict[Tuple[str, int], List[Tuple[int, int]]] = {}  # Level to (position, order ID)
+        removals: Dict[int, int] = {}
+        queue_fills: Dict[Tuple[str, int], List[int]] = {}
+        executions = {'B': ([], []), 'S': ([], [])}  # Positions and prices of matches on each book
+        additions = {'B': ([], []), 'S': ([], [])}  # Positions and prices of LimitOrders from each side
+
+        book = OrderBook()
+        for idx, order in enumerate(orders):
+            order_type = type(order)
+            if order_type is LimitOrder:
+                arrivals.setdefault((order.side, order.price), []).append((idx, order.id))
+                additions[order.side][0].append(idx)
+                additions[order.side][1].append(order.price)
+                book.add_limit_order(copy(order))  # Book changes LimitOrder in place
+
+            elif order_type is MarketOrder:
+                side_book = book.order_pool[order.id]
+                price = side_book.order_price(order.id)
+                queue = side_book.price_levels[price].queue
+                if next(iter(queue)) == order.id:
+                    queue_fills.setdefault((side_book.side, price), []).append(idx)
+                if queue[order.id].shares == order.shares:
+                    removals[order.id] = idx
+                executions[side_book.side][0].append(idx)
+                executions[side_book.side][1].append(price)
+                book.match_limit_order(order)
+
+            elif order_type is CancelOrder:
+                book.cancel_order(order)
+
+            elif order_type is DeleteOrder:
+                removals[order.id] = idx
+                book.delete_order(order)
+
+            elif order_type is UpdateOrder:
+                side = book.order_pool[order.old_id].side
+                removals[order.old_id] = idx
+                arrivals.setdefault((side, order.price), []).append((idx, order.id))
+                book.modify_order(order)
+
+            else:
+                raise ValueError(f'Unrecognized order type {type(order)}')
+
+            bid, ask = book.quote
+            self.bid_quotes[idx] = bid or 0
+            self.ask_quotes[idx] = ask or 0
+
+        # For each level, arrival positions and the running max of removal positions in order of arrival
+        self._arrivals: Dict[Tuple[str, int], Tuple[List[int], np.ndarray]] = {}
+        for level, entries in arrivals.items():
+            positions = [position for position, _ in entries]
+            removed = [removals.get(order_id, num_orders) for _, order_id in entries]
+            self._arrivals[level] = positions, np.maximum.accumulate(removed)
+        self._queue_fills = queue_fills
+
+        # Signed so that "at most a bound" means at or through the user price. See _first_fill
+        self._run_over = {'B': _FirstBelow(executions['B'][0], executions['B'][1]),
+                          'S': _FirstBelow(executions['S'][0], [-price for price in executions['S'][1]])}
+        self._crossing = {'B': _FirstBelow(additions['S'][0], additions['S'][1]),
+                          'S': _FirstBelow(additions['B'][0], [-price for price in additions['B'][1]])}
+
+    # ========== Queries ==========
+    def first_fill(self, side: str, price: int, position: int) -> Optional[int]:
+        """ Position of the real order that executes a user order at price resting since position. None if never """
+        sign = 1 if side == 'B' else -1
+        candidates = [
+            self._run_over[side].first(position, sign * price - 1),
+            self._crossing[side].first(position, sign * price),
+            self._first_queue_fill(side, price, position),
+        ]
+        candidates = [candidate for candidate in candidates if candidate is not None]
+        return min(candidates) if candidates else None
+
+    def first_fill_time(self, side: str, price: int, timestamp: int) -> Optional[int]:
+        """
+        Timestamp of the first execution of a user LimitOrder arriving at timestamp. None if never
+        * Price is adjusted like OrderBook.add_user_limit_order when it crosses the real quote
+        """
+        position = bisect_right(self.timestamps, timestamp)
+        fill = self.first_fill(side, self.adjusted_price(side, price, position), position)
+        return self.timestamps[fill] if fill is not None else None
+
+    def adjusted_price(self, side: str, price: int, position: int) -> int:
+        """ Price of a user LimitOrder arriving at position. Moved one tick away from the real quote if crossing it """
+        if position > 0:
+            if side == 'B':
+                ask = int(self.ask_quotes[position - 1])
+                if ask and price >= ask:
+                    return ask - 100
+            else:
+                bid = int(self.bid_quotes[position - 1])
+                if bid and price <= bid:
+                    return bid + 100
+        return price
+
+    def mid_price(self, position: int) -> Optional[int]:
+        """ Mid price right after the real order at position. None if either side is empty """
+        bid, ask = int(self.bid_quotes[position]), int(self.ask_quotes[position])
+        return int((bid + ask) / 2) if bid and ask else None
+
+    def next_fill(self, book: OrderBook, tape: Tape) -> Optional[int]:
+        """ Position of the real order that executes the first of the user orders resting in book """
+        fills = []
+        for side_book in (book.bid_book, book.ask_book):
+            for order_id, price in side_book.user_orders.items():
+                fill = self.first_fill(side_book.side, price, tape.user_arrivals[order_id])
+                if fill is not None:
+                    fills.append(fill)
+        return min(fills) if fills else None
+
+    # ========== Private Methods ==========
+    def _first_queue_fill(self, side: str, price: int, position: int) -> Optional[int]:
+        """ First match on the oldest order of the level after the orders ahead of the user order are gone """
+        fills = self._queue_fills.get((side, price))
+        if not fills:
+            return None
+
+        # Orders arriving before the user order are ahead of it. Last of them leaves the level at cleared
+        cleared = position - 1
+        arrivals = self._arrivals.get((side, price))
+        if arrivals:
+            num_ahead = bisect_left(arrivals[0], position)
+            if num_ahead > 0:
+                cleared = max(cleared, int(arrivals[1][num_ahead - 1]))
+
+        idx = bisect_right(fills, cleared)
+        return fills[idx] if idx < len(fills) else None
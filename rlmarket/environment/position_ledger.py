@@ -0,0 +1,118 @@
+"""
+FIFO ledger of open positions
+* Open lots are kept in two integer arrays, price and unsigned shares, between a head and a tail index. All lots are
+    on the same side
+* A fill on the side of the lots is appended at the tail. An opposite fill consumes lots from the head and whatever
+    is left opens a new position on its own side
+* Arrays are compacted or doubled only when the tail reaches the end, so matching is O(1) amortized per lot
+* Fills are passed by price and shares and never changed
+* realized is the running total of realized PnL since the last reset, in tape units
+"""
+from typing import NamedTuple, Tuple
+import numpy as np
+
+
+class Lot(NamedTuple):
+    """ Open lot. Shares are signed, positive for long """
+    price: int
+    shares: int
+
+
+class PositionLedger:
+    """ Open lots matched on FIFO basis """
+
+    def __init__(self, capacity: int = 64) -> None:
+        self._prices = np.zeros(max(capacity, 1), dtype=np.int64)
+        self._shares = np.zeros(max(capacity, 1), dtype=np.int64)
+        self._head = 0
+        self._tail = 0
+        self._side = 0  # 1 for long, -1 for short and 0 for flat
+        self.realized = 0
+
+    def reset(self) -> None:
+        """ Close all lots and clear realized PnL. Buffers are kept """
+        self._head = self._tail = 0
+        self._side = 0
+        self.realized = 0
+
+    def fill(self, price: int, shares: int) -> Tuple[int, int]:
+        """
+        Match a fill of signed shares at price against open lots
+        * Return realized PnL and matched shares. Matched shares are signed like the fill and 0 if it only adds to the
+            position
+        """
+        if shares == 0:
+            return 0, 0
+
+        side = 1 if shares > 0 else -1
+        if side == self._side or self._side == 0:
+            self._push(price, abs(shares))
+            self._side = side
+            return 0, 0
+
+        # Consume lots from the head
+        prices, lots = self._prices, self._shares
+        head, tail = self._head, self._tail
+        remaining = abs(shares)
+        pnl = 0
+        while remaining and head < tail:
+            lot = int(lots[head])
+            matched = min(lot, remaining)
+            pnl += (price - int(prices[head])) * matched
+            remaining -= matched
+            if matched == lot:
+                head += 1
+            else:
+                lots[head] = lot - matched
+        self._head = head
+
+        if remaining:
+            self._head = self._tail = 0  # All lots are consumed
+            self._push(price, remaining)
+            self._side = side
+        elif head == tail:
+            self._head = self._tail = 0
+            self._side = 0
+
+        # Selling to close long earns price minus cost, buying to close short the opposite
+        self.realized -= side * pnl
+        return -side * pnl, side * (abs(shares) - remaining)
+
+    def copy(self) -> 'PositionLedger':
+        """ Independent ledger with the same open lots """
+        ledger = PositionLedger.__new__(PositionLedger)
+        ledger._prices = self._prices.copy()
+        ledger._shares = self._shares.copy()
+        ledger._head, ledger._tail, ledger._side = self._head, self._tail, self._side
+        ledger.realized = self.realized
+        return ledger
+
+    def __len__(self) -> int:
+        return self._tail - self._head
+
+    def __getitem__(self, idx: int) -> Lot:
+        """ Lot at idx, oldest first """
+        if not 0 <= idx < len(self):
+            raise IndexError(f'Lot index {idx} out of range')
+        return Lot(int(self._prices[self._head + idx]), self._side * int(self._shares[self._head + idx]))
+
+    @property
+    def position(self) -> int:
+        return self._side * int(self._shares[self._head:self._tail].sum())
+
+    # ========== Private Methods ==========
+    def _push(self, price: int, shares: int) -> None:
+        """ Append lot at the tail. Compact if at least half of the arrays are consumed, otherwise double them """
+        if self._tail == len(self._prices):
+            size = self._tail - self._head
+            if 2 * self._head >= len(self._prices):
+                self._prices[:size] = self._prices[self._head:self._tail]
+                self._shares[:size] = self._shares[self._head:self._tail]
+            else:
+                self._prices = np.concatenate([self._prices[self._head:self._tail], np.zeros_like(self._prices)])
+                self._shares = np.concatenate([self._shares[self._head:self._tail], np.zeros_like(self._shares)])
+            self._head, self._tail = 0, size
+
+        self._prices[self._tail] = price
+        self._shares[self._tail] = shares
+        self._tail += 1
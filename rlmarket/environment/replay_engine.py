@@ -0,0 +1,215 @@
+"""
+Replay of a tape on an order book
+* ReplayEngine is the replay loop shared by exchanges. Events are dispatched through a jump table indexed by integer
+    type code
+* real_order_table and apply_orders are the same dispatch for code that replays real orders without an engine
+* The book changes LimitOrder in place when it is matched. Orders of a tape belong to that tape and are applied as
+    they are. Orders owned by someone else are applied with copy_orders
+* ReplayEngine.advance batches real orders that cannot affect user orders
+"""
+from copy import copy
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from rlmarket.environment.exchange_elements import Tape
+from rlmarket.environment.fill_oracle import FillOracle
+from rlmarket.market import OrderBook, Event, LimitOrder, MarketOrder, CancelOrder, DeleteOrder, UpdateOrder
+from rlmarket.market import UserLimitOrder, UserMarketOrder, Execution
+
+# Integer type codes of events. They index the dispatch table of ReplayEngine. Real orders come first
+LIMIT, MARKET, CANCEL, DELETE, UPDATE, USER_LIMIT, USER_MARKET = range(7)
+EVENT_CODES = {
+    LimitOrder: LIMIT,
+    MarketOrder: MARKET,
+    CancelOrder: CANCEL,
+    DeleteOrder: DELETE,
+    UpdateOrder: UPDATE,
+    UserLimitOrder: USER_LIMIT,
+    UserMarketOrder: USER_MARKET,
+}
+EVENT_NAMES = ('limit', 'market', 'cancel', 'delete', 'update', 'user_limit', 'user_market')
+
+
+def event_codes(orders: List[Event]) -> bytes:
+    """ Column of type codes aligned with orders """
+    try:
+        return bytes(EVENT_CODES[type(order)] for order in orders)
+    except KeyError as error:
+        raise ValueError(f'Unrecognized order type {error.args[0]}') from None
+
+
+def real_order_table(book: OrderBook, copy_orders: bool = False) -> Tuple[Callable, ...]:
+    """ Handlers of real orders on book indexed by type code. With copy_orders, LimitOrders are copied before added """
+    if copy_orders:
+        def add_limit_order(order: LimitOrder) -> Optional[Execution]:
+            return book.add_limit_order(copy(order))
+    else:
+        add_limit_order = book.add_limit_order
+
+    return add_limit_order, book.match_limit_order, book.cancel_order, book.delete_order, book.modify_order
+
+
+def apply_orders(table: Sequence[Callable], orders: List[Event], codes: bytes, start: int, stop: int) -> None:
+    """ Apply orders from start to stop through table. codes is the column of type codes aligned with orders """
+    for pointer in range(start, stop):
+        table[codes[pointer]](orders[pointer])
+
+
+class ReplayEngine:
+    """
+    Replay loop of an exchange over its tape and book
+    * Type codes of real orders are computed once per tape as a column aligned with the real orders. Dispatching a
+        real order is then two indexings instead of an isinstance chain. User orders are looked up by type
+    * counts keeps the number of applied events by type code, including real orders applied by fast forward
+    * Stopping rules are those of the exchanges. See wait_for_execution
+    """
+
+    def __init__(self, tape: Tape, book: OrderBook, end_time: int, fast_forward: bool = False,
+                 oracle: Optional[FillOracle] = None) -> None:
+        self.tape = tape
+        self.book = book
+        self.end_time = end_time
+        self.fast_forward = fast_forward  # Batch replay of orders that cannot execute user orders
+        self.oracle = oracle  # Jump to the next execution with FillOracle. Requires fast_forward
+        self.codes = event_codes(tape.real_orders)
+        self.counts = [0] * len(EVENT_NAMES)
+        self._table = real_order_table(book) + (book.add_user_limit_order, book.match_limit_order_for_user)
+
+    @property
+    def counters(self) -> Dict[str, int]:
+        """ Number of applied events by event type """
+        return dict(zip(EVENT_NAMES, self.counts))
+
+    def run(self) -> Optional[Execution]:
+        """ Apply the next event of the tape """
+        tape = self.tape
+        pointer = tape.pointer
+        order = tape.next()
+        if tape.pointer != pointer:
+            code = self.codes[pointer]
+            self.counts[code] += 1
+            return self._table[code](order)
+
+        code = EVENT_CODES.get(type(order))
+        if code is None:
+            raise ValueError(f'Unrecognized order type {type(order)}')
+        self.counts[code] += 1
+        execution = self._table[code](order)
+        # Arrivals only matter for user orders still resting. Forget the others as new user orders come in
+        book = self.book
+        tape.retain_user_arrivals([*book.bid_book.user_orders, *book.ask_book.user_orders])
+        return execution
+
+    def warm_up(self, start_time: int) -> None:
+        """ Run the tape until start_time is reached """
+        while self.tape.current_time < start_time:
+            self.run()
+
+    def wait_for_execution(self) -> Optional[Execution]:
+        """
+        Run the tape until a user order is executed. None if the tape runs out or end time is passed first
+        * End time is passed with the first real order after it that produces no execution
+        """
+        tape = self.tape
+        while not tape.done:
+            if self.fast_forward:
+                passed_end = self.advance()
+                if passed_end or tape.done:
+                    return None
+
+            execution = self.run()
+
+            if execution:
+                return execution
+
+            if tape.current_time > self.end_time:
+                # If no execution and end time is passed, return
+                return None
+
+        return None
+
+    def drain(self) -> None:
+        """ Run the rest of the tape """
+        while not self.tape.done:
+            self.run()
+
+    def replay(self, stop: int) -> None:
+        """ Apply real orders before stop, skipping user orders. Used where the book has no user orders """
+        tape = self.tape
+        start = tape.pointer
+        stop = max(start, stop)
+        apply_orders(self._table, tape.real_orders, self.codes, start, stop)
+        tape.seek(stop)
+        self._count(start, stop)
+
+    def advance(self) -> bool:
+        """
+        Apply real orders up to the next one that may execute user orders. Return True if end time is passed
+        * Stop before user order arrivals, MarketOrders matched at or through the front user order price and
+            LimitOrders crossing the front user order price on the other side
+        * With oracle, stop right before the real order that executes a user order instead
+        * Orders in between cannot produce Execution and do not change user orders. Therefore, they are dispatched
+            directly by type code and the front user order prices can be read once
+        * Stopping points are the same as running the tape order by order and checking end time after each order
+        """
+        tape, book, end_time = self.tape, self.book, self.end_time
+        orders, codes, table = tape.real_orders, self.codes, self._table
+        num_orders = len(orders)
+        user_time = tape.pending_user_time()
+        pointer = start = tape.pointer
+
+        use_oracle = self.oracle is not None
+        if use_oracle:
+            fill = self.oracle.next_fill(book, tape)
+            stop = num_orders if fill is None else fill
+        else:
+            stop = num_orders
+            bid_book, ask_book = book.bid_book, book.ask_book
+            user_bid, user_ask = bid_book.user_order_price, ask_book.user_order_price
+
+        passed_end = False
+        while pointer < stop:
+            order = orders[pointer]
+            if user_time is not None and user_time < order.timestamp:
+                break
+
+            code = codes[pointer]
+            if use_oracle:
+                if table[code](order) is not None:
+                    raise RuntimeError(f'Fill oracle missed execution at {order}')
+            else:
+                if code == MARKET:
+                    # Sell MarketOrder is matched against bid book
+                    if order.side == 'S':
+                        if user_bid is not None and bid_book.order_price(order.id) <= user_bid:
+                            break
+                    elif user_ask is not None and ask_book.order_price(order.id) >= user_ask:
+                        break
+                elif code == LIMIT:
+                    if order.side == 'B':
+                        if user_ask is not None and order.price >= user_ask:
+                            break
+                    elif user_bid is not None and order.price <= user_bid:
+                        break
+                table[code](order)
+
+            pointer += 1
+            if order.timestamp > end_time:
+                passed_end = True
+                break
+
+        if pointer > start:
+            tape.seek(pointer)
+            self._count(start, pointer)
+        return passed_end
+
+    def _count(self, start: int, stop: int) -> None:
+        """ Count real orders from start to stop applied outside of run """
+        if stop > start:
+            column = self.codes[start:stop]
+            for code in range(USER_LIMIT):
+                self.counts[code] += column.count(code)
+
+
+def fast_forward(tape: Tape, book: OrderBook, end_time: int, oracle: Optional[FillOracle] = None) -> bool:
+    """ One ReplayEngine.advance on tape and book. Type codes of the tape are computed on every call """
+    return ReplayEngine(tape, book, end_time, fast_forward=True, oracle=oracle).advance()
@@ -0,0 +1,61 @@
+"""
+Book snapshots to warm-start an exchange in the middle of a session
+* Snapshot taken for a time is the book right after the warm-up of an exchange starting at that time, together with
+    the position of the next real order on the tape
+* Only real orders are replayed. Snapshot never contains user orders
+* SnapshotLadder keeps snapshots at a regular interval so that an exchange can start anywhere in the session with a
+    short catch-up replay from the nearest snapshot before the start
+"""
+from bisect import bisect_right
+from copy import deepcopy
+from typing import List, NamedTuple, Sequence
+
+from rlmarket.environment.exchange_elements import Tape
+from rlmarket.environment.replay_engine import ReplayEngine
+from rlmarket.market import OrderBook
+
+
+class Snapshot(NamedTuple):
+    """ Book state at time on the tape of path """
+    path: str
+    time: int  # Start time the snapshot is taken for
+    pointer: int  # Index of the next real order
+    book: OrderBook
+
+
+def take_snapshots(path: str, times: Sequence[int], lean: bool = False) -> List[Snapshot]:
+    """
+    Replay the tape of path once and return snapshots at times in ascending order
+    * The tape is private to the replay, so its orders are applied as they are
+    """
+    tape = Tape(path)
+    book = OrderBook(lean=lean)
+    times = sorted(times)
+    engine = ReplayEngine(tape, book, times[-1] if times else 0)
+
+    snapshots = []
+    for time in times:
+        # Same stopping rule as the warm-up loop of exchanges
+        while tape.current_time < time:
+            if tape.done:
+                raise ValueError(f'Tape of {path} ends before {time}')
+            engine.run()
+        snapshots.append(Snapshot(path, time, tape.pointer, deepcopy(book)))
+    return snapshots
+
+
+class SnapshotLadder:
+    """ Snapshots every interval nanoseconds from start_time to end_time, taken in one replay of the tape of path """
+
+    def __init__(self, path: str, start_time: int, end_time: int, interval: int, lean: bool = False) -> None:
+        if interval <= 0:
+            raise ValueError(f'Snapshot interval {interval} should be positive')
+        self.times = list(range(start_time, end_time, interval))
+        self.snapshots = take_snapshots(path, self.times, lean=lean)
+
+    def nearest(self, time: int) -> Snapshot:
+        """ Latest snapshot at or before time """
+        idx = bisect_right(self.times, time) - 1
+        if idx < 0:
+            raise ValueError(f'No snapshot at or before {time}')
+        return self.snapshots[idx]
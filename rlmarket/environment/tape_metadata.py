@@ -0,0 +1,61 @@
+"""
+Metadata sidecar of a tape file
+* Facts about the whole tape that take a full replay to find out. They are recorded once, at conversion or at the
+    first full replay, in a JSON file next to the pickle
+* clears: whether the book is empty after the last real order. User orders are phantom and cannot change it, so
+    exchanges use it to skip draining the rest of the tape in clean_up
+"""
+import json
+from pathlib import Path
+from typing import Any, Dict, List
+
+from rlmarket.environment.exchange_elements import Tape
+from rlmarket.environment.replay_engine import apply_orders, event_codes, real_order_table
+from rlmarket.market import OrderBook, Event
+
+
+def metadata_path(path: str) -> Path:
+    return Path(path).with_suffix('.json')
+
+
+def load_metadata(path: str) -> Dict[str, Any]:
+    """ Metadata of the tape file at path. Empty if not recorded """
+    try:
+        with open(metadata_path(path), 'r') as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return metadata if isinstance(metadata, dict) else {}
+
+
+def save_metadata(path: str, **fields: Any) -> None:
+    """ Merge fields into the metadata of the tape file at path """
+    metadata = load_metadata(path)
+    metadata.update(fields)
+    try:
+        with open(metadata_path(path), 'w') as f:
+            json.dump(metadata, f)
+    except OSError as error:
+        print(f'Cannot save metadata of {path}: {error}')
+
+
+def validate_orders(orders: List[Event]) -> Dict[str, Any]:
+    """ Replay orders on a private book and return metadata fields. Orders belong to the caller and are not changed """
+    book = OrderBook()
+    apply_orders(real_order_table(book, copy_orders=True), orders, event_codes(orders), 0, len(orders))
+    return {'num_orders': len(orders), 'clears': book.empty}
+
+
+def clears_at_end(tape: Tape) -> bool:
+    """ True if metadata records that the book is empty after the last order of tape """
+    metadata = load_metadata(tape.path)
+    return metadata.get('clears') is True and metadata.get('num_orders') == len(tape.real_orders)
+
+
+def record_clearing(tape: Tape, book: OrderBook) -> None:
+    """ Record whether book is empty after tape is drained, so that later clean-ups can skip the drain """
+    if not tape.done:
+        raise RuntimeError('Tape should be drained before recording')
+    metadata = load_metadata(tape.path)
+    if metadata.get('clears') != book.empty or metadata.get('num_orders') != len(tape.real_orders):
+        save_metadata(tape.path, num_orders=len(tape.real_orders), clears=book.empty)
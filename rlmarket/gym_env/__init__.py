@@ -1,2 +1,7 @@
 from rlmarket.gym_env.absolute_exchange import AbsoluteExchange
 from rlmarket.gym_env.relative_exchange import RelativeExchange
+from rlmarket.gym_env.multi_agent_exchange import MultiAgentExchange
+from rlmarket.gym_env.vec_exchange import VecExchange
+from rlmarket.gym_env.subproc_vec_exchange import SubprocVecExchange
+from rlmarket.gym_env.session_slices import SliceSpec, SliceResult, run_slices, merge_results
+from rlmarket.gym_env.fork_runner import ForkRunner, EpisodeResult
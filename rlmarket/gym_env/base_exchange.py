@@ -1,16 +1,23 @@
 """
 Base Exchange class based on gym env
 """
-from typing import List, Deque, DefaultDict, Optional, Tuple
+from typing import List, DefaultDict, Dict, Optional, Tuple
 import abc
-from collections import deque, defaultdict
+from collections import defaultdict
 from gym import Env, spaces
 import numpy as np
 from pandas import Timedelta
 
-from rlmarket.environment.exchange_elements import Tape, Indicator
+from rlmarket.environment.blotter import Blotter, LIQUIDATION
+from rlmarket.environment.counterfactual import ActionOutcome, scan_actions
+from rlmarket.environment.event_indicators import attach_event_indicators
+from rlmarket.environment.exchange_elements import Tape, Indicator, StateBuffer, RemainingTime
+from rlmarket.environment.fill_oracle import FillOracle
+from rlmarket.environment.position_ledger import PositionLedger
+from rlmarket.environment.replay_engine import ReplayEngine
+from rlmarket.environment.snapshot import Snapshot, SnapshotLadder
+from rlmarket.environment.tape_metadata import clears_at_end, record_clearing
 from rlmarket.market import OrderBook
-from rlmarket.market import LimitOrder, MarketOrder, CancelOrder, DeleteOrder, UpdateOrder
 from rlmarket.market import UserLimitOrder, UserMarketOrder, Execution
 
 
@@ -18,11 +25,15 @@ class BaseExchange(Env, abc.ABC):
     """ Exchange environment that implements the gym env API """
 
     tape: Tape
+    engine: ReplayEngine
 
     def __init__(self, files: List[str], indicators: List[Indicator],
                  reward_lb: float, reward_ub: float,
                  start_time: int, end_time: int, latency: int = 20_000_000,
-                 order_size: int = 100, position_limit: int = 10000, liquidation_ratio: float = 0.2) -> None:
+                 order_size: int = 100, position_limit: int = 10000, liquidation_ratio: float = 0.2,
+                 fast_forward: bool = False, fill_oracle: bool = False,
+                 episode_length: Optional[int] = None, snapshot_interval: int = 600_000_000_000,
+                 seed: Optional[int] = None, copy_state: bool = False) -> None:
 
         if reward_lb >= 0:
             raise ValueError(f'Reward lower bound {reward_lb} should be negative')
@@ -37,6 +48,10 @@ class BaseExchange(Env, abc.ABC):
                        for file in files]
 
         self._indicators = indicators
+        # Indicators write into their slices of one observation buffer. Returned states are the buffer itself and
+        # are overwritten by the next state unless copy_state
+        self._state = StateBuffer([ind.dimension for ind in indicators])
+        self._copy_state = copy_state
         self._path_pointer = -1  # Point to the file to use
 
         # Reward parameters
@@ -47,13 +62,31 @@ class BaseExchange(Env, abc.ABC):
         self._start_time = start_time
         self._end_time = end_time
         self._latency = latency
+        # With episode_length, each episode is a random window of that length within the session from start_time to
+        # end_time. It is restored from the nearest snapshot of a ladder taken once per file
+        self._session_start = start_time
+        self._session_end = end_time
+        self._episode_length = episode_length
+        self._snapshot_interval = snapshot_interval
+        self._ladders: Dict[str, SnapshotLadder] = {}
+        self._random = np.random.RandomState(seed)
+        if episode_length is not None and not 0 < episode_length <= end_time - start_time:
+            raise ValueError(f'Episode length {episode_length} should be positive and within the session')
+        if episode_length is not None and any(isinstance(ind, RemainingTime) and ind.end_time is not None
+                                              for ind in indicators):
+            raise ValueError('RemainingTime should follow the episode window when episodes start at random')
 
         # Order elements
-        self._open_positions: Deque[Execution] = deque()
+        self._open_positions = PositionLedger()
         self._position = 0
         self._order_size = order_size
         self._position_limit = position_limit
         self._liquidation_ratio = liquidation_ratio  # The portion of position to neutralize when using MarketOrder
+        self._fast_forward = fast_forward  # Batch replay of orders that cannot execute user orders
+        self._fill_oracle = fill_oracle  # Jump to the next execution with FillOracle. Requires fast_forward
+        self._oracles: Dict[str, FillOracle] = {}  # Built once per file
+        self._oracle: Optional[FillOracle] = None
+        self._snapshot: Optional[Snapshot] = None  # Book state at start time to skip the warm-up
 
         # Set up market
         self.book = OrderBook()
@@ -61,32 +94,46 @@ class BaseExchange(Env, abc.ABC):
         # Book keeping stats
         self.bk_action_counts: DefaultDict[int, int] = defaultdict(int)
         self.bk_liquidation: int = 0
-        self.bk_bid_counts: int = 0
-        self.bk_ask_counts: int = 0
-        self.bk_spread_profits: List[int] = []
-        self.bk_total_pnl = 0
+        self.blotter = Blotter()  # Fills of the episode
+        self._last_action = LIQUIDATION  # Action of the last order sent. Fills are attributed to it
 
     def reset(self) -> np.ndarray:
         """ Reset exchange status """
+        if self._episode_length is not None:
+            # Nanosecond times overflow the default int32 of numpy on Windows
+            self._start_time = int(self._random.randint(self._session_start,
+                                                        self._session_end - self._episode_length + 1, dtype=np.int64))
+            self._end_time = self._start_time + self._episode_length
         print(f'Trading time is from {Timedelta(self._start_time, "ns")} to {Timedelta(self._end_time, "ns")}')
         self._path_pointer = (self._path_pointer + 1) % len(self._paths)
-        self.tape = Tape(self._paths[self._path_pointer], latency=self._latency, end_time=self._end_time)
-
-        self._open_positions.clear()
-        self._position = 0
-        self.book.reset()
-
-        # Reset training stats
-        self.bk_action_counts.clear()
-        self.bk_liquidation = 0
-        self.bk_bid_counts = 0
-        self.bk_ask_counts = 0
-        self.bk_spread_profits = []
-        self.bk_total_pnl = 0
+        path = self._paths[self._path_pointer]
+        self.tape = Tape(path, latency=self._latency, end_time=self._end_time)
+        if self._fill_oracle:
+            if path not in self._oracles:
+                self._oracles[path] = FillOracle(self.tape.real_orders)
+            self._oracle = self._oracles[path]
+
+        snapshot = self._snapshot
+        if snapshot is None and self._episode_length is not None:
+            if path not in self._ladders:
+                self._ladders[path] = SnapshotLadder(path, self._session_start, self._session_end,
+                                                     self._snapshot_interval)
+            snapshot = self._ladders[path].nearest(self._start_time)
+
+        if snapshot is not None:
+            if snapshot.path != path or snapshot.time > self._start_time:
+                raise ValueError(f'Snapshot at {snapshot.time} of {snapshot.path} does not precede '
+                                 f'start time {self._start_time} of {path}')
+            self.tape.seek(snapshot.pointer)
+            self.book = snapshot.book.fork()  # Snapshot books are never updated, so a copy-on-write fork is enough
+        else:
+            self.book.reset()
+        self._reset_account()
+        attach_event_indicators(self._indicators, self.book)
 
-        # Load market
-        while self.tape.current_time < self._start_time:
-            self._run_market()
+        # Load market. Only the catch-up from the snapshot is replayed if there is one
+        self.engine = ReplayEngine(self.tape, self.book, self._end_time, self._fast_forward, self._oracle)
+        self.engine.warm_up(self._start_time)
 
         return self._get_state()
 
@@ -101,19 +148,7 @@ class BaseExchange(Env, abc.ABC):
         * The reason we do not want to separate spread profit from position unrealized PnL is that we will
             over-emphasize the spread profit because position PnL is discounted while spread profit is not in this case.
         """
-        # Perform action
-        if action == 0:
-            self._place_order(3, 3)
-        elif action == 1:
-            self._place_order(5, 2)
-        elif action == 2:
-            self._place_order(2, 5)
-        elif action == 3:
-            self._place_order(1, 1)  # For unittest
-        else:
-            raise RuntimeError(f'Unrecognized action {action}')
-
-        self.bk_action_counts[action] += 1
+        self._perform_action(action)
 
         # Wait for result
         reward_pair = self._wait_for_execution()
@@ -121,16 +156,7 @@ class BaseExchange(Env, abc.ABC):
 
             # Neutralize position if exceeds limit
             if abs(self._position) >= self._position_limit:
-                # Book keeping
-                self.bk_liquidation += 1
-
-                # Calculate shares to cover
-                shares = int(self._position * self._liquidation_ratio)
-                if shares > 0:
-                    self.tape.add_user_order(UserMarketOrder(side='S', shares=shares))
-                else:
-                    self.tape.add_user_order(UserMarketOrder(side='B', shares=abs(shares)))
-
+                self._place_liquidation_order()
                 liquidation_pair = self._wait_for_execution()  # Liquidate position
                 if liquidation_pair:
                     # Assumes that both regular execution and liquidation hit the lower bound
@@ -145,22 +171,47 @@ class BaseExchange(Env, abc.ABC):
             return self._get_state(), reward_pair[0], False, {'pnl': reward_pair[1]}
         return self._get_state(), 0, True, {'pnl': 0}
 
-    def clean_up(self) -> None:
+    def clean_up(self, strict: bool = False) -> None:
+        """
+        Check that the market clears at the end of the tape and print stats
+        * Drain of the rest of the tape is skipped if tape metadata records that the market clears, unless strict
+        """
         final_mtm = self.book.mid_price
 
-        while not self.tape.done:
-            self._run_market()
+        if strict or not clears_at_end(self.tape):
+            self.engine.drain()
+            record_clearing(self.tape, self.book)
 
-        # Check if exchange finishes properly
-        if not self.book.empty:
-            raise RuntimeError('Market is not fully cleared')
+            # Check if exchange finishes properly
+            if not self.book.empty:
+                raise RuntimeError('Market is not fully cleared')
 
-        tmp = {idx: self.bk_action_counts[idx] for idx in range(self.action_space.n)}
-        print(f'Actions: {tmp} | Bids: {self.bk_bid_counts} | Asks: {self.bk_ask_counts} | Cover: {self.bk_liquidation}'
-              f' | Avg SP: {np.mean(self.bk_spread_profits) / 10000:.3g}'
-              f' | SP: {np.sum(self.bk_spread_profits) / 10000}'
-              f' | Pos PnL: {(self.bk_total_pnl + final_mtm * self._position) / 10000}'
-              f' | Pos: {self._position}')
+        self._print_stats(final_mtm)
+
+    def evaluate_actions(self) -> List[ActionOutcome]:
+        """
+        Outcome of every action at this decision point against the upcoming tape. Exchange is not changed
+        * Requires fill_oracle. See rlmarket/environment/counterfactual.py for what is simulated
+        """
+        if self._oracle is None:
+            raise RuntimeError('Counterfactual evaluation requires fill_oracle')
+
+        prices = {action: self._order_prices(*self._order_distances(action)) for action in range(self.action_space.n)}
+        outcomes = []
+        for outcome in scan_actions(self._oracle, self.tape, self._end_time, self._latency, prices):
+            if outcome.side is not None:
+                reward, pnl = self._preview_reward(outcome)
+                outcome = outcome._replace(reward=reward, pnl=pnl)
+            outcomes.append(outcome)
+        return outcomes
+
+    def warm_start(self, snapshot: Optional[Snapshot]) -> None:
+        """ Start episodes from snapshot instead of replaying the tape from the open. None to replay again """
+        self._snapshot = snapshot
+
+    def bind_state(self, out: np.ndarray) -> None:
+        """ Write states into out from now on, e.g. a row of the stacked observations of a vectorized exchange """
+        self._state = StateBuffer(self._state.dimensions, out=out)
 
     def render(self, mode='human'):
         pass
@@ -169,31 +220,80 @@ class BaseExchange(Env, abc.ABC):
     def position(self) -> int:
         return self._position
 
+    @property
+    def paths(self) -> List[str]:
+        """ Tape files that episodes cycle through """
+        return list(self._paths)
+
     # ========== Private methods ==========
+    def _print_stats(self, final_mtm: int) -> None:
+        """ Print training stats with position marked at final_mtm """
+        tmp = {idx: self.bk_action_counts[idx] for idx in range(self.action_space.n)}
+        stats = self.blotter.summary(final_mtm)
+        print(f'Actions: {tmp} | Bids: {stats["bids"]} | Asks: {stats["asks"]} | Cover: {self.bk_liquidation}'
+              f' | Avg SP: {stats["avg_spread_profit"] / 10000:.3g}'
+              f' | SP: {stats["spread_capture"] / 10000}'
+              f' | Pos PnL: {stats["inventory_pnl"] / 10000}'
+              f' | Pos: {self._position}')
+
+    def _reset_account(self) -> None:
+        """ Clear position, open positions and training stats """
+        self._open_positions.reset()
+        self._position = 0
+
+        # Reset training stats
+        self.bk_action_counts.clear()
+        self.bk_liquidation = 0
+        self.blotter.reset()
+
+    def _perform_action(self, action: int) -> None:
+        """ Place the order pair of action """
+        self._place_order(*self._order_distances(action))
+
+        self.bk_action_counts[action] += 1
+        self._last_action = action
+
+    def _place_liquidation_order(self) -> None:
+        """ Send MarketOrder to neutralize part of the position """
+        # Book keeping
+        self.bk_liquidation += 1
+        self._last_action = LIQUIDATION
+
+        # Calculate shares to cover
+        shares = int(self._position * self._liquidation_ratio)
+        if shares > 0:
+            self.tape.add_user_order(UserMarketOrder(side='S', shares=shares))
+        else:
+            self.tape.add_user_order(UserMarketOrder(side='B', shares=abs(shares)))
+
     def _get_state(self) -> np.ndarray:
         """ Define the state of exchange """
-        return np.array(sum((ind.update(self) for ind in self._indicators), ())).astype(np.float32)
-
-    def _run_market(self) -> Optional[Execution]:
-        """ Update OrderBook for an event """
-        order = self.tape.next()
-
-        if isinstance(order, LimitOrder):
-            return self.book.add_limit_order(order)
-        elif isinstance(order, MarketOrder):
-            return self.book.match_limit_order(order)
-        elif isinstance(order, CancelOrder):
-            return self.book.cancel_order(order)
-        elif isinstance(order, DeleteOrder):
-            return self.book.delete_order(order)
-        elif isinstance(order, UpdateOrder):
-            return self.book.modify_order(order)
-        elif isinstance(order, UserLimitOrder):
-            return self.book.add_user_limit_order(order)
-        elif isinstance(order, UserMarketOrder):
-            return self.book.match_limit_order_for_user(order)
+        for ind, out in zip(self._indicators, self._state.slices):
+            ind.write(self, out)
+        return self._state.array.copy() if self._copy_state else self._state.array
+
+    def _order_distances(self, action: int) -> Tuple[int, int]:
+        """ Distances of bid and ask from the quote in price levels for action """
+        if action == 0:
+            return 3, 3
+        elif action == 1:
+            return 5, 2
+        elif action == 2:
+            return 2, 5
+        elif action == 3:
+            return 1, 1  # For unittest
         else:
-            raise ValueError(f'Unrecognized order type {type(order)}')
+            raise RuntimeError(f'Unrecognized action {action}')
+
+    def _preview_reward(self, outcome: ActionOutcome) -> Tuple[float, float]:
+        """ Reward and pnl of the execution in outcome. Open positions are left untouched """
+        shares = self._order_size if outcome.side == 'B' else -self._order_size
+        open_positions = self._open_positions
+        self._open_positions = open_positions.copy()
+        try:
+            return self._calculate_reward(Execution(0, outcome.price, shares))
+        finally:
+            self._open_positions = open_positions
 
     def _place_order(self, bid_dist: int, ask_dist: int) -> None:
         """
@@ -203,41 +303,48 @@ class BaseExchange(Env, abc.ABC):
             hit the market, due to latency. This is fine. We just attribute the profit to the action that originates
             it.
         """
-        # We try not to place order inside the market
-        bid_depths, ask_depths = self.book.get_depth(num_levels=5)
-        bid_price = bid_depths[bid_dist - 1][0]
-        ask_price = ask_depths[ask_dist - 1][0]
+        bid_price, ask_price = self._order_prices(bid_dist, ask_dist)
 
         # "Fancy" LimitOrder will delete the existing one if it does exist when the new LimitOrder hits the market
         self.tape.add_user_order(UserLimitOrder(side='B', price=bid_price, shares=self._order_size))
         self.tape.add_user_order(UserLimitOrder(side='S', price=ask_price, shares=self._order_size))
 
+    def _order_prices(self, bid_dist: int, ask_dist: int) -> Tuple[int, int]:
+        """ Prices of the order pair at the given distances """
+        # We try not to place order inside the market
+        bid_depths, ask_depths = self.book.get_depth(num_levels=5)
+        bid_price = bid_depths[bid_dist - 1][0]
+        ask_price = ask_depths[ask_dist - 1][0]
+        return bid_price, ask_price
+
     def _wait_for_execution(self) -> Optional[Tuple[float, float]]:
-        """ If tape runs out before order is executed, None is returned """
-        while not self.tape.done:
-            execution = self._run_market()
-
-            if execution:
-                # Book keeping. Move booking to the front because _calculate_pnl will change Execution
-                mid_price = self.book.mid_price
-                self.bk_total_pnl -= mid_price * execution.shares
-                self.bk_spread_profits.append((mid_price - execution.price) * execution.shares)
-                if execution.shares > 0:
-                    self.bk_bid_counts += 1
-                else:
-                    self.bk_ask_counts += 1
-
-                # Update for current episode
-                self._position += execution.shares
-
-                # Derive reward
-                return self._calculate_reward(execution)
-
-            if self.tape.current_time > self._end_time:
-                # If no execution and end time is passed, return
-                return None
-
-        return None
+        """
+        If tape runs out before order is executed, None is returned
+        * Executions merged by the book are recorded fill by fill at their own prices
+        """
+        if self.engine.wait_for_execution() is None:
+            return None
+
+        reward = pnl = 0
+        for fill in self.book.fills:
+            fill_reward, fill_pnl = self._record_execution(fill)
+            reward += fill_reward
+            pnl += fill_pnl
+        return reward, pnl
+
+    def _record_execution(self, execution: Execution) -> Tuple[float, float]:
+        """ Update position and stats for execution and return reward and pnl """
+        # Update for current episode
+        self._position += execution.shares
+
+        # Derive reward
+        realized = self._open_positions.realized
+        reward, pnl = self._calculate_reward(execution)
+
+        # Book keeping. Blotter keeps PnL in tape units
+        self.blotter.record(self.tape.current_time, execution.price, execution.shares, self.book.mid_price,
+                            self._last_action, self._position, self._open_positions.realized - realized)
+        return reward, pnl
 
     @abc.abstractmethod
     def _calculate_reward(self, execution: Execution) -> Tuple[float, float]:
@@ -0,0 +1,125 @@
+"""
+Evaluate many policies on the same day from a single warm-up
+* Parent resets the exchange once, which replays the tape up to start time. Each episode then runs in a child
+    forked from the parent and shares the warmed book, tape and fill oracle copy-on-write
+* Children only copy the pages they modify, so an episode costs about as much memory as the book changes it makes
+* At most max_workers children run at a time. Slot of a finished child is recycled by forking a new child from the
+    untouched parent state
+* Requires os.fork. Not available on Windows
+"""
+import gc
+from multiprocessing.connection import Connection, Pipe, wait
+import os
+import signal
+import sys
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+import numpy as np
+
+from rlmarket.gym_env.base_exchange import BaseExchange
+
+Policy = Callable[[np.ndarray], int]
+
+
+class EpisodeResult(NamedTuple):
+    """ Outcome of a policy from start time to the end of the episode """
+    reward: float
+    pnl: float
+    steps: int
+    position: int
+
+
+def _run_episode(env: BaseExchange, state: np.ndarray, policy: Policy) -> EpisodeResult:
+    """ Step env with policy from state until done """
+    total_reward = total_pnl = 0.0
+    steps = 0
+    done = False
+    while not done:
+        state, reward, done, info = env.step(int(policy(state)))
+        total_reward += reward
+        total_pnl += info['pnl']
+        steps += 1
+    return EpisodeResult(total_reward, total_pnl, steps, env.position)
+
+
+class ForkRunner:
+    """ Run episodes of policies in children forked from a warmed-up exchange """
+
+    def __init__(self, env: BaseExchange, max_workers: Optional[int] = None) -> None:
+        if not hasattr(os, 'fork'):
+            raise RuntimeError('ForkRunner requires os.fork')
+
+        self.env = env
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._state: Optional[np.ndarray] = None  # First state after warm-up
+
+    def warm_up(self) -> np.ndarray:
+        """ Reset exchange to start time of its next file. Later episodes start from here """
+        self._state = self.env.reset()
+        return self._state
+
+    def run(self, policies: Sequence[Policy]) -> List[EpisodeResult]:
+        """ Run one episode per policy and return results in the order of policies """
+        if self._state is None:
+            self.warm_up()
+
+        results: List[Optional[EpisodeResult]] = [None] * len(policies)
+        running: Dict[Connection, Tuple[int, int]] = {}  # Result pipe to policy index and child pid
+
+        # Objects of the warm-up will not be touched by garbage collection in children, keeping their pages shared
+        gc.freeze()
+        try:
+            for idx, policy in enumerate(policies):
+                if len(running) == self.max_workers:
+                    self._reap(running, results)
+                remote, pid = self._spawn(policy)
+                running[remote] = idx, pid
+            while running:
+                self._reap(running, results)
+        finally:
+            for remote, (_, pid) in running.items():  # Children left by an error. Do not wait for their episodes
+                remote.close()
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                os.waitpid(pid, 0)
+            gc.unfreeze()
+        return results
+
+    # ========== Private Methods ==========
+    def _spawn(self, policy: Policy) -> Tuple[Connection, int]:
+        """ Fork a child to run policy. Return the pipe it writes its result to and its pid """
+        remote, work_remote = Pipe(duplex=False)
+        sys.stdout.flush()  # Otherwise buffered output is printed again by the child
+        pid = os.fork()
+        if pid == 0:
+            remote.close()
+            code = 0
+            try:
+                work_remote.send(_run_episode(self.env, self._state, policy))
+            except BaseException as error:  # Pass error to the parent instead of dying silently
+                code = 1
+                try:
+                    work_remote.send(error)
+                except Exception:
+                    work_remote.send(RuntimeError(repr(error)))
+            finally:
+                sys.stdout.flush()
+                os._exit(code)  # Skip clean-up inherited from the parent
+
+        work_remote.close()
+        return remote, pid
+
+    def _reap(self, running: Dict[Connection, Tuple[int, int]], results: List[Optional[EpisodeResult]]) -> None:
+        """ Collect results of finished children. Wait for at least one """
+        for remote in wait(list(running)):
+            idx, pid = running.pop(remote)
+            try:
+                message = remote.recv()
+            except EOFError:
+                message = RuntimeError('Child exited without result')
+            remote.close()
+            os.waitpid(pid, 0)
+            if isinstance(message, BaseException):
+                raise RuntimeError(f'Episode of policy {idx} failed') from message
+            results[idx] = message
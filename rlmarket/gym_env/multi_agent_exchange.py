@@ -0,0 +1,319 @@
+"""
+Multi-agent exchange that drives several agents off one market replay
+* User orders never change the real OrderBook. Agents therefore quote against the same book without seeing each other
+* Each agent is a BaseExchange with its own indicators, reward parameters, user orders, position and open positions.
+    Its book is replaced by the shared one and its tape by an AgentTape holding its own user orders
+* Executions of resting user orders are read from FillOracle instead of resting them in the book. The real book is
+    replayed once for all agents and follows the same rules as OrderBook. See fill_oracle.py
+* Depth seen by agents only has real levels. A single exchange also lists levels held by its own user orders behind
+    the quote. States can only differ after liquidation and at the end of the episode, when user orders rest
+* QueuePosition reads user orders from the book, so agents cannot use it
+"""
+from bisect import bisect_right
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+import numpy as np
+from pandas import Timedelta
+
+from rlmarket.environment.event_indicators import attach_event_indicators
+from rlmarket.environment.exchange_elements import Tape, QueuePosition
+from rlmarket.environment.fill_oracle import FillOracle
+from rlmarket.environment.replay_engine import ReplayEngine
+from rlmarket.environment.tape_metadata import clears_at_end, record_clearing
+from rlmarket.gym_env.base_exchange import BaseExchange
+from rlmarket.market import OrderBook
+from rlmarket.market import UserEvent, UserLimitOrder, UserMarketOrder, Execution
+
+StepResult = Tuple[np.ndarray, float, bool, dict]
+
+
+class AgentTape:
+    """ User order queue of one agent. Time is read from the shared Tape """
+
+    def __init__(self, tape: Tape, latency: int) -> None:
+        self._tape = tape
+        self._delay = latency
+        self._user_queue: Deque[UserEvent] = deque()
+        self._user_order_id: int = -1
+
+    def add_user_order(self, order: UserEvent) -> int:
+        """ Put user order on tape with correct timestamp and order ID """
+        order.timestamp = self._tape.current_time + self._delay
+        order.id = self._user_order_id
+        self._user_order_id -= 1
+        self._user_queue.append(order)
+        return order.id
+
+    @property
+    def user_orders(self) -> Deque[UserEvent]:
+        return self._user_queue
+
+    @property
+    def current_time(self) -> int:
+        return self._tape.current_time
+
+    @property
+    def done(self) -> bool:
+        return self._tape.done
+
+
+class _AgentSlot:
+    """ Replay state of one agent """
+
+    def __init__(self, agent: BaseExchange) -> None:
+        self.agent = agent
+        self.resting: Dict[str, Tuple[UserLimitOrder, int]] = {}  # Side to user order and position of its fill
+        self.pending_reward: Optional[Tuple[float, float]] = None  # Reward and pnl of a fill waiting for liquidation
+        self.waiting = False  # Whether an action has been taken and the agent waits for the market
+        self.stop = 0  # Agent is done if still waiting when replay reaches this real order
+        self.done = False
+
+
+class MultiAgentExchange:
+    """
+    Run several BaseExchange agents on one replay
+    * Agents must share files, start time and end time. Other parameters such as latency, order size, reward bounds
+        and indicators can differ, which is what hyperparameter sweeps and seed ensembles need
+    * step takes the actions of the agents that are waiting for a decision, keyed by agent index. Market is replayed
+        until at least one agent finishes its step. Results are returned as dicts keyed by agent index
+    * With one agent, results are the same as stepping the agent alone
+    """
+
+    def __init__(self, agents: List[BaseExchange]) -> None:
+        if not agents:
+            raise ValueError('At least one agent is needed')
+
+        first = agents[0]
+        for agent in agents[1:]:
+            if (agent._paths, agent._start_time, agent._end_time) != (first._paths, first._start_time, first._end_time):
+                raise ValueError('Agents should replay the same files over the same time')
+        for agent in agents:
+            if any(isinstance(ind, QueuePosition) for ind in agent._indicators):
+                raise ValueError('QueuePosition is not supported because user orders of agents never enter the book')
+
+        self.agents = agents
+        self._paths = first._paths
+        self._start_time = first._start_time
+        self._end_time = first._end_time
+        self._path_pointer = -1
+
+        self._oracles: Dict[str, FillOracle] = {}  # Built once per file
+        self._oracle: Optional[FillOracle] = None
+        self._end_pointer = 0  # Index of the first real order after end time
+
+        # Set up market shared by all agents
+        self.book = OrderBook()
+        self._slots: List[_AgentSlot] = []
+
+    def reset(self) -> Dict[int, np.ndarray]:
+        """ Reset exchange and all agents. Return initial states """
+        print(f'Trading time is from {Timedelta(self._start_time, "ns")} to {Timedelta(self._end_time, "ns")}')
+        self._path_pointer = (self._path_pointer + 1) % len(self._paths)
+        path = self._paths[self._path_pointer]
+        self.tape = Tape(path, latency=0, end_time=self._end_time)
+        if path not in self._oracles:
+            self._oracles[path] = FillOracle(self.tape.real_orders)
+        self._oracle = self._oracles[path]
+
+        self._end_pointer = bisect_right(self._oracle.timestamps, self._end_time)
+
+        self.book.reset()
+        self._slots = []
+        for agent in self.agents:
+            agent.book = self.book
+            agent.tape = AgentTape(self.tape, agent._latency)
+            agent._reset_account()
+            attach_event_indicators(agent._indicators, self.book)
+            self._slots.append(_AgentSlot(agent))
+
+        # Load market
+        self.engine = ReplayEngine(self.tape, self.book, self._end_time)
+        self.engine.warm_up(self._start_time)
+
+        return {idx: agent._get_state() for idx, agent in enumerate(self.agents)}
+
+    def step(self, actions: Dict[int, int]) -> Tuple[Dict[int, np.ndarray], Dict[int, float],
+                                                      Dict[int, bool], Dict[int, dict]]:
+        """
+        * Every agent that is not done and not waiting for the market must act
+        * Only agents that finish their steps are in the returned dicts
+        """
+        for idx, action in actions.items():
+            slot = self._slots[idx]
+            if slot.waiting or slot.done:
+                raise RuntimeError(f'Agent {idx} is not waiting for an action')
+            slot.agent._perform_action(action)
+            slot.waiting = True
+            slot.stop = self._stop_pointer()
+
+        idle = [idx for idx, slot in enumerate(self._slots) if not slot.waiting and not slot.done]
+        if idle:
+            raise RuntimeError(f'Agents {idle} have not acted')
+
+        results = self._run_market()
+        states = {idx: result[0] for idx, result in results.items()}
+        rewards = {idx: result[1] for idx, result in results.items()}
+        dones = {idx: result[2] for idx, result in results.items()}
+        infos = {idx: result[3] for idx, result in results.items()}
+        return states, rewards, dones, infos
+
+    def clean_up(self, strict: bool = False) -> None:
+        """ Run the rest of the tape and print stats of each agent. Drain is skipped like BaseExchange.clean_up """
+        final_mtm = self.book.mid_price
+        if strict or not clears_at_end(self.tape):
+            self._replay(self._oracle.num_orders)
+            record_clearing(self.tape, self.book)
+
+            # Check if exchange finishes properly
+            if not self.book.empty:
+                raise RuntimeError('Market is not fully cleared')
+
+        for agent in self.agents:
+            agent._print_stats(final_mtm)
+
+    @property
+    def done(self) -> bool:
+        return all(slot.done for slot in self._slots)
+
+    # ========== Private methods ==========
+    def _run_market(self) -> Dict[int, StepResult]:
+        """ Replay until at least one waiting agent finishes its step """
+        results: Dict[int, StepResult] = {}
+        waiting = [idx for idx, slot in enumerate(self._slots) if slot.waiting]
+        while waiting and not results:
+            # Apply real orders up to the earliest event of any agent
+            target = min(min(self._next_event(self._slots[idx]), self._slots[idx].stop) for idx in waiting)
+            self._replay(target)
+
+            for idx in waiting:
+                slot = self._slots[idx]
+                result = self._process_events(slot, target)
+                if result is None and target >= slot.stop:
+                    result = self._finish(slot)
+                if result is not None:
+                    slot.waiting = False
+                    results[idx] = result
+
+            waiting = [idx for idx in waiting if self._slots[idx].waiting]
+        return results
+
+    def _replay(self, target: int) -> None:
+        """ Apply real orders before target. The shared book has no user orders so nothing is executed """
+        self.engine.replay(target)
+
+    def _stop_pointer(self) -> int:
+        """
+        Pointer at which a wait starting now gives up. Same as _wait_for_execution
+        * Wait ends after the first real order past end time that does not execute user orders. At least one real
+            order is replayed in each wait
+        """
+        return min(max(self.tape.pointer, self._end_pointer) + 1, self._oracle.num_orders)
+
+    def _release_pointer(self, order: UserEvent) -> Optional[int]:
+        """ User order is released before the first real order later than it, like Tape.next. None if never """
+        if order.timestamp >= self._end_time:
+            return None
+        pointer = bisect_right(self._oracle.timestamps, order.timestamp)
+        return pointer if pointer < self._oracle.num_orders else None
+
+    def _next_event(self, slot: _AgentSlot) -> int:
+        """
+        Pointer at which the next event of agent happens
+        * Execution at real order k happens at pointer k + 1, right after k is applied
+        """
+        events = [fill + 1 for _, fill in slot.resting.values()]
+        user_orders = slot.agent.tape.user_orders
+        if user_orders:
+            release = self._release_pointer(user_orders[0])
+            if release is not None:
+                events.append(release)
+        return min(events) if events else slot.stop
+
+    def _process_events(self, slot: _AgentSlot, pointer: int) -> Optional[StepResult]:
+        """ Handle executions and user order releases of agent at pointer. Executions come first """
+        for side, (order, fill) in slot.resting.items():
+            if fill + 1 == pointer:
+                # Execution removes user orders from both sides
+                slot.resting.clear()
+                sign = 1 if side == 'B' else -1
+                result = self._settle(slot, Execution(order.id, order.price, sign * order.shares))
+                if result is not None:
+                    return result
+                break
+
+        user_orders = slot.agent.tape.user_orders
+        while user_orders:
+            release = self._release_pointer(user_orders[0])
+            if release is None or release > pointer:
+                break
+
+            order = user_orders.popleft()
+            if isinstance(order, UserLimitOrder):
+                self._add_user_limit_order(slot, order, pointer)
+            elif isinstance(order, UserMarketOrder):
+                result = self._settle(slot, self._match_limit_order_for_user(slot, order))
+                if result is not None:
+                    return result
+            else:
+                raise ValueError(f'Unrecognized order type {type(order)}')
+        return None
+
+    def _add_user_limit_order(self, slot: _AgentSlot, order: UserLimitOrder, pointer: int) -> None:
+        """ Rest user order for agent. Same checks and price adjustment as OrderBook.add_user_limit_order """
+        if order.side == 'B':
+            this_book, opposite_book, opposite_side = self.book.bid_book, self.book.ask_book, 'S'
+        else:
+            this_book, opposite_book, opposite_side = self.book.ask_book, self.book.bid_book, 'B'
+
+        this_price = this_book.key_func(order.price)
+        opposite_order = slot.resting.get(opposite_side)
+
+        if opposite_order and this_price <= this_book.key_func(opposite_order[0].price):
+            raise RuntimeError('User order crosses another user order')
+
+        elif opposite_book.quote and this_price <= this_book.key_func(opposite_book.quote):
+            # Update order price to one cent away from opposite quote
+            order.price = opposite_book.quote + this_book.key_func(100)
+
+        # New order replaces the old one on the same side
+        fill = self._oracle.first_fill(order.side, order.price, pointer)
+        slot.resting[order.side] = order, self._oracle.num_orders if fill is None else fill
+
+    def _match_limit_order_for_user(self, slot: _AgentSlot, order: UserMarketOrder) -> Execution:
+        """ Execute user MarketOrder against the shared book """
+        if ('S' if order.side == 'B' else 'B') in slot.resting:
+            raise RuntimeError('Cannot execute MarketOrder on the side that also has user LimitOrder')
+        return self.book.match_limit_order_for_user(order)
+
+    def _settle(self, slot: _AgentSlot, execution: Execution) -> Optional[StepResult]:
+        """ Book execution for agent. Return step result unless agent needs to wait for liquidation """
+        agent = slot.agent
+        reward_pair = agent._record_execution(execution)
+
+        if slot.pending_reward is not None:
+            # Assumes that both regular execution and liquidation hit the lower bound
+            pending_reward, slot.pending_reward = slot.pending_reward, None
+            return (
+                agent._get_state(),
+                pending_reward[0] + reward_pair[0],
+                False,
+                {'pnl': pending_reward[1] + reward_pair[1]}
+            )
+
+        # Neutralize position if exceeds limit
+        if abs(agent.position) >= agent._position_limit:
+            agent._place_liquidation_order()
+            slot.pending_reward = reward_pair
+            slot.stop = self._stop_pointer()
+            return None
+
+        return agent._get_state(), reward_pair[0], False, {'pnl': reward_pair[1]}
+
+    @staticmethod
+    def _finish(slot: _AgentSlot) -> StepResult:
+        """ Result of agent when tape runs out or end time is passed before its step finishes """
+        slot.done = True
+        if slot.pending_reward is not None:
+            pending_reward, slot.pending_reward = slot.pending_reward, None
+            return slot.agent._get_state(), pending_reward[0], True, {'pnl': pending_reward[1]}
+        return slot.agent._get_state(), 0, True, {'pnl': 0}
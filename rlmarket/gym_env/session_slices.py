@@ -0,0 +1,99 @@
+"""
+Intra-day sharding of a session into disjoint time slices
+* Session from start time to end time is split into windows. Each window is run by its own exchange in its own
+    process, warm-started from a snapshot of the book at the window start
+* Snapshots of all windows are taken in the parent with a single replay of the tape
+* Every window starts flat and ends like an exchange ends at its end time. Position is not carried over to the next
+    window
+"""
+import multiprocessing as mp
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+import numpy as np
+
+from rlmarket.environment.snapshot import Snapshot, take_snapshots
+from rlmarket.gym_env.base_exchange import BaseExchange
+
+Transition = Tuple[np.ndarray, int, float, np.ndarray, bool]  # State, action, reward, next state and done
+EnvFn = Callable[[int, int], BaseExchange]  # Build exchange for a window from its start and end time
+Policy = Callable[[np.ndarray], int]
+
+
+class SliceSpec(NamedTuple):
+    """ Split of the session from start_time to end_time into num_slices windows of equal length """
+    start_time: int
+    end_time: int
+    num_slices: int
+
+    @property
+    def windows(self) -> List[Tuple[int, int]]:
+        if self.num_slices < 1:
+            raise ValueError(f'Number of slices {self.num_slices} should be positive')
+        if self.end_time <= self.start_time:
+            raise ValueError(f'End time {self.end_time} should be after start time {self.start_time}')
+
+        bounds = [self.start_time + (self.end_time - self.start_time) * idx // self.num_slices
+                  for idx in range(self.num_slices + 1)]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+
+class SliceResult(NamedTuple):
+    """ Episode of one window """
+    start_time: int
+    end_time: int
+    transitions: List[Transition]
+    reward: float
+    pnl: float
+
+
+def _run_slice(env_fn: EnvFn, policy: Policy, snapshot: Snapshot, end_time: int) -> SliceResult:
+    """ Run one episode of the window from snapshot time to end_time """
+    env = env_fn(snapshot.time, end_time)
+    env.warm_start(snapshot)
+    state = env.reset().copy()  # Transitions keep states. Exchange reuses its state buffer
+
+    transitions: List[Transition] = []
+    total_reward = total_pnl = 0.0
+    done = False
+    while not done:
+        action = int(policy(state))
+        next_state, reward, done, info = env.step(action)
+        next_state = next_state.copy()
+        transitions.append((state, action, reward, next_state, done))
+        total_reward += reward
+        total_pnl += info['pnl']
+        state = next_state
+
+    env.close()
+    return SliceResult(snapshot.time, end_time, transitions, total_reward, total_pnl)
+
+
+def run_slices(env_fn: EnvFn, policy: Policy, spec: SliceSpec, processes: Optional[int] = None,
+               start_method: Optional[str] = None) -> List[SliceResult]:
+    """
+    Run every window of spec in a process pool and return results in time order
+    * Windows run on the first file of the exchange
+    * env_fn and policy are sent to subprocesses. They need to be picklable
+    """
+    windows = spec.windows
+    probe = env_fn(*windows[0])  # Exchange only loads its tape on reset, so the probe is cheap
+    path = probe.paths[0]
+    probe.close()
+    snapshots = take_snapshots(path, [start for start, _ in windows])
+    tasks = [(env_fn, policy, snapshot, end) for snapshot, (_, end) in zip(snapshots, windows)]
+
+    context = mp.get_context(start_method)
+    with context.Pool(min(processes or len(tasks), len(tasks))) as pool:
+        return pool.starmap(_run_slice, tasks)
+
+
+def merge_results(results: List[SliceResult]) -> Tuple[List[Transition], Dict[str, float]]:
+    """ Concatenate transitions of windows in time order and summarize them """
+    results = sorted(results, key=lambda result: result.start_time)
+    transitions = [transition for result in results for transition in result.transitions]
+    report = {
+        'slices': len(results),
+        'steps': len(transitions),
+        'reward': sum(result.reward for result in results),
+        'pnl': sum(result.pnl for result in results),
+    }
+    return transitions, report
@@ -0,0 +1,211 @@
+"""
+Vectorized exchange with one subprocess per exchange
+* Each worker owns its exchange, and therefore its tape and book
+* Observations, rewards, pnl, dones and terminal observations are written by workers into shared memory. Pipes only
+    carry commands and acknowledgements
+* Finished exchange is reset inside its worker. Use send and recv with a batch size below the number of exchanges to
+    keep collecting from other workers while one is warming up
+"""
+from __future__ import annotations
+from ctypes import Array
+import multiprocessing as mp
+from multiprocessing.connection import Connection, wait
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+
+from rlmarket.gym_env.base_exchange import BaseExchange
+
+# Observations, rewards, pnl, dones and terminal observations
+Buffers = Tuple[Array, Array, Array, Array, Array]
+
+
+def _views(buffers: Buffers, num_envs: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """ Numpy views on shared buffers """
+    observations, rewards, pnls, dones, terminals = buffers
+    return (np.frombuffer(observations, dtype=np.float32).reshape(num_envs, -1),
+            np.frombuffer(rewards, dtype=np.float32),
+            np.frombuffer(pnls, dtype=np.float64),
+            np.frombuffer(dones, dtype=np.bool_),
+            np.frombuffer(terminals, dtype=np.float32).reshape(num_envs, -1))
+
+
+def _worker(remote: Connection, parent_remote: Connection, env_fn: Callable[[], BaseExchange], index: int,
+            buffers: Buffers, num_envs: int) -> None:
+    """ Run commands from the parent on its own exchange """
+    parent_remote.close()
+    observations, rewards, pnls, dones, terminals = _views(buffers, num_envs)
+    env = env_fn()
+    env.bind_state(observations[index])  # States are written straight into shared memory
+    while True:
+        command, data = remote.recv()
+        try:
+            if command == 'step':
+                state, reward, done, info = env.step(data)
+                rewards[index] = reward
+                pnls[index] = info['pnl']
+                dones[index] = done
+                if done:
+                    terminals[index] = state
+                    env.reset()
+                remote.send(None)
+            elif command == 'reset':
+                env.reset()
+                dones[index] = False
+                remote.send(None)
+            elif command == 'clean_up':
+                env.clean_up()
+                remote.send(None)
+            elif command == 'get_attr':
+                remote.send(getattr(env, data))
+            elif command == 'close':
+                env.close()
+                remote.close()
+                break
+            else:
+                raise ValueError(f'Unrecognized command {command}')
+        except Exception as error:  # Pass error to the parent instead of dying silently
+            remote.send(error)
+
+
+class SubprocVecExchange:
+    """
+    Batched reset and step over M exchanges running in subprocesses
+    * step and reset follow VecExchange. info only has pnl, plus terminal_observation for finished exchanges
+    * env_fns are sent to subprocesses. They need to be picklable unless the start method is fork
+    """
+
+    def __init__(self, env_fns: Sequence[Callable[[], BaseExchange]], start_method: Optional[str] = None) -> None:
+        if not env_fns:
+            raise ValueError('At least one exchange is needed')
+
+        # Spaces are read from a probe. Exchange only loads its tape on reset, so this is cheap
+        probe = env_fns[0]()
+        try:
+            self.observation_space = probe.observation_space
+            self.action_space = probe.action_space
+        finally:
+            probe.close()
+        self.num_envs = len(env_fns)
+        dimension = int(np.prod(self.observation_space.shape))
+
+        context = mp.get_context(start_method)
+        self._buffers: Buffers = (
+            context.RawArray('f', self.num_envs * dimension),
+            context.RawArray('f', self.num_envs),
+            context.RawArray('d', self.num_envs),
+            context.RawArray('b', self.num_envs),
+            context.RawArray('f', self.num_envs * dimension),
+        )
+        self._observations, self._rewards, self._pnls, self._dones, self._terminals = _views(self._buffers,
+                                                                                              self.num_envs)
+
+        self._remotes: List[Connection] = []
+        self._processes = []
+        for index, env_fn in enumerate(env_fns):
+            remote, work_remote = context.Pipe()
+            process = context.Process(target=_worker, daemon=True,
+                                      args=(work_remote, remote, env_fn, index, self._buffers, self.num_envs))
+            process.start()
+            work_remote.close()
+            self._remotes.append(remote)
+            self._processes.append(process)
+
+        self._pending: Dict[Connection, int] = {}  # Remotes waiting for acknowledgement to env index
+        self._closed = False
+
+    # ========== Lockstep interface ==========
+    def reset(self) -> np.ndarray:
+        """ Reset all exchanges in parallel and return stacked first states """
+        self._wait_all()
+        for remote in self._remotes:
+            remote.send(('reset', None))
+        self._receive(self._remotes)
+        return self._observations.copy()
+
+    def step(self, actions: Sequence[int]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[dict]]:
+        """ Step every exchange with its action """
+        self.step_async(actions)
+        return self.step_wait()
+
+    def step_async(self, actions: Sequence[int]) -> None:
+        if len(actions) != self.num_envs:
+            raise ValueError(f'Expect {self.num_envs} actions but got {len(actions)}')
+        self.send(actions)
+
+    def step_wait(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[dict]]:
+        observations, rewards, dones, infos, _ = self.recv(batch_size=len(self._pending))
+        return observations, rewards, dones, infos
+
+    # ========== Asynchronous interface ==========
+    def send(self, actions: Sequence[int], env_ids: Optional[Sequence[int]] = None) -> None:
+        """ Send actions to exchanges in env_ids, or all exchanges if None. Exchanges should not be busy """
+        env_ids = range(self.num_envs) if env_ids is None else env_ids
+        for index, action in zip(env_ids, actions):
+            remote = self._remotes[index]
+            if remote in self._pending:
+                raise RuntimeError(f'Exchange {index} is still busy')
+            remote.send(('step', int(action)))
+            self._pending[remote] = index
+
+    def recv(self, batch_size: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[dict],
+                                                               np.ndarray]:
+        """ Wait until at least batch_size busy exchanges finish their steps. Return their results and indices """
+        batch_size = len(self._pending) if batch_size is None else batch_size
+        if batch_size > len(self._pending):
+            raise ValueError(f'Only {len(self._pending)} exchanges are busy')
+
+        ready: List[Connection] = []
+        while len(ready) < batch_size:
+            ready.extend(wait([remote for remote in self._pending if remote not in ready]))
+        env_ids = np.array(sorted(self._pending[remote] for remote in ready), dtype=np.int64)
+        self._receive(ready)
+
+        infos = []
+        for index in env_ids:
+            info = {'pnl': float(self._pnls[index])}
+            if self._dones[index]:
+                info['terminal_observation'] = self._terminals[index].copy()
+            infos.append(info)
+        return self._observations[env_ids], self._rewards[env_ids], self._dones[env_ids], infos, env_ids
+
+    # ========== Others ==========
+    def get_attr(self, name: str) -> list:
+        """ Read attribute of every exchange """
+        self._wait_all()
+        for remote in self._remotes:
+            remote.send(('get_attr', name))
+        return self._receive(self._remotes)
+
+    def clean_up(self) -> None:
+        """ Clean up every exchange. See BaseExchange.clean_up """
+        self._wait_all()
+        for remote in self._remotes:
+            remote.send(('clean_up', None))
+        self._receive(self._remotes)
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._wait_all()
+        for remote in self._remotes:
+            remote.send(('close', None))
+        for process in self._processes:
+            process.join()
+        self._closed = True
+
+    # ========== Private Methods ==========
+    def _wait_all(self) -> None:
+        """ Drain acknowledgements of steps in flight """
+        if self._pending:
+            self._receive(list(self._pending))
+
+    def _receive(self, remotes: List[Connection]) -> list:
+        """ Receive one message from each remote and raise errors from workers """
+        messages = []
+        for remote in remotes:
+            message = remote.recv()
+            self._pending.pop(remote, None)
+            if isinstance(message, Exception):
+                raise RuntimeError(f'Exchange {self._remotes.index(remote)} failed') from message
+            messages.append(message)
+        return messages
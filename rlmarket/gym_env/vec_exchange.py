@@ -0,0 +1,86 @@
+"""
+Vectorized exchange that steps several exchanges in lockstep in the same process
+"""
+from typing import Callable, List, Optional, Sequence, Tuple
+import numpy as np
+
+from rlmarket.gym_env.base_exchange import BaseExchange
+
+
+class VecExchange:
+    """
+    Batched reset and step over M exchanges, each usually on a different day, date slice or seed
+    * Observations are stacked into a float32 array of shape (M, state dimension). Rewards are float32 and dones are
+        bool arrays of shape (M,)
+    * Each exchange writes its states straight into its row of the stacked observations
+    * Exchange that finishes is reset right away. Its row of the returned observations is then the first state of
+        the new episode and the final state is kept in info['terminal_observation']
+    * Exchanges must have the same observation and action space
+    """
+
+    def __init__(self, env_fns: Sequence[Callable[[], BaseExchange]], clean_up: bool = False) -> None:
+        if not env_fns:
+            raise ValueError('At least one exchange is needed')
+
+        self.envs: List[BaseExchange] = [env_fn() for env_fn in env_fns]
+        self.num_envs = len(self.envs)
+        self.observation_space = self.envs[0].observation_space
+        self.action_space = self.envs[0].action_space
+        for env in self.envs[1:]:
+            if env.observation_space != self.observation_space or env.action_space != self.action_space:
+                raise ValueError('Exchanges should have the same observation and action space')
+
+        self._clean_up = clean_up  # Run clean_up on finished exchange before reset. It replays the rest of the tape
+        self._observations = np.zeros((self.num_envs,) + self.observation_space.shape, dtype=np.float32)
+        for env, row in zip(self.envs, self._observations):
+            env.bind_state(row)
+        self._rewards = np.zeros(self.num_envs, dtype=np.float32)
+        self._dones = np.zeros(self.num_envs, dtype=bool)
+        self._actions: Optional[np.ndarray] = None
+
+    def reset(self) -> np.ndarray:
+        """ Reset all exchanges and return stacked first states """
+        for env in self.envs:
+            env.reset()  # Written into its row
+        return self._observations.copy()
+
+    def step(self, actions: Sequence[int]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[dict]]:
+        """ Step every exchange with its action """
+        self.step_async(actions)
+        return self.step_wait()
+
+    def step_async(self, actions: Sequence[int]) -> None:
+        """ Record actions. Exchanges are stepped in step_wait """
+        if len(actions) != self.num_envs:
+            raise ValueError(f'Expect {self.num_envs} actions but got {len(actions)}')
+        self._actions = np.asarray(actions)
+
+    def step_wait(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[dict]]:
+        """ Step exchanges with recorded actions and reset those that finish """
+        if self._actions is None:
+            raise RuntimeError('step_async should be called before step_wait')
+
+        infos = []
+        for idx, (env, action) in enumerate(zip(self.envs, self._actions)):
+            state, reward, done, info = env.step(int(action))
+            if done:
+                info = dict(info, terminal_observation=np.array(state, dtype=np.float32))  # Reset reuses the buffer
+                if self._clean_up:
+                    env.clean_up()
+                env.reset()
+
+            self._rewards[idx] = reward
+            self._dones[idx] = done
+            infos.append(info)
+
+        self._actions = None
+        return self._observations.copy(), self._rewards.copy(), self._dones.copy(), infos
+
+    def clean_up(self) -> None:
+        """ Clean up every exchange. See BaseExchange.clean_up """
+        for env in self.envs:
+            env.clean_up()
+
+    def close(self) -> None:
+        for env in self.envs:
+            env.close()
@@ -2,5 +2,5 @@
 Components to mimic exchange order book
 """
 from rlmarket.market.order_book import OrderBook
-from rlmarket.market.order import LimitOrder, MarketOrder, CancelOrder, DeleteOrder, UpdateOrder, Event
+from rlmarket.market.order import LimitOrder, MarketOrder, CancelOrder, DeleteOrder, UpdateOrder, Event, LevelDelta
 from rlmarket.market.user_order import UserLimitOrder, UserMarketOrder, UserEvent, Execution
@@ -4,38 +4,86 @@ Book is an price-ordered collection of price levels, representing one side of th
 from __future__ import annotations
 from typing import Callable, Dict, Optional, List, Tuple
 from sortedcontainers import SortedList
+import numpy as np
+import sys
 
-from rlmarket.market.price_level import PriceLevel
+from rlmarket.market.price_level import PriceLevel, LeanPriceLevel
 from rlmarket.market.order import LimitOrder, MarketOrder, CancelOrder, DeleteOrder
 from rlmarket.market.user_order import UserLimitOrder, UserMarketOrder, Execution
 
+# Rough memory footprint for size statistics. A dict or list slot costs about 6 machine words including spare capacity
+_ENTRY_BYTES = 48
+_ORDER_BYTES = sys.getsizeof(LimitOrder(0, 0, 'B', 0, 0)) + sys.getsizeof(LimitOrder(0, 0, 'B', 0, 0).__dict__)
+_LEVEL_BYTES = sys.getsizeof(PriceLevel(0)) + sys.getsizeof(PriceLevel(0).__dict__) + 2 * sys.getsizeof({})
+
+
+# Key functions are defined at module level instead of lambdas so that books can be pickled
+def ascending_key(price: int) -> int:
+    return price
+
+
+def descending_key(price: int) -> int:
+    return -price
+
 
 class Book:
     """
     Represent bid / ask book.
-    * Book only allows one user order at a time
+    * Book allows up to max_user_orders user orders, at most one per price level. When full, a new user order
+        replaces the oldest one
     * User order will not affect book statistics like quote and volume
+    * Top levels are cached and only rebuilt when a level within the cached window is modified
+    * Removed price levels are kept in a pool of up to pool_size levels and recycled when new levels are needed
     """
 
-    def __init__(self, side: str, key_func: Optional[Callable[[int], int]]) -> None:
+    _order_entries = 2  # LimitOrder is referenced by its PriceLevel queue and order_pool
+
+    def __init__(self, side: str, key_func: Optional[Callable[[int], int]], depth_levels: int = 10,
+                 pool_size: int = 64, max_user_orders: int = 1) -> None:
         self.side = side
-        self.key_func = key_func if key_func else lambda x: x
+        self.key_func = key_func if key_func else ascending_key
 
         # We need this because price levels follow price priority not time priority (which dict alone can provides)
         self.prices = SortedList(key=key_func)  # Sorted prices
         self.price_levels: Dict[int, PriceLevel] = {}  # Price to level map
         self.order_pool: Dict[int, PriceLevel] = {}  # Order ID to level map
-        # Store order price and PriceLevel. We do not need ID since there is only one order
-        self.user_order_info: Optional[Tuple[int, PriceLevel]] = None
+        # User order registry. Map user order ID to price in the order of arrival and keep prices in price priority
+        self.max_user_orders = max_user_orders
+        self.user_orders: Dict[int, int] = {}
+        self.user_prices = SortedList(key=key_func)
+        # Individual user order executions behind the last returned Execution
+        self.fills: List[Execution] = []
 
         self._front_idx: Optional[int] = None
 
+        # Modification counter and depth cache. The cache holds (price, shares) of the top levels
+        self.version = 0
+        self._depth = np.zeros((depth_levels, 2), dtype=np.int64)
+        self._depth_list: List[Tuple[int, int]] = []
+        self._depth_size = 0
+        self._depth_dirty = True
+        self._depth_bound: Optional[int] = None  # Signed price of the last cached level. None if cache is not full
+        self._cumulative = np.zeros((depth_levels, 2), dtype=np.int64)  # Cumulative shares and value of depth cache
+        self._cumulative_dirty = True
+
+        # Free list of removed price levels
+        self.pool_size = pool_size
+        self._level_pool: List[PriceLevel] = []
+        self.levels_allocated = 0
+        self.levels_reused = 0
+
+        # High-water marks. Kept across reset
+        self.peak_orders = 0
+        self.peak_levels = 0
+
     def reset(self):
         self.prices.clear()
         self.price_levels.clear()
         self.order_pool.clear()
-        self.user_order_info = None
+        self.user_orders.clear()
+        self.user_prices.clear()
         self._front_idx = None
+        self._touch(None)
 
     # ========== Order Operations ==========
     def add_limit_order(self, order: LimitOrder) -> None:
@@ -44,91 +92,101 @@ class Book:
             raise RuntimeError(f'LimitOrder {order.id} already exists')
 
         self.order_pool[order.id] = self._get_price_level(order.price, force_index=True).add_limit_order(order)
+        self._touch(order.price)
+        if len(self.order_pool) > self.peak_orders:
+            self.peak_orders = len(self.order_pool)
 
     def match_limit_order(self, market_order: MarketOrder) -> Tuple[bool, Optional[Execution]]:
         """ Match environment order against limit order. Remove empty price level where needed """
         # Sometime environment order may not follow time priority. We should follow the referenced order ID in this case
-        user_order = None
-        target_price_level = self.order_pool[market_order.id]
+        user_orders = []
+        target_price_level = self._level_of(market_order.id)
 
         # User orders may create price levels that do not exist in the real market. Need to match against those first
-        if target_price_level.price != self.prices[0]:
+        while target_price_level.price != self.prices[0]:
             top_level = self.price_levels[self.prices[0]]
             if top_level.shares > 0:
                 # Shares > 0 means that there are real LimitOrder exists in the top level
                 raise RuntimeError('Market order being matched against levels not in the front')
-            user_order = top_level.pop_user_order()
-            self._remove_price_level_if_empty(top_level)
+            user_orders.append(self._pop_user_order(top_level.user_order_id))
 
         # Now get the user orders that are in front of the matched real LimitOrder
         price_level, exhausted, executed_order = target_price_level.match_limit_order(market_order)
+        self._touch(price_level.price)
         self._remove_price_level_if_empty(price_level)
 
-        # It can be that both order are None
         if executed_order is not None:
-            user_order = executed_order
+            self._unregister_user_order(executed_order.id)
+            user_orders.append(executed_order)
 
         # Whether the matching limit order is already exhausted
         if exhausted:
             del self.order_pool[market_order.id]
 
         # Update user order pool and return executions
-        return exhausted, self._handle_matched_user_limit_order(user_order) if user_order else None
+        return exhausted, self._handle_matched_user_limit_orders(user_orders) if user_orders else None
 
     def cancel_order(self, order: CancelOrder) -> None:
         """ Cancel (partial) shares of a LimitOrder """
-        self.order_pool[order.id].cancel_order(order)
+        price_level = self._level_of(order.id)
+        price_level.cancel_order(order)
+        self._touch(price_level.price)
 
     def delete_order(self, order: DeleteOrder):
         """ Delete the whole LimitOrder """
-        price_level = self.order_pool[order.id].delete_order(order)
+        price_level = self._level_of(order.id).delete_order(order)
         del self.order_pool[order.id]
+        self._touch(price_level.price)
         self._remove_price_level_if_empty(price_level)
 
     # ========== User Order Operation ==========
     def add_user_limit_order(self, order: UserLimitOrder) -> None:
         """
         Add user limit order to the correct price level
-        * Remove the old user order if exists
+        * Remove the user order at the same price, or the oldest one if there are already max_user_orders
         * We do not want to deal with time priority because
             * This simplifies the flow
             * Last action's effect will spill over to the current one
         """
-        if self.user_order_info:
-            original_id, price_level = self.user_order_info
-            price_level.pop_user_order()  # Only one user order is allowed
-            self._remove_price_level_if_empty(price_level)
+        if order.id in self.user_orders:
+            self._pop_user_order(order.id)
+
+        level = self.price_levels.get(order.price, None)
+        if level is not None and level.user_order_id is not None:
+            self._pop_user_order(level.user_order_id)  # Only one user order is allowed per level
+
+        if len(self.user_orders) >= self.max_user_orders:
+            self._pop_user_order(next(iter(self.user_orders)))
 
-        self.user_order_info = order.price, self._get_price_level(order.price).add_user_limit_order(order)
+        self._get_price_level(order.price).add_user_limit_order(order)
+        self.user_orders[order.id] = order.price
+        self.user_prices.add(order.price)
 
     def match_limit_order_for_user(self, order: UserMarketOrder) -> Execution:
         """ Match LimitOrder for UserMarketOrder """
-        if self.user_order_info:
+        if self.user_orders:
             raise RuntimeError('Cannot execute MarketOrder on the side that also has user LimitOrder')
 
-        total_value = 0
-        shares = 0
-
         # Recall that we are not actually matching the LimitOrders. No need to remove the executed LimitOrder.
-        for price in self.prices:
-            executed = order.shares - self.price_levels[price].match_limit_order_for_user(order)
-            total_value += price * executed
-            shares += executed
-            if order.shares == 0:
-                break
-
-        if order.shares > 0:
+        walk = self._walk_book(order.shares)
+        if walk is None:
             raise RuntimeError('User market order cannot be fully executed')
 
-        return Execution(order.id, int(total_value / shares), shares if order.side == 'B' else -shares)
+        shares = order.shares
+        return Execution(order.id, int(walk[0] / shares), shares if order.side == 'B' else -shares)
 
-    def delete_user_order(self):
-        """ Remove user order """
-        if self.user_order_info:
-            _, price_level = self.user_order_info
-            price_level.pop_user_order()
-            self._remove_price_level_if_empty(price_level)
-            self.user_order_info = None
+    def preview_market_order(self, shares: int) -> Optional[int]:
+        """ Return the volume weighted price of a MarketOrder against this side. None if liquidity is insufficient """
+        walk = self._walk_book(shares)
+        return int(walk[0] / shares) if walk else None
+
+    def delete_user_order(self, order_id: Optional[int] = None):
+        """ Remove user order. Remove all user orders if order_id is None """
+        if order_id is None:
+            for user_order_id in list(self.user_orders):
+                self._pop_user_order(user_order_id)
+        elif order_id in self.user_orders:
+            self._pop_user_order(order_id)
 
     def resolve_book_crossing_on_user_order(self, price: int) -> Optional[Execution]:
         """
@@ -141,13 +199,10 @@ class Book:
         if quote and self.key_func(quote) <= signed_price:
             raise RuntimeError('Real order crosses real order')
 
-        if self.user_order_info and self.key_func(self.user_order_info[0]) <= signed_price:
-            price_level = self.price_levels[self.user_order_info[0]]
-            execution = self._handle_matched_user_limit_order(price_level.pop_user_order())
-            # Must be empty
-            self._remove_price_level_if_empty(price_level)
-            return execution
-        return None
+        user_orders = []
+        while self.user_prices and self.key_func(self.user_prices[0]) <= signed_price:
+            user_orders.append(self._pop_user_order(self.price_levels[self.user_prices[0]].user_order_id))
+        return self._handle_matched_user_limit_orders(user_orders) if user_orders else None
 
     # ========== Private Methods ==========
     def _get_price_level(self, price: int, force_index=False) -> PriceLevel:
@@ -157,25 +212,45 @@ class Book:
         # shares == 0 means that the PriceLevel was previously occupied by user order only
         if level is None:
             self.prices.add(price)
-            level = PriceLevel(price)
+            if self._level_pool:
+                level = self._level_pool.pop().recycle(price)
+                self.levels_reused += 1
+            else:
+                level = self._new_price_level(price)
+                self.levels_allocated += 1
             self.price_levels[price] = level
+            if len(self.price_levels) > self.peak_levels:
+                self.peak_levels = len(self.price_levels)
             # force_index is used when we are adding a new price level for real order. Order is not added at this point
             #   and shares will be 0. Therefore, we need to force it
             # On the other hand, we still need to run update_front_index for user order because it may change the
             #   ordering
             self._update_front_index(force_index, price)
+            self._touch(price)
 
         elif level.shares == 0:
             self._update_front_index(force_index, price)
+            self._touch(price)
 
         return level
 
+    def _new_price_level(self, price: int) -> PriceLevel:
+        """ Create an empty PriceLevel """
+        return PriceLevel(price)
+
+    def _level_of(self, order_id: int) -> PriceLevel:
+        """ Return the PriceLevel where the LimitOrder rests """
+        return self.order_pool[order_id]
+
     def _remove_price_level_if_empty(self, price_level: PriceLevel):
-        """ Remove PriceLevel if empty """
+        """ Remove PriceLevel if empty. Removed level goes back to the pool and must not be used afterwards """
         if price_level.empty:
             del self.price_levels[price_level.price]
             # "remove" will raise ValueError if not exists
             self.prices.remove(price_level.price)
+            self._touch(price_level.price)
+            if len(self._level_pool) < self.pool_size:
+                self._level_pool.append(price_level)
 
         if price_level.shares == 0:
             # Separate from the logic above because we run be in the situation where real orders are exhausted
@@ -183,20 +258,94 @@ class Book:
             self._update_front_index()
 
     def _update_front_index(self, force_index=False, target_price=None) -> None:
-        """ Find out the first price level that has real order """
-        if not self.prices:
-            self._front_idx = None
-        else:
-            price = self.prices[0]
+        """
+        Find out the first price level that has real order. Only levels held by user orders can be in front of it
+        """
+        self._front_idx = None
+        for idx, price in enumerate(self.prices):
             if self.price_levels[price].shares > 0 or (force_index and price == target_price):
-                self._front_idx = 0
-            else:
-                self._front_idx = 1 if len(self.prices) > 1 else None
+                self._front_idx = idx
+                break
+
+    def _touch(self, price: Optional[int]) -> None:
+        """ Record modification at price. None invalidates the whole depth cache """
+        self.version += 1
+        if not self._depth_dirty and (price is None or self._depth_bound is None
+                                      or self.key_func(price) <= self._depth_bound):
+            self._depth_dirty = True
+
+    def _refresh_depth(self, num_levels: int) -> None:
+        """ Grow the depth cache where needed and rebuild it if stale """
+        if num_levels > len(self._depth):
+            self._depth = np.zeros((num_levels, 2), dtype=np.int64)
+            self._cumulative = np.zeros((num_levels, 2), dtype=np.int64)
+            self._depth_dirty = True
+
+        if self._depth_dirty:
+            self._rebuild_depth()
+
+    def _rebuild_depth(self) -> None:
+        """ Refill depth cache from the front of the book """
+        capacity = len(self._depth)
+        if self._front_idx is not None:
+            prices = self.prices[self._front_idx: self._front_idx + capacity]
+            self._depth_list = [(price, self.price_levels[price].shares) for price in prices]
+        else:
+            self._depth_list = []
+
+        self._depth_size = len(self._depth_list)
+        if self._depth_size > 0:
+            self._depth[:self._depth_size] = self._depth_list
+        self._depth_bound = self.key_func(self._depth_list[-1][0]) if self._depth_size == capacity else None
+        self._depth_dirty = False
+        self._cumulative_dirty = True
 
-    def _handle_matched_user_limit_order(self, order: UserLimitOrder) -> Execution:
-        """ Book-keeping actions for UserLimitOrder execution """
-        self.user_order_info = None
-        return Execution(order.id, order.price, order.shares if self.side == 'B' else -order.shares)
+    def _walk_book(self, shares: int) -> Optional[Tuple[int, int]]:
+        """
+        Return total value and number of price levels needed to fill shares against the front of the book
+        * The depth cache is doubled until it either covers the shares or the whole book
+        """
+        num_levels = len(self._depth)
+        while True:
+            prices, cumulative_shares, cumulative_value = self.get_cumulative_depth(num_levels)
+            idx = int(np.searchsorted(cumulative_shares, shares))
+            if idx < len(cumulative_shares):
+                break
+            if self._depth_size < len(self._depth):
+                return None  # Whole book is cached but still not enough
+            num_levels *= 2
+
+        if idx == 0:
+            return int(prices[0]) * shares, 1
+        remaining = shares - int(cumulative_shares[idx - 1])
+        return int(cumulative_value[idx - 1]) + int(prices[idx]) * remaining, idx + 1
+
+    def _pop_user_order(self, order_id: int) -> UserLimitOrder:
+        """ Remove user order from its price level and the registry """
+        price_level = self.price_levels[self.user_orders[order_id]]
+        order = price_level.pop_user_order()
+        self._unregister_user_order(order_id)
+        self._remove_price_level_if_empty(price_level)
+        return order
+
+    def _unregister_user_order(self, order_id: int) -> None:
+        self.user_prices.remove(self.user_orders.pop(order_id))
+
+    def _handle_matched_user_limit_orders(self, orders: List[UserLimitOrder]) -> Execution:
+        """
+        Book-keeping actions for UserLimitOrder executions
+        * Executions of the same event are merged into one at the volume weighted price under the ID of the first one.
+            Individual executions are kept in fills
+        * Merged price is rounded to the nearest tape unit, so its notional can be off by half a unit per share.
+            Use fills where the exact value matters
+        """
+        sign = 1 if self.side == 'B' else -1
+        self.fills = [Execution(order.id, order.price, sign * order.shares) for order in orders]
+        if len(self.fills) == 1:
+            return self.fills[0]
+        shares = sum(order.shares for order in orders)
+        value = sum(order.price * order.shares for order in orders)
+        return Execution(orders[0].id, (2 * value + shares) // (2 * shares), sign * shares)
 
     # ========== Properties ==========
     # These statistics should not include user orders. Otherwise, we may end up being our own market
@@ -216,21 +365,116 @@ class Book:
 
     def get_depth(self, num_levels: int) -> List[Tuple[int, int]]:
         """ Return the top n price levels without user orders """
-        if self._front_idx is not None:
-            return [(price, self.price_levels[price].shares)
-                    for price in self.prices[self._front_idx: self._front_idx + num_levels]]
-        return []
+        self._refresh_depth(num_levels)
+        return self._depth_list[:num_levels]
+
+    def get_depth_array(self, num_levels: int) -> np.ndarray:
+        """
+        Return the top n price levels as (price, shares) rows without user orders.
+        * The array is a view into the cache. It should not be modified and is only valid until the next book update
+        """
+        self._refresh_depth(num_levels)
+        return self._depth[:min(num_levels, self._depth_size)]
+
+    def get_cumulative_depth(self, num_levels: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Return prices, cumulative shares and cumulative value (price * shares) of the top n price levels
+        * Arrays are views into the cache. See get_depth_array
+        """
+        self._refresh_depth(num_levels)
+        size = min(num_levels, self._depth_size)
+        if self._cumulative_dirty:
+            np.cumsum(self._depth[:self._depth_size, 1], out=self._cumulative[:self._depth_size, 0])
+            np.cumsum(self._depth[:self._depth_size, 0] * self._depth[:self._depth_size, 1],
+                      out=self._cumulative[:self._depth_size, 1])
+            self._cumulative_dirty = False
+        return self._depth[:size, 0], self._cumulative[:size, 0], self._cumulative[:size, 1]
 
     @property
     def empty(self) -> bool:
-        if len(self.order_pool) == 0:
-            if self.user_order_info is None:
-                return len(self.prices) == 0
-            return len(self.prices) == 1 and self.price_levels[self.prices[0]].shares == 0
-        return False
+        # Without real orders, every remaining level is held by exactly one user order
+        return len(self.order_pool) == 0 and len(self.prices) == len(self.user_orders)
+
+    @property
+    def user_order_info(self) -> Optional[Tuple[int, PriceLevel]]:
+        """ Price and PriceLevel of the user order in the front """
+        if self.user_prices:
+            price = self.user_prices[0]
+            return price, self.price_levels[price]
+        return None
 
     @property
     def user_order_price(self) -> Optional[int]:
-        if self.user_order_info:
-            return self.user_order_info[0]
+        """ Price of the user order in the front """
+        if self.user_prices:
+            return self.user_prices[0]
+        return None
+
+    def order_price(self, order_id: int) -> int:
+        """ Return the price of a resting LimitOrder """
+        return self._level_of(order_id).price
+
+    def level_shares(self, price: int) -> int:
+        """ Return real shares at price. 0 if the level does not exist """
+        level = self.price_levels.get(price, None)
+        return level.shares if level is not None else 0
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        Return size statistics. Bytes are estimates of what orders and price levels hold, not exact measurements
+        * max_queue_length requires a scan over all price levels
+        """
+        order_bytes = _ORDER_BYTES + self._order_entries * _ENTRY_BYTES
+        level_bytes = _LEVEL_BYTES + 2 * _ENTRY_BYTES  # Price is kept in prices and price_levels
+        return {
+            'orders': len(self.order_pool),
+            'levels': len(self.price_levels),
+            'user_orders': len(self.user_orders),
+            'max_queue_length': max((level.length for level in self.price_levels.values()), default=0),
+            'order_bytes': len(self.order_pool) * order_bytes,
+            'level_bytes': (len(self.price_levels) + len(self._level_pool)) * level_bytes,
+            'peak_orders': self.peak_orders,
+            'peak_levels': self.peak_levels,
+            'peak_bytes': self.peak_orders * order_bytes + self.peak_levels * level_bytes,
+        }
+
+    @property
+    def level_reuse_rate(self) -> float:
+        """ Fraction of new price levels served from the pool """
+        total = self.levels_allocated + self.levels_reused
+        return self.levels_reused / total if total else 0.0
+
+    @property
+    def user_shares_ahead(self) -> Optional[int]:
+        """ Real shares in front of the user order in the front in its price level """
+        if self.user_prices:
+            return self.price_levels[self.user_prices[0]].shares_ahead
         return None
+
+
+class LeanBook(Book):
+    """
+    Book that only keeps aggregated price levels (L2)
+    * order_pool maps order ID to the LimitOrder itself, which carries side, price and shares
+    * Per-order queues are only materialized at the level where user order rests. See LeanPriceLevel
+    """
+
+    order_pool: Dict[int, LimitOrder]
+    _order_entries = 1
+
+    def add_limit_order(self, order: LimitOrder) -> None:
+        """ Add limit order to the correct price level """
+        if order.id in self.order_pool:
+            raise RuntimeError(f'LimitOrder {order.id} already exists')
+
+        self._get_price_level(order.price, force_index=True).add_limit_order(order)
+        self.order_pool[order.id] = order
+        self._touch(order.price)
+        if len(self.order_pool) > self.peak_orders:
+            self.peak_orders = len(self.order_pool)
+
+    def _new_price_level(self, price: int) -> PriceLevel:
+        return LeanPriceLevel(price, self.order_pool)
+
+    def _level_of(self, order_id: int) -> PriceLevel:
+        return self.price_levels[self.order_pool[order_id].price]
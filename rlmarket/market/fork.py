@@ -0,0 +1,185 @@
+"""
+Copy-on-write forks of the order book for what-if evaluation
+* A fork shares price levels and order maps with its parent and only copies what it is about to modify
+* Parent should not be updated while its forks are in use. Otherwise forks will see the changes on shared levels
+"""
+from __future__ import annotations
+from typing import Dict, Iterator, Mapping, MutableMapping, Optional, Set, Tuple, TypeVar, Generic
+from copy import copy
+
+from rlmarket.market.book import Book, LeanBook
+from rlmarket.market.price_level import PriceLevel
+from rlmarket.market.order import LimitOrder, MarketOrder, CancelOrder, DeleteOrder
+from rlmarket.market.user_order import UserLimitOrder, Execution
+
+KT = TypeVar('KT')
+VT = TypeVar('VT')
+
+
+class CopyOnWriteDict(MutableMapping, Generic[KT, VT]):
+    """
+    Dict overlay on a base mapping that is never modified
+    * Writes and deletions are recorded locally
+    * Values read from base are remapped by identity to their copies where a copy has been made
+    """
+
+    def __init__(self, base: Mapping[KT, VT], remap: Optional[Dict[int, VT]] = None) -> None:
+        self.base = base
+        self.local: Dict[KT, VT] = {}
+        self.deleted: Set[KT] = set()
+        self.remap = remap if remap is not None else {}
+        self._size = len(base)
+
+    def __getitem__(self, key: KT) -> VT:
+        if key in self.local:
+            return self.local[key]
+        if key in self.deleted:
+            raise KeyError(key)
+        value = self.base[key]
+        return self.remap.get(id(value), value)
+
+    def __setitem__(self, key: KT, value: VT) -> None:
+        if key not in self:
+            self._size += 1
+        self.local[key] = value
+        self.deleted.discard(key)
+
+    def __delitem__(self, key: KT) -> None:
+        if key not in self:
+            raise KeyError(key)
+        self.local.pop(key, None)
+        if key in self.base:
+            self.deleted.add(key)
+        self._size -= 1
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.local or (key not in self.deleted and key in self.base)
+
+    def __iter__(self) -> Iterator[KT]:
+        yield from self.local
+        for key in self.base:
+            if key not in self.local and key not in self.deleted:
+                yield key
+
+    def __len__(self) -> int:
+        return self._size
+
+    def clear(self) -> None:
+        """ Drop everything including the base """
+        self.base = {}
+        self.local.clear()
+        self.deleted.clear()
+        self._size = 0
+
+
+class CopyOnWriteBook:
+    """
+    Mixin for Book that copies a shared price level before modifying it
+    * Incoming LimitOrders are copied because the same objects will be replayed on the parent later
+    """
+
+    order_pool: CopyOnWriteDict
+    price_levels: Dict[int, PriceLevel]
+    user_orders: Dict[int, int]
+
+    _shared: Set[int]  # Prices of levels that are still shared with the parent
+    _remap: Dict[int, PriceLevel]
+
+    @classmethod
+    def from_parent(cls, parent: Book) -> Book:
+        """ Create fork of parent """
+        book = cls(parent.side, parent.key_func, depth_levels=len(parent._depth), pool_size=parent.pool_size,
+                   max_user_orders=parent.max_user_orders)
+        book.prices = parent.prices.copy()
+        book.price_levels = dict(parent.price_levels)
+        book.user_orders = dict(parent.user_orders)
+        book.user_prices = parent.user_prices.copy()
+        book._front_idx = parent._front_idx
+        book.version = parent.version
+        book._shared = set(parent.price_levels)
+        book._remap = {}
+        book.order_pool = CopyOnWriteDict(parent.order_pool, book._remap)
+        return book
+
+    # ========== Order Operations ==========
+    def add_limit_order(self, order: LimitOrder) -> None:
+        self._own_level(order.price)
+        super().add_limit_order(copy(order))
+
+    def match_limit_order(self, market_order: MarketOrder) -> Tuple[bool, Optional[Execution]]:
+        self._own_user_levels()  # User order only levels in front may be run over
+        self._own_order(market_order.id)
+        return super().match_limit_order(market_order)
+
+    def cancel_order(self, order: CancelOrder) -> None:
+        self._own_order(order.id)
+        super().cancel_order(order)
+
+    def delete_order(self, order: DeleteOrder):
+        self._own_order(order.id)
+        super().delete_order(order)
+
+    # ========== User Order Operation ==========
+    def add_user_limit_order(self, order: UserLimitOrder) -> None:
+        self._own_user_levels()
+        self._own_level(order.price)
+        super().add_user_limit_order(order)
+
+    def delete_user_order(self, order_id: Optional[int] = None):
+        self._own_user_levels()
+        super().delete_user_order(order_id)
+
+    def resolve_book_crossing_on_user_order(self, price: int) -> Optional[Execution]:
+        self._own_user_levels()
+        return super().resolve_book_crossing_on_user_order(price)
+
+    def reset(self):
+        super().reset()
+        self._shared.clear()
+        self._remap.clear()
+
+    # ========== Private Methods ==========
+    def _own_order(self, order_id: int) -> None:
+        """ Make sure the level where the order rests is not shared """
+        self._own_level(self.order_pool[order_id].price)
+
+    def _own_user_levels(self) -> None:
+        for price in self.user_orders.values():
+            self._own_level(price)
+
+    def _own_level(self, price: int) -> None:
+        """ Replace shared level with a copy """
+        if price in self._shared:
+            self._shared.discard(price)
+            level = self.price_levels[price]
+            level_copy = self._copy_level(level)
+            self.price_levels[price] = level_copy
+            self._remap[id(level)] = level_copy
+
+    def _copy_level(self, level: PriceLevel) -> PriceLevel:
+        return level.copy()
+
+
+class ForkedBook(CopyOnWriteBook, Book):
+    """ Copy-on-write fork of Book """
+
+
+class ForkedLeanBook(CopyOnWriteBook, LeanBook):
+    """ Copy-on-write fork of LeanBook. LimitOrders in the order map are copied before being modified """
+
+    def _own_order(self, order_id: int) -> None:
+        super()._own_order(order_id)
+        if order_id not in self.order_pool.local:
+            self.order_pool[order_id] = copy(self.order_pool[order_id])
+
+    def _copy_level(self, level: PriceLevel) -> PriceLevel:
+        level_copy = level.copy()
+        level_copy.orders = self.order_pool
+        return level_copy
+
+
+def fork_book(book: Book) -> Book:
+    """ Return copy-on-write fork of Book or LeanBook """
+    if isinstance(book, LeanBook):
+        return ForkedLeanBook.from_parent(book)
+    return ForkedBook.from_parent(book)
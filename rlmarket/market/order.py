@@ -3,6 +3,7 @@ Real orders
 """
 from dataclasses import dataclass
 from datetime import timedelta
+from typing import NamedTuple
 
 
 def show_time(timestamp):
@@ -63,3 +64,19 @@ class UpdateOrder(Event):
 
     def __str__(self):
         return f'Update({show_time(self.timestamp)} {self.old_id}->{self.id} {self.price} {self.shares})'
+
+
+class LevelDelta(NamedTuple):
+    """
+    Change of a price level published by OrderBook
+    * shares is the new total of real shares at the level. 0 means the level is gone
+    * cause is the ITCH message type: A (add), E (execute), X (cancel), D (delete) and U (replace)
+    """
+    timestamp: int
+    side: str
+    price: int
+    shares: int
+    cause: str
+
+    def __str__(self):
+        return f'Delta({show_time(self.timestamp)} {self.cause} {self.side} {self.price} {self.shares})'
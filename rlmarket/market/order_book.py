@@ -11,29 +11,63 @@ This is the implementation of the full order book. We differentiate between real
 Convention of ITCH data:
 * Order ID of MarketOrder, CancelOrder and DeleteOrder is the ID of the referenced LimitOrder
 """
-from typing import Dict, Tuple, List, Optional
+from __future__ import annotations
+from typing import Callable, Dict, Tuple, List, Optional
+import numpy as np
 
-from rlmarket.market.book import Book
-from rlmarket.market.order import LimitOrder, MarketOrder, CancelOrder, DeleteOrder, UpdateOrder
+from rlmarket.market.book import Book, LeanBook, descending_key
+from rlmarket.market.fork import CopyOnWriteDict, fork_book
+from rlmarket.market.order import LimitOrder, MarketOrder, CancelOrder, DeleteOrder, UpdateOrder, LevelDelta
 from rlmarket.market.user_order import UserLimitOrder, UserMarketOrder, Execution
 
 
 class OrderBook:
-    """ Full order book with both ask and bid sides """
+    """
+    Full order book with both ask and bid sides
+    * In lean mode, books only keep aggregated price levels and materialize order queue where user order rests
+    * Real order operations publish LevelDelta to subscribers. User orders are phantom and do not publish
+    * Each side holds up to max_user_orders user orders. When several are executed by one event, the returned
+        Execution is their volume weighted sum and the individual executions are kept in fills
+    """
 
-    def __init__(self) -> None:
+    def __init__(self, lean: bool = False, max_user_orders: int = 1) -> None:
+        self.lean = lean
+        self.max_user_orders = max_user_orders
+        book_class = LeanBook if lean else Book
         # Bid book is in descending order
-        self.bid_book = Book('B', lambda x: -x)
+        self.bid_book = book_class('B', descending_key, max_user_orders=max_user_orders)
         # Ask book is in ascending order. None is default for ascending ordering
-        self.ask_book = Book('S', None)
+        self.ask_book = book_class('S', None, max_user_orders=max_user_orders)
         # Store mapping from order to book and price level
         self.order_pool: Dict[int, Book] = {}
+        self.subscribers: List[Callable[[LevelDelta], None]] = []
+        self.fills: List[Execution] = []  # Individual user order executions behind the last returned Execution
 
     def reset(self):
         self.order_pool.clear()
         self.bid_book.reset()
         self.ask_book.reset()
 
+    def fork(self) -> OrderBook:
+        """
+        Return a copy-on-write fork for what-if evaluation
+        * Real order structures are shared with this book and only copied where the fork modifies them
+        * This book should not be updated while the fork is in use
+        """
+        fork = OrderBook(lean=self.lean, max_user_orders=self.max_user_orders)
+        fork.bid_book = fork_book(self.bid_book)
+        fork.ask_book = fork_book(self.ask_book)
+        fork.order_pool = CopyOnWriteDict(self.order_pool, {id(self.bid_book): fork.bid_book,
+                                                            id(self.ask_book): fork.ask_book})
+        return fork
+
+    def subscribe(self, callback: Callable[[LevelDelta], None]) -> None:
+        """ Register callback to receive LevelDelta after every real order operation """
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback: Callable[[LevelDelta], None]) -> None:
+        self.subscribers.remove(callback)
+
     # ========== Order Operations ==========
     def add_limit_order(self, order: LimitOrder) -> Optional[Execution]:
         """ Add real limit order to the book """
@@ -48,6 +82,7 @@ class OrderBook:
                 execution = self.ask_book.resolve_book_crossing_on_user_order(order.price)
                 # Clean up the user order from another side
                 if execution:
+                    self.fills = self.ask_book.fills
                     self.bid_book.delete_user_order()
             else:
                 # Under the user order matching logic, we should not need to cross the book
@@ -58,20 +93,26 @@ class OrderBook:
                 self._add_limit_order_to_book(order, self.ask_book)
                 execution = self.bid_book.resolve_book_crossing_on_user_order(order.price)
                 if execution:
+                    self.fills = self.bid_book.fills
                     self.ask_book.delete_user_order()
             else:
                 # Under the user order matching logic, we should not need to cross the book
                 raise RuntimeError(f'Sell limit order of price {order.price} '
                                    f'cross to the bid book with quote of {self.bid_book.quote}')
 
+        if self.subscribers:
+            self._publish(order.timestamp, self.order_pool[order.id], order.price, 'A')
         return execution
 
     def match_limit_order(self, market_order: MarketOrder) -> Optional[Execution]:
         """ Match environment in the correct book """
-        exhausted, execution = self.order_pool[market_order.id].match_limit_order(market_order)
+        book = self.order_pool[market_order.id]
+        price = book.order_price(market_order.id) if self.subscribers else None
+        exhausted, execution = book.match_limit_order(market_order)
 
         # Clean up another side of the book
         if execution:
+            self.fills = book.fills
             if market_order.side == 'B':
                 self.bid_book.delete_user_order()
             else:
@@ -80,22 +121,36 @@ class OrderBook:
         if exhausted:
             del self.order_pool[market_order.id]  # If limit order is exhausted, remove from pool
 
+        if price is not None:
+            self._publish(market_order.timestamp, book, price, 'E')
         return execution
 
     def cancel_order(self, order: CancelOrder) -> None:
         """ CancelOrder should not exhausted the referenced LimitOrder """
-        self.order_pool[order.id].cancel_order(order)
+        book = self.order_pool[order.id]
+        book.cancel_order(order)
+        if self.subscribers:
+            self._publish(order.timestamp, book, book.order_price(order.id), 'X')
 
     def delete_order(self, order: DeleteOrder) -> None:
         """ Remove order from book """
-        self.order_pool[order.id].delete_order(order)
+        book = self.order_pool[order.id]
+        price = book.order_price(order.id) if self.subscribers else None
+        book.delete_order(order)
         del self.order_pool[order.id]
+        if price is not None:
+            self._publish(order.timestamp, book, price, 'D')
 
     def modify_order(self, order: UpdateOrder) -> None:
         """ UpdateOrder only happens on the same side of book """
         book = self.order_pool.pop(order.old_id)
+        old_price = book.order_price(order.old_id) if self.subscribers else None
         book.delete_order(DeleteOrder(order.timestamp, order.old_id))
         self._add_limit_order_to_book(LimitOrder(order.timestamp, order.id, book.side, order.price, order.shares), book)
+        if old_price is not None:
+            self._publish(order.timestamp, book, old_price, 'U')
+            if order.price != old_price:
+                self._publish(order.timestamp, book, order.price, 'U')
 
     # ========== User Order Operations ==========
     def add_user_limit_order(self, order: UserLimitOrder) -> None:
@@ -106,7 +161,7 @@ class OrderBook:
             * If we execute the order instead, the pairing user order will not be handle properly
         * Otherwise, add
 
-        We do not need to deal with book keeping because there is only one order and Book will deal with it
+        Book keeping of user orders is done by Book. See Book.add_user_limit_order
         """
         if order.side == 'B':
             this_book, opposite_book = self.bid_book, self.ask_book
@@ -128,11 +183,22 @@ class OrderBook:
     def match_limit_order_for_user(self, order: UserMarketOrder) -> Execution:
         """ Execute user MarketOrder in the correct book """
         if order.side == 'B':
-            return self.ask_book.match_limit_order_for_user(order)
+            execution = self.ask_book.match_limit_order_for_user(order)
         elif order.side == 'S':
-            return self.bid_book.match_limit_order_for_user(order)
+            execution = self.bid_book.match_limit_order_for_user(order)
         else:
             raise ValueError(f'Unrecognized side {order.side}')
+        self.fills = [execution]
+        return execution
+
+    def preview_market_order(self, side: str, shares: int) -> Optional[int]:
+        """ Return expected fill price of a user MarketOrder without touching the book. None if cannot be filled """
+        if side == 'B':
+            return self.ask_book.preview_market_order(shares)
+        elif side == 'S':
+            return self.bid_book.preview_market_order(shares)
+        else:
+            raise ValueError(f'Unrecognized side {side}')
 
     # ========== Private Methods ==========
     def _add_limit_order_to_book(self, order: LimitOrder, book: Book) -> None:
@@ -140,6 +206,12 @@ class OrderBook:
         book.add_limit_order(order)
         self.order_pool[order.id] = book
 
+    def _publish(self, timestamp: int, book: Book, price: int, cause: str) -> None:
+        """ Send the new state of a price level to subscribers """
+        delta = LevelDelta(timestamp, book.side, price, book.level_shares(price), cause)
+        for callback in self.subscribers:
+            callback(delta)
+
     # ========== Properties ==========
     @property
     def quote(self) -> Tuple[int, int]:
@@ -159,5 +231,30 @@ class OrderBook:
     def empty(self) -> bool:
         return len(self.order_pool) == 0
 
+    @property
+    def user_shares_ahead(self) -> Tuple[Optional[int], Optional[int]]:
+        """ Real shares in front of user bid and ask. None if there is no user order on that side """
+        return self.bid_book.user_shares_ahead, self.ask_book.user_shares_ahead
+
+    @property
+    def version(self) -> int:
+        """ Increases whenever either side is modified. Can be used to cache derived statistics """
+        return self.bid_book.version + self.ask_book.version
+
+    def get_stats(self) -> Dict[str, int]:
+        """ Size statistics of both sides prefixed by bid_ / ask_, plus total bytes. See Book.get_stats """
+        stats = {}
+        for prefix, book in (('bid_', self.bid_book), ('ask_', self.ask_book)):
+            for key, value in book.get_stats().items():
+                stats[prefix + key] = value
+        stats['total_bytes'] = sum(stats[f'{prefix}{kind}_bytes'] for prefix in ('bid_', 'ask_')
+                                   for kind in ('order', 'level'))
+        stats['peak_bytes'] = stats['bid_peak_bytes'] + stats['ask_peak_bytes']
+        return stats
+
     def get_depth(self, num_levels: int = 5) -> Tuple[List[Tuple[int, int]], List[Tuple[int, int]]]:
         return self.bid_book.get_depth(num_levels), self.ask_book.get_depth(num_levels)
+
+    def get_depth_array(self, num_levels: int = 5) -> Tuple[np.ndarray, np.ndarray]:
+        """ Same as get_depth but return cached (price, shares) arrays. See Book.get_depth_array """
+        return self.bid_book.get_depth_array(num_levels), self.ask_book.get_depth_array(num_levels)
@@ -3,13 +3,18 @@ Price level represent the queue at a certain price level in the bid / ask book
 """
 from __future__ import annotations
 from typing import Dict, Tuple, Union, Optional
+import copy
 
 from rlmarket.market.order import LimitOrder, MarketOrder, CancelOrder, DeleteOrder
 from rlmarket.market.user_order import UserLimitOrder, UserMarketOrder
 
 
 class PriceLevel:
-    """ Price level is the queue of a price level """
+    """
+    Price level is the queue of a price level
+    * Position of user order is tracked incrementally. Real shares in front of the user order are counted by
+        shares_ahead and real orders arriving after the user order are kept in behind
+    """
 
     def __init__(self, price: int) -> None:
         """ We won't track user orders on PriceLevel since it is a book level enforcement """
@@ -18,6 +23,8 @@ class PriceLevel:
         # Rely on the feature of dict that it preserves insertion order
         self.queue: Dict[int, Union[LimitOrder, UserLimitOrder]] = {}
         self.user_order_id: Optional[int] = None
+        self.shares_ahead = 0
+        self.behind: Dict[int, LimitOrder] = {}
 
     # ========== Order Operations ===========
     def add_limit_order(self, order: LimitOrder) -> PriceLevel:
@@ -25,54 +32,62 @@ class PriceLevel:
         if order.price != self.price:
             raise RuntimeError(f'LimitOrder price {order.price} is not the same as PriceLevel price {self.price}')
         self.shares += order.shares
-        self.queue[order.id] = order
+        self._store_order(order)
+        if self.user_order_id is not None:
+            self.behind[order.id] = order
         return self
 
     def match_limit_order(self, market_order: MarketOrder) -> Tuple[PriceLevel, bool, Optional[UserLimitOrder]]:
         """ Match against a limit order in the queue """
 
         # Order ID of MarketOrder is the LimitOrder ID to be matched
-        limit_order = self.queue[market_order.id]
+        limit_order = self._get_order(market_order.id)
 
         if market_order.side == limit_order.side:
             raise RuntimeError(f'LimitOrder and MarketOrder are on the same side ({market_order.side})')
 
-        # Handle user order
+        if limit_order.shares < market_order.shares:
+            raise RuntimeError(f'Market order shares {market_order.shares} is more than '
+                               f'limit order shares {limit_order.shares}')
+
+        # Handle user order. User order is executed when it is at the head and the order right behind it is matched
         user_order = None
         if self.user_order_id is not None:
-            iterator = iter(self.queue)
-            if next(iterator) == self.user_order_id and next(iterator) == market_order.id:
-                user_order = self.pop_user_order()
+            if market_order.id in self.behind:
+                if self.shares_ahead == 0 and next(iter(self.behind)) == market_order.id:
+                    user_order = self.pop_user_order()
+            else:
+                self.shares_ahead -= market_order.shares
 
         # Handle real order
-        if limit_order.shares > market_order.shares:
-            self.shares -= market_order.shares
-            limit_order.shares -= market_order.shares
-            exhausted = False
-
-        elif limit_order.shares == market_order.shares:
-            self.shares -= market_order.shares
-            del self.queue[market_order.id]
-            exhausted = True
-
+        self.shares -= market_order.shares
+        exhausted = limit_order.shares == market_order.shares
+        if exhausted:
+            self._discard_order(market_order.id)
+            self.behind.pop(market_order.id, None)
         else:
-            raise RuntimeError(f'Market order shares {market_order.shares} is more than '
-                               f'limit order shares {limit_order.shares}')
+            limit_order.shares -= market_order.shares
 
         # Return self for convenience of book level operation
         return self, exhausted, user_order
 
     def cancel_order(self, order: CancelOrder) -> None:
         """ Process order cancellation """
-        if self.queue[order.id].shares <= order.shares:
+        limit_order = self._get_order(order.id)
+        if limit_order.shares <= order.shares:
             raise RuntimeError('Cancel more shares than available')
-        self.queue[order.id].shares -= order.shares
+        limit_order.shares -= order.shares
         self.shares -= order.shares
+        if self.user_order_id is not None and order.id not in self.behind:
+            self.shares_ahead -= order.shares
 
     def delete_order(self, order: DeleteOrder) -> PriceLevel:
         """" Process order deletion """
-        self.shares -= self.queue[order.id].shares
-        del self.queue[order.id]
+        shares = self._get_order(order.id).shares
+        self.shares -= shares
+        self._discard_order(order.id)
+        if self.user_order_id is not None and self.behind.pop(order.id, None) is None:
+            self.shares_ahead -= shares
         return self
 
     # ========== User Order Operation ==========
@@ -90,6 +105,7 @@ class PriceLevel:
         # No need to increase PriceLevel shares since user orders are phantom orders
         self.queue[order.id] = order
         self.user_order_id = order.id
+        self.shares_ahead = self.shares  # User order joins at the back
         return self
 
     def match_limit_order_for_user(self, order: UserMarketOrder) -> int:
@@ -110,8 +126,40 @@ class PriceLevel:
         """ Remove and return user order """
         order = self.queue.pop(self.user_order_id)
         self.user_order_id = None
+        self.shares_ahead = 0
+        self.behind.clear()
         return order
 
+    def recycle(self, price: int) -> PriceLevel:
+        """ Reset an empty level for reuse at price. Queue containers are kept to avoid reallocation """
+        self.price = price
+        self.shares = 0
+        self.queue.clear()
+        self.user_order_id = None
+        self.shares_ahead = 0
+        self.behind.clear()
+        return self
+
+    def copy(self) -> PriceLevel:
+        """ Return a copy that does not share queued orders with this level """
+        level = copy.copy(self)
+        level.queue = {order_id: copy.copy(order) for order_id, order in self.queue.items()}
+        level.behind = {order_id: level.queue.get(order_id, order) for order_id, order in self.behind.items()}
+        return level
+
+    # ========== Private Methods ==========
+    def _get_order(self, order_id: int) -> LimitOrder:
+        """ Look up resting LimitOrder """
+        return self.queue[order_id]
+
+    def _store_order(self, order: LimitOrder) -> None:
+        """ Keep LimitOrder at the back of the queue """
+        self.queue[order.id] = order
+
+    def _discard_order(self, order_id: int) -> None:
+        """ Remove LimitOrder from the queue """
+        del self.queue[order_id]
+
     # ========== Properties ==========
     @property
     def length(self):
@@ -122,3 +170,37 @@ class PriceLevel:
     def empty(self):
         """ Whether PriceLevel is empty """
         return self.shares == 0 and self.user_order_id is None
+
+
+class LeanPriceLevel(PriceLevel):
+    """
+    Price level that only tracks the total shares. LimitOrders are looked up from the order map of the Book
+    * Queue is only materialized while a user order rests at this level. It then holds the user order and the real
+        orders arriving after it are kept in behind
+    * Real orders in front of the user order are only known through shares_ahead
+    """
+
+    def __init__(self, price: int, orders: Dict[int, LimitOrder]) -> None:
+        super().__init__(price)
+        self.orders = orders
+        self.num_orders = 0
+
+    def recycle(self, price: int) -> PriceLevel:
+        self.num_orders = 0
+        return super().recycle(price)
+
+    # ========== Private Methods ==========
+    def _get_order(self, order_id: int) -> LimitOrder:
+        return self.orders[order_id]
+
+    def _store_order(self, order: LimitOrder) -> None:
+        self.num_orders += 1
+
+    def _discard_order(self, order_id: int) -> None:
+        self.num_orders -= 1
+
+    # ========== Properties ==========
+    @property
+    def length(self):
+        """ Length (total number) of orders (real and user) """
+        return self.num_orders + len(self.queue)
@@ -0,0 +1,43 @@
+"""
+Periodic sampling of order book size statistics
+"""
+from typing import Dict, List, Optional, Tuple
+
+from rlmarket.market.order import LevelDelta, show_time
+from rlmarket.market.order_book import OrderBook
+
+
+class BookStatsSampler:
+    """
+    Sample OrderBook.get_stats every n real order operations
+    * Operations are counted through LevelDelta subscription, so the cost between samples is one counter increment
+    """
+
+    def __init__(self, book: OrderBook, every: int = 100000, verbose: bool = False) -> None:
+        self.book = book
+        self.every = every
+        self.verbose = verbose
+        self.samples: List[Tuple[Optional[int], Dict[str, int]]] = []
+        self._count = 0
+        book.subscribe(self)
+
+    def __call__(self, delta: LevelDelta) -> None:
+        self._count += 1
+        if self._count >= self.every:
+            self._count = 0
+            self.sample(delta.timestamp)
+
+    def sample(self, timestamp: Optional[int] = None) -> Dict[str, int]:
+        """ Record current stats """
+        stats = self.book.get_stats()
+        self.samples.append((timestamp, stats))
+        if self.verbose:
+            print(f'[{show_time(timestamp)}] orders={stats["bid_orders"]}/{stats["ask_orders"]} '
+                  f'levels={stats["bid_levels"]}/{stats["ask_levels"]} '
+                  f'max_queue={max(stats["bid_max_queue_length"], stats["ask_max_queue_length"])} '
+                  f'bytes={stats["total_bytes"]} peak_bytes={stats["peak_bytes"]}')
+        return stats
+
+    def close(self) -> None:
+        """ Stop sampling """
+        self.book.unsubscribe(self)
@@ -3,6 +3,7 @@ from pathlib import Path
 import pickle
 from datetime import datetime
 
+from rlmarket.environment.tape_metadata import save_metadata, validate_orders
 from rlmarket.market import LimitOrder, MarketOrder, CancelOrder, DeleteOrder, UpdateOrder
 
 
@@ -119,3 +120,6 @@ def convert_csv_to_pickle(path, file):
 
     with open(full_path.with_suffix('.pickle'), 'wb') as f:
         pickle.dump(queue, f)
+
+    # Record the end-of-day check so that exchanges can skip draining the tape
+    save_metadata(str(full_path.with_suffix('.pickle')), **validate_orders(queue))
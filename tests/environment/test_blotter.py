@@ -0,0 +1,42 @@
+"""
+Unittest for rlmarket/environment/blotter.py
+"""
+import numpy as np
+
+from rlmarket.environment.blotter import Blotter, LIQUIDATION
+
+
+def test_blotter():
+    """
+    Fills should be kept in columns across growth and summarized like the old book keeping stats
+        * Spread capture is (mid - price) * shares per fill
+        * Inventory PnL is fills at mid plus final position at the final mid
+    """
+    blotter = Blotter(capacity=2)
+    blotter.record(1, 9900, 100, 10000, 0, 100, 0)
+    blotter.record(2, 10200, -100, 10100, 2, 0, 30000)
+    blotter.record(3, 10100, -100, 10050, LIQUIDATION, -100)  # Grows capacity
+    assert len(blotter) == 3
+    np.testing.assert_array_equal(blotter['timestamp'], [1, 2, 3])
+    np.testing.assert_array_equal(blotter['side'], [1, -1, -1])
+
+    assert blotter.num_bids == 1
+    assert blotter.num_asks == 2
+    np.testing.assert_array_equal(blotter.spread_profits(), [10000, 10000, 5000])
+    np.testing.assert_array_equal(blotter.action_fills(3), [1, 0, 1])
+    np.testing.assert_array_equal(blotter.inventory_path(), [[1, 100], [2, 0], [3, -100]])
+
+    # Same as the old running total: -sum(mid * shares) + final_mid * position
+    assert blotter.inventory_pnl(10000) == -10000 * 100 + 10100 * 100 + 10050 * 100 - 10000 * 100
+
+    stats = blotter.summary(10000)
+    assert stats['spread_capture'] == 25000
+    assert stats['avg_spread_profit'] == 25000 / 3
+    assert stats['total_pnl'] == 25000 + stats['inventory_pnl']
+    assert stats['realized_pnl'] == 30000  # Tape units. NaN PnL is skipped
+    assert np.isnan(blotter.summary(None)['inventory_pnl'])
+
+    blotter.reset()
+    assert len(blotter) == 0
+    assert blotter.inventory_pnl(10000) == 0
+    assert np.isnan(blotter.summary(10000)['avg_spread_profit'])
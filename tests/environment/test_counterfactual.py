@@ -0,0 +1,89 @@
+"""
+Tests for rlmarket/environment/counterfactual.py
+"""
+from copy import deepcopy
+import pytest
+
+from rlmarket.environment import NewExchange
+from rlmarket.environment.exchange_elements import Position
+from rlmarket.market import LimitOrder, MarketOrder, DeleteOrder
+
+
+anchor = 34200000000000
+delta = 30000000
+start_time = anchor + 9 * delta
+end_time = anchor + 23 * delta
+
+tape = [
+    # 5 Bid Levels
+    LimitOrder(anchor + 0 * delta, 1, 'B', 10000, 150),
+    LimitOrder(anchor + 1 * delta, 2, 'B', 9000, 50),
+    LimitOrder(anchor + 2 * delta, 3, 'B', 8000, 100),
+    LimitOrder(anchor + 3 * delta, 4, 'B', 7000, 50),
+    LimitOrder(anchor + 4 * delta, 5, 'B', 6000, 50),
+
+    # 5 Ask Levels
+    LimitOrder(anchor + 5 * delta, 6, 'S', 12000, 100),
+    LimitOrder(anchor + 6 * delta, 7, 'S', 13000, 200),
+    LimitOrder(anchor + 7 * delta, 8, 'S', 14000, 50),
+    LimitOrder(anchor + 8 * delta, 9, 'S', 15000, 50),
+    LimitOrder(anchor + 9 * delta, 10, 'S', 16000, 50),
+
+    MarketOrder(anchor + 10 * delta, 1, 'S', 150),
+    MarketOrder(anchor + 11 * delta, 2, 'S', 25),
+    MarketOrder(anchor + 12 * delta, 6, 'B', 100),
+    MarketOrder(anchor + 13 * delta, 7, 'B', 100),
+    MarketOrder(anchor + 15 * delta, 2, 'S', 25),  # Bid at 9000 executed
+    MarketOrder(anchor + 16 * delta, 3, 'S', 50),
+    MarketOrder(anchor + 17 * delta, 3, 'S', 50),
+    MarketOrder(anchor + 18 * delta, 4, 'S', 25),  # Bid at 8000 executed
+    MarketOrder(anchor + 19 * delta, 4, 'S', 25),
+    MarketOrder(anchor + 20 * delta, 7, 'B', 100),
+    MarketOrder(anchor + 21 * delta, 8, 'B', 25),  # Ask at 13000 executed
+    MarketOrder(anchor + 22 * delta, 8, 'B', 25),
+    MarketOrder(anchor + 23 * delta, 9, 'B', 50),
+    DeleteOrder(anchor + 24 * delta, 5),
+    DeleteOrder(anchor + 25 * delta, 10),
+]
+
+
+def test_evaluate_actions(mocker):
+    """
+    Outcomes of all actions should be the same as taking each of them
+        * Reward is calculated against open positions without changing them
+    """
+    mocker.patch('rlmarket.environment.exchange_elements.pickle.load', return_value=deepcopy(tape))
+    mocker.patch('builtins.open', mocker.mock_open())
+
+    exchange = NewExchange(files=[''], indicators=[Position()], reward_lb=-0.2, reward_ub=0.3,
+                           start_time=start_time, end_time=end_time,
+                           latency=delta, order_size=50, position_limit=1000, fill_oracle=True)
+    exchange.reset()
+
+    # Pretend that there is an open long position of 50 shares at 12000
+    exchange._position = 50
+    exchange._open_positions.fill(12000, 50)
+    outcomes = exchange.evaluate_actions()
+
+    assert [(outcome.bid_price, outcome.ask_price) for outcome in outcomes] == [(8000, 14000), (6000, 13000),
+                                                                                 (9000, 16000)]
+    assert [(outcome.fill_time, outcome.side, outcome.price) for outcome in outcomes] == [
+        (9 * delta, 'B', 8000), (12 * delta, 'S', 13000), (7 * delta, 'B', 9000)]
+    assert outcomes[1].mid_price == 10000
+    assert outcomes[1].reward == pytest.approx(0.3 * 50 / 10000)  # Profit of 1000 per share hits the upper bound
+    assert outcomes[1].pnl == pytest.approx(1000 * 50 / 10000)
+    assert outcomes[0].reward == 0 and outcomes[2].reward == 0  # Add to the position
+    assert len(exchange._open_positions) == 1 and exchange._open_positions[0].shares == 50
+
+    for outcome in outcomes:
+        fork = deepcopy(exchange)
+        _, reward, pnl, done = fork.step(outcome.action)
+        assert not done
+        assert fork.tape.current_time - exchange.tape.current_time == outcome.fill_time
+        assert fork.position - exchange.position == (50 if outcome.side == 'B' else -50)
+        assert (reward, pnl) == pytest.approx((outcome.reward, outcome.pnl))
+
+    # Oracle is needed
+    exchange._oracle = None
+    with pytest.raises(RuntimeError, match='fill_oracle'):
+        exchange.evaluate_actions()
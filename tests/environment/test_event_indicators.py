@@ -0,0 +1,66 @@
+"""
+Unittest for rlmarket/environment/event_indicators.py
+"""
+import math
+from types import SimpleNamespace
+import pytest
+
+from rlmarket.environment.event_indicators import (RollingWindow, RealizedVolatility, TradeIntensity, CancelRate,
+                                                   OrderFlowImbalance, TimeSinceMidChange, attach_event_indicators)
+from rlmarket.environment.exchange_elements import Position
+from rlmarket.market import OrderBook, LimitOrder, MarketOrder, CancelOrder, DeleteOrder
+
+
+def test_rolling_window():
+    """ Values at or before now - window are evicted """
+    window = RollingWindow(10)
+    window.push(1, 2)
+    window.push(5, 3)
+    assert window.total == 5
+    window.evict(11)
+    assert window.total == 3 and len(window) == 1
+    window.push(20, 1)  # Push evicts too
+    assert window.total == 1
+    with pytest.raises(ValueError):
+        RollingWindow(0)
+
+
+def test_event_indicators():
+    """
+    Indicators should follow every real order event and read out at decision time without replay
+        * Bid improves, is executed away, ask is partially cancelled and bid is deleted
+        * Expired events are dropped when the value is read
+        * Re-attaching clears statistics without subscribing twice
+    """
+    book = OrderBook()
+    env = SimpleNamespace(book=book, tape=SimpleNamespace(current_time=0))
+    window = 10
+    volatility, trades, cancels = RealizedVolatility(window), TradeIntensity(window), CancelRate(window)
+    flow, since = OrderFlowImbalance(window, scale=10), TimeSinceMidChange(scale=1)
+    indicators = [volatility, trades, cancels, flow, since, Position()]
+    attach_event_indicators(indicators, book)
+    assert len(book.subscribers) == 5
+
+    book.add_limit_order(LimitOrder(1, 1, 'B', 10000, 100))
+    book.add_limit_order(LimitOrder(2, 2, 'S', 10200, 100))
+    book.add_limit_order(LimitOrder(3, 3, 'B', 10100, 50))  # Bid improves. Flow +50
+    book.match_limit_order(MarketOrder(4, 3, 'S', 50))  # Bid falls back. Flow -50
+    book.cancel_order(CancelOrder(5, 2, 50))  # Ask shrinks. Flow +50
+    book.delete_order(DeleteOrder(6, 1))  # One-sided book does not count
+
+    env.tape.current_time = 6
+    assert volatility.update(env) == pytest.approx((math.sqrt(2 * math.log(20300 / 20200) ** 2),))
+    assert trades.update(env) == pytest.approx((0, 1e8))
+    assert cancels.update(env) == pytest.approx((1e8, 1e8))
+    assert flow.update(env) == pytest.approx((5,))
+    assert since.update(env) == (2,)
+
+    env.tape.current_time = 15
+    assert volatility.update(env) == (0,)
+    assert trades.update(env) == (0, 0)
+    assert cancels.update(env) == pytest.approx((1e8, 0))
+    assert flow.update(env) == (0,)
+
+    attach_event_indicators(indicators, book)
+    assert len(book.subscribers) == 5
+    assert cancels.update(env) == (0, 0) and since.update(env) == (0,)
@@ -1,11 +1,14 @@
 """
 Test for Tape at rlmarket/environment/exchange_elements.py
 """
+from copy import deepcopy
+from types import SimpleNamespace
 import numpy as np
 
-from rlmarket.environment.exchange_elements import Tape, MidPriceDeltaSign, Imbalance, Position
+from rlmarket.environment.exchange_elements import (Tape, MidPriceDeltaSign, Imbalance, Position, QueuePosition,
+                                                    StateBuffer)
 from rlmarket.environment import Exchange
-from rlmarket.market import LimitOrder, MarketOrder, UserLimitOrder
+from rlmarket.market import OrderBook, LimitOrder, MarketOrder, UserLimitOrder
 
 
 def test_tape(mocker):
@@ -145,3 +148,48 @@ def test_imbalance(mocker):
     bid_vol = 100 + 100 * np.exp(1)
     ask_vol = 100 + 50 * np.exp(1)
     assert abs(ind.update(env)[0] - (bid_vol - ask_vol) / (bid_vol + ask_vol)) < 1E-10
+
+
+def test_queue_position():
+    """ Test queue position reading """
+    env = SimpleNamespace(book=OrderBook())
+    ind = QueuePosition(scale=100)
+    assert ind.dimension == 2
+    assert ind.update(env) == (0, 0)
+
+    env.book.add_limit_order(LimitOrder(1, 1, 'B', 10000, 100))
+    env.book.add_limit_order(LimitOrder(2, 2, 'S', 12000, 50))
+    env.book.add_user_limit_order(UserLimitOrder(3, -1, 'B', 10000, 100))
+    env.book.add_user_limit_order(UserLimitOrder(3, -2, 'S', 12000, 100))
+    assert ind.update(env) == (1, 0.5)
+
+    env.book.match_limit_order(MarketOrder(4, 1, 'S', 50))
+    assert ind.update(env) == (0.5, 0.5)
+
+
+def test_ring_buffer():
+    """
+    Ring buffer indicator should keep the last values oldest first across wrap-arounds
+        * write gives the same values as update without building a tuple
+        * Copy of the state buffer keeps its slices as views of the copied array
+    """
+    env = SimpleNamespace(book=OrderBook())
+    env.book.add_limit_order(LimitOrder(1, 1, 'B', 10000, 100))
+    env.book.add_limit_order(LimitOrder(2, 2, 'S', 12000, 100))
+    ind = MidPriceDeltaSign(3)
+    assert ind.update(env) == (0, 0, 0)
+
+    env.book.add_limit_order(LimitOrder(3, 3, 'S', 11000, 100))
+    assert ind.update(env) == (0, 0, -1)
+    env.book.match_limit_order(MarketOrder(4, 3, 'B', 100))
+    assert ind.update(env) == (0, -1, 1)
+    assert ind.update(env) == (-1, 1, 0)
+
+    state = StateBuffer([1, ind.dimension])
+    ind.write(env, state.slices[1])
+    np.testing.assert_array_equal(state.array, (0, 1, 0, 0))
+
+    fork = deepcopy(state)
+    fork.slices[1][:] = 1
+    np.testing.assert_array_equal(fork.array, (0, 1, 1, 1))
+    np.testing.assert_array_equal(state.array, (0, 1, 0, 0))
@@ -0,0 +1,43 @@
+"""
+Tests for rlmarket/environment/fill_oracle.py
+"""
+from rlmarket.environment.fill_oracle import FillOracle
+from rlmarket.market import LimitOrder, MarketOrder, CancelOrder, DeleteOrder, UpdateOrder
+
+
+def test_fill_oracle():
+    """ Test run-over, crossing and queue execution on both sides """
+    orders = [
+        LimitOrder(1, 1, 'B', 10000, 100),
+        LimitOrder(2, 2, 'B', 9900, 100),
+        LimitOrder(3, 3, 'S', 10200, 100),
+        LimitOrder(4, 4, 'B', 10000, 50),
+        MarketOrder(5, 1, 'S', 100),
+        CancelOrder(6, 4, 20),
+        LimitOrder(7, 5, 'B', 10000, 100),
+        MarketOrder(8, 4, 'S', 30),
+        MarketOrder(9, 5, 'S', 100),
+        LimitOrder(10, 6, 'B', 10100, 100),
+        UpdateOrder(11, 7, 3, 10300, 100),
+        MarketOrder(12, 7, 'B', 100),
+        DeleteOrder(13, 6),
+        DeleteOrder(14, 2),
+    ]
+    oracle = FillOracle(orders)
+
+    # Bid side
+    assert oracle.first_fill_time('B', 10000, 0) == 5  # Nothing ahead. Order 1 is behind and matched at the head
+    assert oracle.first_fill_time('B', 10000, 1) == 8  # Order 1 is ahead
+    assert oracle.first_fill_time('B', 10000, 4) == 9  # Orders 1 and 4 are ahead
+    assert oracle.first_fill_time('B', 10000, 7) is None
+    assert oracle.first_fill_time('B', 10050, 3) == 5  # Run over by the match at 10000
+    assert oracle.first_fill_time('B', 9900, 1) is None
+
+    # Ask side
+    assert oracle.first_fill_time('S', 10100, 3) == 10  # Crossed by order 6
+    assert oracle.first_fill_time('S', 10200, 3) == 12  # Run over by the match at 10300
+    assert oracle.first_fill_time('S', 10300, 3) == 12  # Order 7 replaces order 3 behind the user order
+    assert oracle.first_fill_time('S', 10300, 11) is None
+
+    # Price crossing the real quote is moved one tick away from it like OrderBook
+    assert oracle.first_fill_time('B', 10500, 3) == oracle.first_fill_time('B', 10100, 3) == 5
@@ -0,0 +1,41 @@
+"""
+Unittest for rlmarket/environment/position_ledger.py
+"""
+from rlmarket.environment.position_ledger import PositionLedger
+
+
+def test_position_ledger():
+    """
+    Lots should be matched on FIFO basis across compaction and growth of the arrays
+        * Same side fill is queued and matches nothing
+        * Opposite fill consumes lots from the head and the rest opens a position on its own side
+        * Copy is independent of the original
+        * Realized PnL is kept as a running total until reset
+    """
+    ledger = PositionLedger(capacity=2)
+    assert ledger.fill(100, -100) == (0, 0)
+    assert ledger.fill(110, -100) == (0, 0)
+    assert ledger.fill(120, -100) == (0, 0)  # Grows capacity
+    assert [tuple(lot) for lot in (ledger[0], ledger[1], ledger[2])] == [(100, -100), (110, -100), (120, -100)]
+    assert ledger.position == -300
+
+    # Partial match of the head lot
+    assert ledger.fill(110, 50) == (-500, 50)
+    assert tuple(ledger[0]) == (100, -50)
+
+    # Copy does not share lots
+    fork = ledger.copy()
+    assert fork.fill(90, 150) == (10 * 50 + 20 * 100, 150)
+    assert len(fork) == 1 and tuple(fork[0]) == (120, -100)
+    assert len(ledger) == 3 and ledger.position == -250
+    assert ledger.realized == -500 and fork.realized == -500 + 10 * 50 + 20 * 100
+
+    # Match through all lots and flip to long
+    assert ledger.fill(90, 300) == (10 * 50 + 20 * 100 + 30 * 100, 250)
+    assert len(ledger) == 1 and tuple(ledger[0]) == (90, 50)
+    assert ledger.fill(100, -50) == (500, -50)
+    assert len(ledger) == 0 and ledger.position == 0
+    assert ledger.realized == -500 + 10 * 50 + 20 * 100 + 30 * 100 + 500
+
+    ledger.reset()
+    assert ledger.realized == 0
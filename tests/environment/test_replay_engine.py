@@ -0,0 +1,143 @@
+"""
+Tests for rlmarket/environment/replay_engine.py
+"""
+import pytest
+
+from rlmarket.environment.exchange_elements import Tape
+from rlmarket.environment.replay_engine import fast_forward, ReplayEngine, event_codes, LIMIT, MARKET, DELETE
+from rlmarket.market import OrderBook, LimitOrder, MarketOrder, DeleteOrder, UserLimitOrder
+
+
+def test_fast_forward(mocker):
+    """ Fast forward should stop right before orders that may execute user orders """
+    messages = [
+        LimitOrder(1, 1, 'B', 10000, 100),
+        LimitOrder(2, 2, 'S', 10200, 100),
+        LimitOrder(3, 3, 'B', 9900, 100),
+        MarketOrder(4, 1, 'S', 100),  # Better than user bid
+        DeleteOrder(5, 2),
+        LimitOrder(6, 4, 'S', 10400, 100),
+        MarketOrder(7, 3, 'S', 50),  # At user bid price
+        LimitOrder(8, 5, 'B', 10100, 100),
+        LimitOrder(9, 6, 'B', 10300, 100),  # Cross user ask
+        DeleteOrder(10, 6),
+        DeleteOrder(11, 5),
+        DeleteOrder(12, 4),
+    ]
+    mocker.patch('rlmarket.environment.exchange_elements.pickle.load', return_value=messages)
+    mocker.patch('builtins.open', mocker.mock_open())
+
+    tape = Tape('', latency=1, end_time=10)
+    book = OrderBook()
+    for _ in range(3):
+        book.add_limit_order(tape.next())
+    tape.add_user_order(UserLimitOrder(side='B', price=9900, shares=100))
+    tape.add_user_order(UserLimitOrder(side='S', price=10300, shares=100))
+
+    # User order arrival
+    assert not fast_forward(tape, book, 10)
+    assert tape.pointer == 4
+    book.add_user_limit_order(tape.next())
+    book.add_user_limit_order(tape.next())
+
+    assert not fast_forward(tape, book, 10)
+    assert (tape.pointer, tape.current_time) == (6, 6)
+    assert book.get_depth() == ([(9900, 100)], [(10400, 100)])
+    assert book.match_limit_order(tape.next()) is None  # User bid is not at the head
+
+    assert not fast_forward(tape, book, 10)
+    assert tape.pointer == 8
+    assert book.add_limit_order(tape.next()).id == -2
+
+    # Nothing left that can execute user orders. Stop after passing end time
+    assert fast_forward(tape, book, 10)
+    assert (tape.pointer, tape.current_time) == (11, 11)
+    assert not tape.done
+
+
+@pytest.mark.parametrize('fast', [False, True])
+def test_replay_engine(mocker, fast):
+    """
+    Engine should dispatch by type code and count events by type
+        * Waiting stops at the execution of the user order whether or not fast forward is used
+        * Orders applied by fast forward are counted
+    """
+    messages = [
+        LimitOrder(1, 1, 'B', 10000, 100),
+        LimitOrder(2, 2, 'S', 10200, 100),
+        LimitOrder(3, 3, 'B', 9900, 100),
+        DeleteOrder(5, 3),
+        MarketOrder(6, 1, 'S', 100),  # Run over user bid inside the spread
+        DeleteOrder(7, 2),
+    ]
+    mocker.patch('rlmarket.environment.exchange_elements.pickle.load', return_value=messages)
+    mocker.patch('builtins.open', mocker.mock_open())
+
+    assert event_codes(messages) == bytes([LIMIT, LIMIT, LIMIT, DELETE, MARKET, DELETE])
+    with pytest.raises(ValueError, match='Unrecognized order type'):
+        event_codes([None])
+
+    tape = Tape('', latency=1, end_time=10)
+    engine = ReplayEngine(tape, OrderBook(), 10, fast_forward=fast)
+    engine.warm_up(2)
+    assert engine.book.quote == (10000, 10200)
+    assert engine.counters['limit'] == 2
+
+    tape.add_user_order(UserLimitOrder(side='B', price=10100, shares=100))
+    execution = engine.wait_for_execution()
+    assert execution.price == 10100 and execution.shares == 100
+    assert tape.pointer == 5
+    assert engine.counters == {'limit': 3, 'market': 1, 'cancel': 0, 'delete': 1, 'update': 0, 'user_limit': 1,
+                               'user_market': 0}
+
+    assert engine.wait_for_execution() is None
+    assert tape.done
+    assert engine.counters['delete'] == 2
+    with pytest.raises(ValueError, match='Unrecognized order type'):
+        engine.run()
+
+
+def test_replay_engine_replay(mocker):
+    """ Replay should apply real orders before the stop only """
+    messages = [
+        LimitOrder(1, 1, 'B', 10000, 100),
+        LimitOrder(2, 2, 'S', 10200, 100),
+        MarketOrder(3, 1, 'S', 50),
+        DeleteOrder(4, 2),
+    ]
+    mocker.patch('rlmarket.environment.exchange_elements.pickle.load', return_value=messages)
+    mocker.patch('builtins.open', mocker.mock_open())
+
+    tape = Tape('')
+    engine = ReplayEngine(tape, OrderBook(), 10)
+    engine.replay(3)
+    assert (tape.pointer, tape.current_time) == (3, 3)
+    assert engine.book.get_depth() == ([(10000, 50)], [(10200, 100)])
+    assert engine.counters['market'] == 1
+    engine.drain()
+    assert engine.book.get_depth() == ([(10000, 50)], [])
+
+
+def test_user_arrivals(mocker):
+    """ Tape should only keep arrivals of user orders resting in the book """
+    messages = [
+        LimitOrder(1, 1, 'B', 10000, 100),
+        LimitOrder(2, 2, 'S', 10200, 100),
+        LimitOrder(5, 3, 'B', 9800, 100),
+        DeleteOrder(6, 3),
+    ]
+    mocker.patch('rlmarket.environment.exchange_elements.pickle.load', return_value=messages)
+    mocker.patch('builtins.open', mocker.mock_open())
+
+    tape = Tape('', latency=1, end_time=10)
+    engine = ReplayEngine(tape, OrderBook(), 10)
+    engine.warm_up(2)
+    bid_id = tape.add_user_order(UserLimitOrder(side='B', price=9900, shares=100))
+    ask_id = tape.add_user_order(UserLimitOrder(side='S', price=10300, shares=100))
+    engine.run()
+    engine.run()
+    assert tape.user_arrivals == {bid_id: 2, ask_id: 2}
+
+    new_bid_id = tape.add_user_order(UserLimitOrder(side='B', price=9800, shares=100))  # Replace the user bid
+    engine.run()
+    assert tape.user_arrivals == {ask_id: 2, new_bid_id: 2}
@@ -0,0 +1,47 @@
+"""
+Unittest for rlmarket/environment/tape_metadata.py
+"""
+import pickle
+
+from rlmarket.environment.exchange_elements import Tape
+from rlmarket.environment.tape_metadata import (load_metadata, save_metadata, validate_orders, clears_at_end,
+                                                record_clearing)
+from rlmarket.market import OrderBook, LimitOrder, MarketOrder, DeleteOrder
+
+
+def test_tape_metadata(tmp_path):
+    """
+    Clearing check should be recorded at conversion or first drain and read back from the sidecar
+        * Tape without metadata, or with metadata of another length, is not known to clear
+    """
+    orders = [
+        LimitOrder(1, 1, 'B', 10000, 100),
+        LimitOrder(2, 2, 'S', 10100, 100),
+        MarketOrder(3, 1, 'S', 100),
+        DeleteOrder(4, 2),
+    ]
+    path = str(tmp_path / 'tape.pickle')
+    with open(path, 'wb') as f:
+        pickle.dump(orders, f)
+
+    assert load_metadata(path) == {}
+    assert validate_orders(orders) == {'num_orders': 4, 'clears': True}
+    assert validate_orders(orders[:2]) == {'num_orders': 2, 'clears': False}
+    assert orders[0].shares == 100  # Orders are not changed
+
+    tape = Tape(path)
+    assert not clears_at_end(tape)
+
+    # Drain records the check
+    book = OrderBook()
+    book.add_limit_order(tape.next())
+    book.add_limit_order(tape.next())
+    book.match_limit_order(tape.next())
+    book.delete_order(tape.next())
+    record_clearing(tape, book)
+    assert load_metadata(path) == {'num_orders': 4, 'clears': True}
+    assert clears_at_end(Tape(path))
+
+    save_metadata(path, num_orders=5)
+    assert load_metadata(path) == {'num_orders': 5, 'clears': True}
+    assert not clears_at_end(Tape(path))
@@ -2,10 +2,15 @@
 Unittest for rlmarket/gym_env/absolute_exchange.py
 """
 from copy import deepcopy
+from types import SimpleNamespace
 from numpy.testing import assert_almost_equal
+import numpy as np
+import pytest
 
 from rlmarket.gym_env import AbsoluteExchange
-from rlmarket.environment.exchange_elements import Position, Imbalance, NormalizedPosition
+from rlmarket.environment.event_indicators import TradeIntensity, TimeSinceMidChange
+from rlmarket.environment.snapshot import SnapshotLadder
+from rlmarket.environment.exchange_elements import Position, Imbalance, NormalizedPosition, RemainingTime
 from rlmarket.market import LimitOrder, MarketOrder, DeleteOrder
 
 
@@ -57,7 +62,8 @@ tape = [
 ]
 
 
-def test_exchange(mocker):
+@pytest.mark.parametrize('fast_forward, fill_oracle', [(False, False), (True, False), (True, True)])
+def test_exchange(mocker, fast_forward, fill_oracle):
     mocker.patch('rlmarket.environment.exchange_elements.pickle.load', return_value=deepcopy(tape))
     mocker.patch('builtins.open', mocker.mock_open())
 
@@ -66,7 +72,8 @@ def test_exchange(mocker):
     exchange = AbsoluteExchange(files=[''], indicators=[Position(), Imbalance(1, decay=0)],
                                 reward_lb=-0.2, reward_ub=0.3,  # Bounds in percentage
                                 start_time=start_time, end_time=end_time,
-                                latency=delta, order_size=50, position_limit=position_limit)
+                                latency=delta, order_size=50, position_limit=position_limit,
+                                fast_forward=fast_forward, fill_oracle=fill_oracle)
 
     assert exchange.observation_space.shape == (2,)
 
@@ -120,6 +127,8 @@ def test_exchange(mocker):
 
     # Total
     assert total_pnl == -50 * 1 + 50 * 1.2 - 50 * 0.9 - 50 * 0.8 + 20 * 0.6 + 50 * 1.3 + 30 * 1.4
+    # Blotter keeps PnL in tape units like prices
+    assert exchange.blotter['pnl'].tolist() == [0, 100000, 0, 0, -60000, 220000, 180000]
 
     # Finishing
     assert not exchange.book.empty
@@ -144,3 +153,147 @@ def test_exchange(mocker):
     assert info['pnl'] == 22
     _, _, _, info = exchange.step(3)
     assert info['pnl'] == 18
+
+
+def test_random_start(mocker):
+    """
+    Episode restored from the snapshot ladder should be the same as an exchange set to start at the random start
+        * Snapshot interval does not fall on the random starts, so catch-up replay is needed
+        * Episodes run on forks and leave the snapshot books untouched
+        * Remaining time follows the episode window and reaches 0 at its end
+    """
+    mocker.patch('rlmarket.environment.exchange_elements.pickle.load', side_effect=lambda _: deepcopy(tape))
+    mocker.patch('builtins.open', mocker.mock_open())
+
+    def make_exchange(**kwargs):
+        return AbsoluteExchange(files=[''], indicators=[Position(), Imbalance(1, decay=0), RemainingTime()],
+                                reward_lb=-0.2, reward_ub=0.3, latency=delta // 2, order_size=25,
+                                position_limit=100, **kwargs)
+
+    exchange = make_exchange(start_time=start_time, end_time=end_time, episode_length=6 * delta,
+                             snapshot_interval=4 * delta, seed=1)
+    starts = set()
+    for _ in range(6):
+        state = exchange.reset()
+        episode_start = exchange._start_time
+        assert start_time <= episode_start <= end_time - 6 * delta
+        starts.add(episode_start)
+
+        expected = make_exchange(start_time=episode_start, end_time=episode_start + 6 * delta)
+        assert_almost_equal(state, expected.reset())
+        assert exchange.book.get_depth(5) == expected.book.get_depth(5)
+        assert 0 < state[2] <= 1
+        done = False
+        while not done:
+            state, reward, done, info = exchange.step(3)
+            expected_state, expected_reward, expected_done, expected_info = expected.step(3)
+            assert_almost_equal(state, expected_state)
+            assert reward == pytest.approx(expected_reward)
+            assert info['pnl'] == pytest.approx(expected_info['pnl'])
+            assert done == expected_done
+            assert state[2] == pytest.approx((exchange._end_time - exchange.tape.current_time) / (6 * delta))
+        assert state[2] <= 0  # Episode ends once the tape passes its end time
+
+    assert len(starts) > 1
+    assert len(exchange._ladders) == 1
+
+    with pytest.raises(ValueError, match='RemainingTime should follow the episode window'):
+        AbsoluteExchange(files=[''], indicators=[RemainingTime(start_time, end_time)], reward_lb=-0.2, reward_ub=0.3,
+                         start_time=start_time, end_time=end_time, episode_length=6 * delta)
+
+    path, ladder = next(iter(exchange._ladders.items()))
+    fresh = SnapshotLadder(path, start_time, end_time, 4 * delta)
+    for used, expected in zip(ladder.snapshots, fresh.snapshots):
+        assert used.book.get_depth(5) == expected.book.get_depth(5)
+        assert used.book.order_pool.keys() == expected.book.order_pool.keys()
+
+
+def test_random_start_full_session(mocker):
+    """
+    Random starts should be drawn over a full trading session in nanoseconds
+        * The default integer of numpy is int32 on Windows. It is emulated here, where the default is int64
+    """
+    session_end = 57600000000000
+    full_day = deepcopy(tape) + [LimitOrder(session_end, 11, 'S', 17000, 50)]
+    mocker.patch('rlmarket.environment.exchange_elements.pickle.load', side_effect=lambda _: deepcopy(full_day))
+    mocker.patch('builtins.open', mocker.mock_open())
+
+    hour = 3600000000000
+    exchange = AbsoluteExchange(files=[''], indicators=[Position()], reward_lb=-0.2, reward_ub=0.3,
+                                start_time=anchor, end_time=session_end, latency=delta, order_size=50,
+                                position_limit=100, episode_length=hour, snapshot_interval=hour, seed=0)
+    randint = exchange._random.randint
+
+    def windows_randint(low, high, dtype=np.int32):
+        return randint(low, high, dtype=dtype)
+
+    exchange._random = SimpleNamespace(randint=windows_randint)
+    for _ in range(3):
+        exchange.reset()
+        assert anchor <= exchange._start_time <= session_end - hour
+        assert exchange._end_time == exchange._start_time + hour
+
+
+def test_clean_up_skips_drain(mocker):
+    """ Drain is skipped if metadata records that the market clears, unless in strict mode """
+    mocker.patch('rlmarket.environment.exchange_elements.pickle.load', return_value=deepcopy(tape))
+    mocker.patch('builtins.open', mocker.mock_open())
+    mocker.patch('rlmarket.gym_env.base_exchange.clears_at_end', return_value=True)
+
+    exchange = AbsoluteExchange(files=[''], indicators=[Position(), Imbalance(1, decay=0)],
+                                reward_lb=-0.2, reward_ub=0.3, start_time=start_time, end_time=end_time,
+                                latency=delta, order_size=50, position_limit=100)
+    exchange.reset()
+    exchange.step(3)
+    pointer = exchange.tape.pointer
+
+    exchange.clean_up()
+    assert exchange.tape.pointer == pointer
+    assert not exchange.book.empty
+
+    exchange.clean_up(strict=True)
+    assert exchange.tape.done
+    assert exchange.book.empty
+
+
+@pytest.mark.parametrize('copy_state', [False, True])
+def test_state_buffer(mocker, copy_state):
+    """ Indicators write into one float32 buffer. It is handed out as is unless copy_state """
+    mocker.patch('rlmarket.environment.exchange_elements.pickle.load', return_value=deepcopy(tape))
+    mocker.patch('builtins.open', mocker.mock_open())
+
+    exchange = AbsoluteExchange(files=[''], indicators=[Position(), Imbalance(1, decay=0), RemainingTime(0, end_time)],
+                                reward_lb=-0.2, reward_ub=0.3, start_time=start_time, end_time=end_time,
+                                latency=delta, order_size=50, position_limit=100, copy_state=copy_state)
+    state = exchange.reset()
+    assert state.dtype == np.float32 and state.shape == (3,)
+    assert_almost_equal(state, (0, 50 / 250, (end_time - exchange.tape.current_time) / end_time), decimal=6)
+    first = state.copy()
+
+    next_state, _, _, _ = exchange.step(3)
+    assert_almost_equal(next_state[:2], (50, -75 / 125))
+    assert (next_state is state) != copy_state
+    if copy_state:
+        assert_almost_equal(state, first)
+
+
+def test_event_indicators(mocker):
+    """ Event indicators should see every real order whether the tape is replayed order by order or fast forwarded """
+    mocker.patch('rlmarket.environment.exchange_elements.pickle.load', side_effect=lambda _: deepcopy(tape))
+    mocker.patch('builtins.open', mocker.mock_open())
+
+    results = []
+    for fast_forward, fill_oracle in [(False, False), (True, False), (True, True)]:
+        exchange = AbsoluteExchange(files=[''], indicators=[TradeIntensity(10 * delta), TimeSinceMidChange(delta)],
+                                    reward_lb=-0.2, reward_ub=0.3, start_time=start_time, end_time=end_time,
+                                    latency=delta, order_size=50, position_limit=100,
+                                    fast_forward=fast_forward, fill_oracle=fill_oracle)
+        states = [exchange.reset().copy()]
+        for _ in range(6):
+            states.append(exchange.step(3)[0].copy())
+        results.append(np.array(states))
+
+    assert_almost_equal(results[0][0], (0, 0, 4))  # No trade in warm-up. Quote is two-sided from the sixth order
+    assert results[0][1:, 1].sum() > 0  # Sells hit the bid
+    assert_almost_equal(results[1], results[0])
+    assert_almost_equal(results[2], results[0])
@@ -0,0 +1,117 @@
+"""
+Unittest for rlmarket/gym_env/fork_runner.py
+"""
+from copy import deepcopy
+import time
+import pytest
+
+from rlmarket.gym_env import AbsoluteExchange, ForkRunner
+from rlmarket.environment.exchange_elements import Position, Imbalance
+from rlmarket.market import LimitOrder, MarketOrder, DeleteOrder
+
+
+anchor = 34200000000000
+delta = 30000000
+start_time = anchor + 9 * delta
+end_time = anchor + 23 * delta
+
+tape = [
+    LimitOrder(anchor - 6 * delta, 11, 'B', 3000, 50),  # Far levels so that every action has prices
+    LimitOrder(anchor - 5 * delta, 12, 'B', 4000, 50),
+    LimitOrder(anchor - 4 * delta, 13, 'B', 5000, 50),
+    LimitOrder(anchor - 3 * delta, 14, 'S', 19000, 50),
+    LimitOrder(anchor - 2 * delta, 15, 'S', 18000, 50),
+    LimitOrder(anchor - 1 * delta, 16, 'S', 17000, 50),
+    LimitOrder(anchor + 0 * delta, 1, 'B', 10000, 150),
+    LimitOrder(anchor + 1 * delta, 2, 'B', 9000, 50),
+    LimitOrder(anchor + 2 * delta, 3, 'B', 8000, 100),
+    LimitOrder(anchor + 3 * delta, 4, 'B', 7000, 50),
+    LimitOrder(anchor + 4 * delta, 5, 'B', 6000, 50),
+    LimitOrder(anchor + 5 * delta, 6, 'S', 12000, 100),
+    LimitOrder(anchor + 6 * delta, 7, 'S', 13000, 200),
+    LimitOrder(anchor + 7 * delta, 8, 'S', 14000, 50),
+    LimitOrder(anchor + 8 * delta, 9, 'S', 15000, 50),
+    LimitOrder(anchor + 9 * delta, 10, 'S', 16000, 50),
+    MarketOrder(anchor + 10 * delta, 1, 'S', 150),
+    MarketOrder(anchor + 11 * delta, 2, 'S', 25),
+    MarketOrder(anchor + 12 * delta, 6, 'B', 100),
+    MarketOrder(anchor + 13 * delta, 7, 'B', 100),
+    MarketOrder(anchor + 15 * delta, 2, 'S', 25),
+    MarketOrder(anchor + 16 * delta, 3, 'S', 50),
+    MarketOrder(anchor + 17 * delta, 3, 'S', 50),
+    MarketOrder(anchor + 18 * delta, 4, 'S', 25),
+    MarketOrder(anchor + 19 * delta, 4, 'S', 25),
+    MarketOrder(anchor + 20 * delta, 7, 'B', 100),
+    MarketOrder(anchor + 21 * delta, 8, 'B', 25),
+    MarketOrder(anchor + 22 * delta, 8, 'B', 25),
+    MarketOrder(anchor + 23 * delta, 9, 'B', 50),
+    DeleteOrder(anchor + 24 * delta, 5),
+    DeleteOrder(anchor + 25 * delta, 10),
+] + [DeleteOrder(anchor + (15 + order_id) * delta, order_id) for order_id in range(11, 17)]
+
+
+def make_env() -> AbsoluteExchange:
+    return AbsoluteExchange(files=[''], indicators=[Position(), Imbalance(1, decay=0)],
+                            reward_lb=-0.2, reward_ub=0.3, start_time=start_time, end_time=end_time,
+                            latency=delta // 2, order_size=25, position_limit=100)
+
+
+def failing_policy(_) -> int:
+    raise ValueError('Bad policy')
+
+
+def slow_policy(_) -> int:
+    time.sleep(60)
+    return 3
+
+
+def test_fork_runner(mocker):
+    """
+    Episodes in forked children should be the same as running each policy on its own exchange
+        * More policies than workers so that worker slots are recycled
+        * Parent exchange stays at the warmed-up state
+        * Error in a child is raised in the parent without waiting for the episodes of other children
+    """
+    mocker.patch('rlmarket.environment.exchange_elements.pickle.load', side_effect=lambda _: deepcopy(tape))
+    mocker.patch('builtins.open', mocker.mock_open())
+
+    policies = [lambda _: 3, lambda _: 0, lambda state: 3 if state[0] <= 0 else 1]
+    expected = []
+    for policy in policies:
+        env = make_env()
+        state = env.reset()
+        total_reward = total_pnl = 0
+        steps = 0
+        done = False
+        while not done:
+            state, reward, done, info = env.step(policy(state))
+            total_reward += reward
+            total_pnl += info['pnl']
+            steps += 1
+        expected.append((total_reward, total_pnl, steps, env.position))
+    assert expected[0] != expected[1]
+
+    env = make_env()
+    runner = ForkRunner(env, max_workers=2)
+    state = runner.warm_up()
+    pointer = env.tape.pointer
+
+    results = runner.run(policies)
+    assert len(results) == 3
+    for result, (reward, pnl, steps, position) in zip(results, expected):
+        assert result.reward == pytest.approx(reward)
+        assert result.pnl == pytest.approx(pnl)
+        assert result.steps == steps and result.position == position
+    assert env.tape.pointer == pointer and env.position == 0
+
+    # Same warm-up is reused
+    assert runner.run(policies[:1])[0] == results[0]
+    assert (runner._state == state).all()
+
+    with pytest.raises(RuntimeError, match='policy 1'):
+        runner.run([policies[0], failing_policy])
+
+    started = time.monotonic()
+    with pytest.raises(RuntimeError, match='policy 1'):
+        runner.run([slow_policy, failing_policy])
+    assert time.monotonic() - started < 30
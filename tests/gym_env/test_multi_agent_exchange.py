@@ -0,0 +1,122 @@
+"""
+Unittest for rlmarket/gym_env/multi_agent_exchange.py
+"""
+from copy import deepcopy
+from numpy.testing import assert_almost_equal
+import pytest
+
+from rlmarket.gym_env import AbsoluteExchange, RelativeExchange, MultiAgentExchange
+from rlmarket.environment.exchange_elements import Position, QueuePosition
+from rlmarket.market import LimitOrder, MarketOrder, DeleteOrder
+
+
+anchor = 34200000000000
+delta = 30000000
+start_time = anchor + 9 * delta
+end_time = anchor + 23 * delta
+
+tape = [
+    LimitOrder(anchor + 0 * delta, 1, 'B', 10000, 150),
+    LimitOrder(anchor + 1 * delta, 2, 'B', 9000, 50),
+    LimitOrder(anchor + 2 * delta, 3, 'B', 8000, 100),
+    LimitOrder(anchor + 3 * delta, 4, 'B', 7000, 50),
+    LimitOrder(anchor + 4 * delta, 5, 'B', 6000, 50),
+    LimitOrder(anchor + 5 * delta, 6, 'S', 12000, 100),
+    LimitOrder(anchor + 6 * delta, 7, 'S', 13000, 200),
+    LimitOrder(anchor + 7 * delta, 8, 'S', 14000, 50),
+    LimitOrder(anchor + 8 * delta, 9, 'S', 15000, 50),
+    LimitOrder(anchor + 9 * delta, 10, 'S', 16000, 50),
+    LimitOrder(anchor + 9 * delta, 11, 'B', 1000, 10),  # Keep both sides quoted while later agents are stepping
+    LimitOrder(anchor + 9 * delta, 12, 'S', 30000, 10),
+    MarketOrder(anchor + 10 * delta, 1, 'S', 150),
+    MarketOrder(anchor + 11 * delta, 2, 'S', 25),
+    MarketOrder(anchor + 12 * delta, 6, 'B', 100),
+    MarketOrder(anchor + 13 * delta, 7, 'B', 100),
+    MarketOrder(anchor + 15 * delta, 2, 'S', 25),
+    MarketOrder(anchor + 16 * delta, 3, 'S', 50),
+    MarketOrder(anchor + 17 * delta, 3, 'S', 50),
+    MarketOrder(anchor + 18 * delta, 4, 'S', 25),
+    MarketOrder(anchor + 19 * delta, 4, 'S', 25),
+    MarketOrder(anchor + 20 * delta, 7, 'B', 100),
+    MarketOrder(anchor + 21 * delta, 8, 'B', 25),
+    MarketOrder(anchor + 22 * delta, 8, 'B', 25),
+    MarketOrder(anchor + 23 * delta, 9, 'B', 50),
+    DeleteOrder(anchor + 24 * delta, 5),
+    DeleteOrder(anchor + 25 * delta, 10),
+    DeleteOrder(anchor + 26 * delta, 11),
+    DeleteOrder(anchor + 26 * delta, 12),
+]
+
+
+def make_agents():
+    """ Agents differ in reward type, latency, order size and position limit """
+    common = dict(files=[''], indicators=[Position()], reward_lb=-0.2, reward_ub=0.3,
+                  start_time=start_time, end_time=end_time)
+    return [
+        AbsoluteExchange(latency=delta, order_size=50, position_limit=100, **common),
+        RelativeExchange(latency=delta // 2, order_size=25, position_limit=1000, **common),
+        AbsoluteExchange(latency=3 * delta, order_size=100, position_limit=150, **common),
+    ]
+
+
+def test_multi_agent_exchange(mocker):
+    """
+    Each agent should get the same results as running alone on the tape
+        * First agent is the same as in test_absolute_exchange
+    """
+    mocker.patch('builtins.open', mocker.mock_open())
+
+    # Results of agents running alone
+    expected = []
+    for agent in make_agents():
+        mocker.patch('rlmarket.environment.exchange_elements.pickle.load', return_value=deepcopy(tape))
+        results = [agent.reset()]
+        done = False
+        while not done:
+            state, reward, done, info = agent.step(3)
+            results.append((state, reward, done, info))
+        expected.append(results)
+    assert [info['pnl'] for _, _, _, info in expected[0][1:]] == [0, 10, 0, -6, 22, 18, 0]
+
+    # Shared replay
+    mocker.patch('rlmarket.environment.exchange_elements.pickle.load', return_value=deepcopy(tape))
+    exchange = MultiAgentExchange(make_agents())
+    states = exchange.reset()
+    results = [[states[idx]] for idx in range(3)]
+    actions = {idx: 3 for idx in range(3)}
+    while not exchange.done:
+        states, rewards, dones, infos = exchange.step(actions)
+        assert states
+        for idx in states:
+            results[idx].append((states[idx], rewards[idx], dones[idx], infos[idx]))
+        actions = {idx: 3 for idx in states if not dones[idx]}
+
+    for result, expected_result in zip(results, expected):
+        assert len(result) == len(expected_result)
+        assert_almost_equal(result[0], expected_result[0])
+        for (state, reward, done, info), (exp_state, exp_reward, exp_done, exp_info) in zip(result[1:],
+                                                                                             expected_result[1:]):
+            assert_almost_equal(state, exp_state)
+            assert reward == pytest.approx(exp_reward)
+            assert done == exp_done
+            assert info['pnl'] == pytest.approx(exp_info['pnl'])
+
+    exchange.clean_up()
+    assert exchange.book.empty
+
+    # Agents waiting for the market cannot act and agents waiting for an action must act
+    mocker.patch('rlmarket.environment.exchange_elements.pickle.load', return_value=deepcopy(tape))
+    exchange.reset()
+    with pytest.raises(RuntimeError, match='have not acted'):
+        exchange.step({0: 3})
+    with pytest.raises(RuntimeError, match='not waiting'):
+        exchange.step({0: 3})
+
+
+def test_queue_position_rejected():
+    """ QueuePosition would always read 0 because user orders of agents never enter the shared book """
+    agents = make_agents()
+    agents[1] = AbsoluteExchange(files=[''], indicators=[Position(), QueuePosition()], reward_lb=-0.2, reward_ub=0.3,
+                                 start_time=start_time, end_time=end_time)
+    with pytest.raises(ValueError, match='QueuePosition is not supported'):
+        MultiAgentExchange(agents)
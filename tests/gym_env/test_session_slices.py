@@ -0,0 +1,106 @@
+"""
+Unittest for rlmarket/gym_env/session_slices.py
+"""
+from copy import deepcopy
+import pytest
+
+from rlmarket.gym_env import AbsoluteExchange, SliceSpec, run_slices, merge_results
+from rlmarket.environment.exchange_elements import Position, Imbalance
+from rlmarket.environment.snapshot import take_snapshots
+from rlmarket.market import LimitOrder, MarketOrder, DeleteOrder
+
+
+anchor = 34200000000000
+delta = 30000000
+start_time = anchor + 9 * delta
+end_time = anchor + 23 * delta
+
+tape = [
+    LimitOrder(anchor + 0 * delta, 1, 'B', 10000, 150),
+    LimitOrder(anchor + 1 * delta, 2, 'B', 9000, 50),
+    LimitOrder(anchor + 2 * delta, 3, 'B', 8000, 100),
+    LimitOrder(anchor + 3 * delta, 4, 'B', 7000, 50),
+    LimitOrder(anchor + 4 * delta, 5, 'B', 6000, 50),
+    LimitOrder(anchor + 5 * delta, 6, 'S', 12000, 100),
+    LimitOrder(anchor + 6 * delta, 7, 'S', 13000, 200),
+    LimitOrder(anchor + 7 * delta, 8, 'S', 14000, 50),
+    LimitOrder(anchor + 8 * delta, 9, 'S', 15000, 50),
+    LimitOrder(anchor + 9 * delta, 10, 'S', 16000, 50),
+    MarketOrder(anchor + 10 * delta, 1, 'S', 150),
+    MarketOrder(anchor + 11 * delta, 2, 'S', 25),
+    MarketOrder(anchor + 12 * delta, 6, 'B', 100),
+    MarketOrder(anchor + 13 * delta, 7, 'B', 100),
+    MarketOrder(anchor + 15 * delta, 2, 'S', 25),
+    MarketOrder(anchor + 16 * delta, 3, 'S', 50),
+    MarketOrder(anchor + 17 * delta, 3, 'S', 50),
+    MarketOrder(anchor + 18 * delta, 4, 'S', 25),
+    MarketOrder(anchor + 19 * delta, 4, 'S', 25),
+    MarketOrder(anchor + 20 * delta, 7, 'B', 100),
+    MarketOrder(anchor + 21 * delta, 8, 'B', 25),
+    MarketOrder(anchor + 22 * delta, 8, 'B', 25),
+    MarketOrder(anchor + 23 * delta, 9, 'B', 50),
+    DeleteOrder(anchor + 24 * delta, 5),
+    DeleteOrder(anchor + 25 * delta, 10),
+]
+
+
+def make_env(window_start: int, window_end: int) -> AbsoluteExchange:
+    return AbsoluteExchange(files=[''], indicators=[Position(), Imbalance(1, decay=0)],
+                            reward_lb=-0.2, reward_ub=0.3, start_time=window_start, end_time=window_end,
+                            latency=delta // 2, order_size=25, position_limit=100)
+
+
+def policy(_) -> int:
+    return 3
+
+
+def test_slice_spec():
+    """ Windows should cover the session without gaps """
+    assert SliceSpec(0, 10, 3).windows == [(0, 3), (3, 6), (6, 10)]
+    with pytest.raises(ValueError):
+        _ = SliceSpec(0, 10, 0).windows
+
+
+def test_run_slices(mocker):
+    """
+    Each window should give the same episode as an exchange warming up to the window start by itself
+        * Snapshot book is the same as the book after warm-up
+        * Results are merged in time order
+    """
+    mocker.patch('rlmarket.environment.exchange_elements.pickle.load', side_effect=lambda _: deepcopy(tape))
+    mocker.patch('builtins.open', mocker.mock_open())
+
+    spec = SliceSpec(start_time, end_time, 2)
+    snapshots = take_snapshots('', [start for start, _ in spec.windows])
+    expected = []
+    for (window_start, window_end), snapshot in zip(spec.windows, snapshots):
+        env = make_env(window_start, window_end)
+        state = env.reset().copy()
+        assert snapshot.pointer == env.tape.pointer
+        assert snapshot.book.get_depth(5) == env.book.get_depth(5)
+
+        transitions = []
+        done = False
+        while not done:
+            next_state, reward, done, info = env.step(3)
+            next_state = next_state.copy()
+            transitions.append((state, 3, reward, next_state, done, info['pnl']))
+            state = next_state
+        expected.append(transitions)
+    assert all(len(transitions) > 1 for transitions in expected)
+
+    assert make_env(start_time, end_time).paths[0].endswith('/.pickle')  # Windows run on the first file
+    results = run_slices(make_env, policy, spec, start_method='fork')  # Workers inherit the mocks
+    assert [(result.start_time, result.end_time) for result in results] == spec.windows
+    for result, transitions in zip(results, expected):
+        assert len(result.transitions) == len(transitions)
+        for actual, target in zip(result.transitions, transitions):
+            assert (actual[0] == target[0]).all() and (actual[3] == target[3]).all()
+            assert actual[1:3] == pytest.approx(target[1:3]) and actual[4] == target[4]
+        assert result.pnl == pytest.approx(sum(target[5] for target in transitions))
+
+    stream, report = merge_results(results[::-1])
+    assert len(stream) == report['steps'] == sum(len(transitions) for transitions in expected)
+    assert stream[0][0] is results[0].transitions[0][0]
+    assert report['slices'] == 2
+    assert report['reward'] == pytest.approx(sum(result.reward for result in results))
@@ -0,0 +1,97 @@
+"""
+Unittest for rlmarket/gym_env/subproc_vec_exchange.py
+"""
+from copy import deepcopy
+from numpy.testing import assert_almost_equal
+import numpy as np
+import pytest
+
+from rlmarket.gym_env import AbsoluteExchange, VecExchange, SubprocVecExchange
+from rlmarket.environment.exchange_elements import Position, Imbalance
+from rlmarket.market import LimitOrder, MarketOrder, DeleteOrder
+
+
+anchor = 34200000000000
+delta = 30000000
+start_time = anchor + 9 * delta
+end_time = anchor + 23 * delta
+
+tape = [
+    LimitOrder(anchor + 0 * delta, 1, 'B', 10000, 150),
+    LimitOrder(anchor + 1 * delta, 2, 'B', 9000, 50),
+    LimitOrder(anchor + 2 * delta, 3, 'B', 8000, 100),
+    LimitOrder(anchor + 3 * delta, 4, 'B', 7000, 50),
+    LimitOrder(anchor + 4 * delta, 5, 'B', 6000, 50),
+    LimitOrder(anchor + 5 * delta, 6, 'S', 12000, 100),
+    LimitOrder(anchor + 6 * delta, 7, 'S', 13000, 200),
+    LimitOrder(anchor + 7 * delta, 8, 'S', 14000, 50),
+    LimitOrder(anchor + 8 * delta, 9, 'S', 15000, 50),
+    LimitOrder(anchor + 9 * delta, 10, 'S', 16000, 50),
+    MarketOrder(anchor + 10 * delta, 1, 'S', 150),
+    MarketOrder(anchor + 11 * delta, 2, 'S', 25),
+    MarketOrder(anchor + 12 * delta, 6, 'B', 100),
+    MarketOrder(anchor + 13 * delta, 7, 'B', 100),
+    MarketOrder(anchor + 15 * delta, 2, 'S', 25),
+    MarketOrder(anchor + 16 * delta, 3, 'S', 50),
+    MarketOrder(anchor + 17 * delta, 3, 'S', 50),
+    MarketOrder(anchor + 18 * delta, 4, 'S', 25),
+    MarketOrder(anchor + 19 * delta, 4, 'S', 25),
+    MarketOrder(anchor + 20 * delta, 7, 'B', 100),
+    MarketOrder(anchor + 21 * delta, 8, 'B', 25),
+    MarketOrder(anchor + 22 * delta, 8, 'B', 25),
+    MarketOrder(anchor + 23 * delta, 9, 'B', 50),
+    DeleteOrder(anchor + 24 * delta, 5),
+    DeleteOrder(anchor + 25 * delta, 10),
+]
+
+
+def make_env(latency: int, order_size: int):
+    return lambda: AbsoluteExchange(files=[''], indicators=[Position(), Imbalance(1, decay=0)],
+                                    reward_lb=-0.2, reward_ub=0.3, start_time=start_time, end_time=end_time,
+                                    latency=latency, order_size=order_size, position_limit=100)
+
+
+def test_subproc_vec_exchange(mocker):
+    """
+    Results should be the same as VecExchange
+        * Lockstep step including auto reset
+        * Asynchronous send and recv on a subset of exchanges
+        * Exchange probed for the spaces is closed
+    """
+    mocker.patch('rlmarket.environment.exchange_elements.pickle.load', side_effect=lambda _: deepcopy(tape))
+    mocker.patch('builtins.open', mocker.mock_open())
+
+    env_fns = [make_env(delta, 50), make_env(delta // 2, 25), make_env(delta, 50)]
+    vec_env = VecExchange(env_fns)
+    close = mocker.spy(AbsoluteExchange, 'close')
+    sub_env = SubprocVecExchange(env_fns, start_method='fork')  # Workers inherit the mocks
+    try:
+        assert close.call_count == 1
+        assert sub_env.num_envs == 3
+        assert_almost_equal(sub_env.reset(), vec_env.reset())
+
+        for _ in range(7):
+            expected = vec_env.step([3, 3, 3])
+            observations, rewards, dones, infos = sub_env.step(np.array([3, 3, 3]))
+            assert observations.dtype == np.float32 and rewards.dtype == np.float32
+            assert_almost_equal(observations, expected[0])
+            assert_almost_equal(rewards, expected[1])
+            assert (dones == expected[2]).all()
+            for info, expected_info in zip(infos, expected[3]):
+                assert info['pnl'] == pytest.approx(expected_info['pnl'])
+                assert ('terminal_observation' in info) == ('terminal_observation' in expected_info)
+        assert dones[0]
+
+        # Only the second exchange is stepped
+        expected = vec_env.envs[1].step(3)
+        sub_env.send([3], env_ids=[1])
+        with pytest.raises(RuntimeError, match='busy'):
+            sub_env.send([3], env_ids=[1])
+        observations, rewards, dones, infos, env_ids = sub_env.recv(batch_size=1)
+        assert env_ids.tolist() == [1]
+        assert_almost_equal(observations[0], expected[0])
+        assert rewards[0] == pytest.approx(expected[1])
+
+        assert sub_env.get_attr('position') == [env.position for env in vec_env.envs]
+    finally:
+        sub_env.close()
@@ -0,0 +1,100 @@
+"""
+Unittest for rlmarket/gym_env/vec_exchange.py
+"""
+from copy import deepcopy
+from numpy.testing import assert_almost_equal
+import numpy as np
+import pytest
+
+from rlmarket.gym_env import AbsoluteExchange, VecExchange
+from rlmarket.environment.exchange_elements import Position, Imbalance
+from rlmarket.market import LimitOrder, MarketOrder, DeleteOrder
+
+
+anchor = 34200000000000
+delta = 30000000
+start_time = anchor + 9 * delta
+end_time = anchor + 23 * delta
+
+tape = [
+    LimitOrder(anchor + 0 * delta, 1, 'B', 10000, 150),
+    LimitOrder(anchor + 1 * delta, 2, 'B', 9000, 50),
+    LimitOrder(anchor + 2 * delta, 3, 'B', 8000, 100),
+    LimitOrder(anchor + 3 * delta, 4, 'B', 7000, 50),
+    LimitOrder(anchor + 4 * delta, 5, 'B', 6000, 50),
+    LimitOrder(anchor + 5 * delta, 6, 'S', 12000, 100),
+    LimitOrder(anchor + 6 * delta, 7, 'S', 13000, 200),
+    LimitOrder(anchor + 7 * delta, 8, 'S', 14000, 50),
+    LimitOrder(anchor + 8 * delta, 9, 'S', 15000, 50),
+    LimitOrder(anchor + 9 * delta, 10, 'S', 16000, 50),
+    MarketOrder(anchor + 10 * delta, 1, 'S', 150),
+    MarketOrder(anchor + 11 * delta, 2, 'S', 25),
+    MarketOrder(anchor + 12 * delta, 6, 'B', 100),
+    MarketOrder(anchor + 13 * delta, 7, 'B', 100),
+    MarketOrder(anchor + 15 * delta, 2, 'S', 25),
+    MarketOrder(anchor + 16 * delta, 3, 'S', 50),
+    MarketOrder(anchor + 17 * delta, 3, 'S', 50),
+    MarketOrder(anchor + 18 * delta, 4, 'S', 25),
+    MarketOrder(anchor + 19 * delta, 4, 'S', 25),
+    MarketOrder(anchor + 20 * delta, 7, 'B', 100),
+    MarketOrder(anchor + 21 * delta, 8, 'B', 25),
+    MarketOrder(anchor + 22 * delta, 8, 'B', 25),
+    MarketOrder(anchor + 23 * delta, 9, 'B', 50),
+    DeleteOrder(anchor + 24 * delta, 5),
+    DeleteOrder(anchor + 25 * delta, 10),
+]
+
+
+def make_env(latency: int, order_size: int):
+    return lambda: AbsoluteExchange(files=[''], indicators=[Position(), Imbalance(1, decay=0)],
+                                    reward_lb=-0.2, reward_ub=0.3, start_time=start_time, end_time=end_time,
+                                    latency=latency, order_size=order_size, position_limit=100)
+
+
+def test_vec_exchange(mocker):
+    """
+    Batched results should be the same as stepping each exchange alone
+        * First exchange is the same as in test_absolute_exchange and finishes after 7 steps
+        * Finished exchange is reset and its final state is kept in info
+    """
+    mocker.patch('rlmarket.environment.exchange_elements.pickle.load', side_effect=lambda _: deepcopy(tape))
+    mocker.patch('builtins.open', mocker.mock_open())
+
+    params = [(delta, 50), (delta // 2, 25)]
+    expected = []
+    for latency, order_size in params:
+        env = make_env(latency, order_size)()
+        results = [(env.reset().copy(), 0, False, {})]
+        for _ in range(7):
+            state, reward, done, info = env.step(3)
+            results.append((state.copy(), reward, done, info))  # Exchange reuses its state buffer
+        expected.append(results)
+
+    vec_env = VecExchange([make_env(latency, order_size) for latency, order_size in params])
+    assert vec_env.num_envs == 2
+    assert vec_env.observation_space.shape == (2,)
+    assert all(np.shares_memory(env._state.array, vec_env._observations) for env in vec_env.envs)  # Written in place
+
+    observations = vec_env.reset()
+    assert observations.dtype == np.float32 and observations.shape == (2, 2)
+    assert_almost_equal(observations, [expected[0][0][0], expected[1][0][0]])
+
+    for step in range(1, 8):
+        observations, rewards, dones, infos = vec_env.step(np.array([3, 3]))
+        assert rewards.dtype == np.float32 and dones.dtype == bool
+        for idx in range(2):
+            state, reward, done, info = expected[idx][step]
+            assert rewards[idx] == pytest.approx(reward)
+            assert dones[idx] == done
+            assert infos[idx]['pnl'] == pytest.approx(info['pnl'])
+            if done:
+                assert_almost_equal(infos[idx]['terminal_observation'], state)
+                assert_almost_equal(observations[idx], expected[idx][0][0])  # Auto reset
+            else:
+                assert_almost_equal(observations[idx], state)
+
+    assert dones[0]
+    assert [info['pnl'] for _, _, _, info in expected[0][1:]] == [0, 10, 0, -6, 22, 18, 0]
+
+    with pytest.raises(ValueError):
+        vec_env.step([3])
@@ -4,7 +4,7 @@ Tests for rlmarket/market/book.py
 import pytest
 
 from rlmarket.market import LimitOrder, MarketOrder, CancelOrder, DeleteOrder
-from rlmarket.market import UserLimitOrder, UserMarketOrder
+from rlmarket.market import UserLimitOrder, UserMarketOrder, Execution
 from rlmarket.market.book import Book
 
 
@@ -367,3 +367,171 @@ def test_crossing_handling():
     assert executions.id == -1
     assert executions.price == 10000
     assert executions.shares == 100
+
+
+def test_depth_cache():
+    """
+    Test that depth cache is only rebuilt when the front of the book changes
+    * Changes beyond the cached levels do not invalidate the cache
+    * Array and list depth agree
+    """
+    book = Book('B', lambda x: -x, depth_levels=2)
+    assert book.get_depth(2) == []
+    assert book.get_depth_array(2).shape == (0, 2)
+
+    book.add_limit_order(LimitOrder(1, 1, 'B', 10000, 100))
+    book.add_limit_order(LimitOrder(2, 2, 'B', 9000, 100))
+    version = book.version
+    assert book.get_depth(2) == [(10000, 100), (9000, 100)]
+    assert book.get_depth_array(2).tolist() == [[10000, 100], [9000, 100]]
+    assert not book._depth_dirty
+
+    # Order behind the cached levels
+    book.add_limit_order(LimitOrder(3, 3, 'B', 8000, 100))
+    assert book.version > version
+    assert not book._depth_dirty
+    assert book.get_depth(2) == [(10000, 100), (9000, 100)]
+
+    # Order within the cached levels
+    book.cancel_order(CancelOrder(4, 2, 50))
+    assert book._depth_dirty
+    assert book.get_depth(2) == [(10000, 100), (9000, 50)]
+
+    # Cache grows if more levels are requested
+    assert book.get_depth(3) == [(10000, 100), (9000, 50), (8000, 100)]
+    assert book.get_depth_array(5).tolist() == [[10000, 100], [9000, 50], [8000, 100]]
+
+    # User order only level is not in front
+    book.add_user_limit_order(UserLimitOrder(5, -1, 'B', 11000, 100))
+    assert book.get_depth(1) == [(10000, 100)]
+
+    book.delete_order(DeleteOrder(6, 1))
+    assert book.get_depth(2) == [(9000, 50), (8000, 100)]
+
+    book.reset()
+    assert book.get_depth(2) == []
+
+
+def test_user_shares_ahead():
+    """ Test Book exposes shares in front of the user order """
+    book = Book('B', lambda x: -x)
+    assert book.user_shares_ahead is None
+
+    book.add_limit_order(LimitOrder(1, 1, 'B', 10000, 100))
+    book.add_user_limit_order(UserLimitOrder(2, -1, 'B', 10000, 100))
+    assert book.user_shares_ahead == 100
+
+    book.match_limit_order(MarketOrder(3, 1, 'S', 40))
+    assert book.user_shares_ahead == 60
+
+    # Replacement resets the position
+    book.add_limit_order(LimitOrder(4, 2, 'B', 10000, 100))
+    book.add_user_limit_order(UserLimitOrder(5, -2, 'B', 10000, 100))
+    assert book.user_shares_ahead == 160
+
+    book.delete_user_order()
+    assert book.user_shares_ahead is None
+
+
+def test_walk_the_book():
+    """
+    Test cumulative depth and user MarketOrder filling
+    * Fill within the first level, across levels and beyond the cached levels
+    * Preview does not change the book
+    """
+    book = Book('S', None, depth_levels=2)
+    book.add_limit_order(LimitOrder(1, 1, 'S', 10000, 100))
+    book.add_limit_order(LimitOrder(2, 2, 'S', 10100, 100))
+    book.add_limit_order(LimitOrder(3, 3, 'S', 10300, 200))
+
+    prices, shares, values = book.get_cumulative_depth(3)
+    assert prices.tolist() == [10000, 10100, 10300]
+    assert shares.tolist() == [100, 200, 400]
+    assert values.tolist() == [1000000, 2010000, 4070000]
+
+    assert book.preview_market_order(50) == 10000
+    assert book.preview_market_order(150) == int((100 * 10000 + 50 * 10100) / 150)
+    assert book.preview_market_order(400) == int(4070000 / 400)
+    assert book.preview_market_order(401) is None
+
+    book = Book('S', None, depth_levels=1)
+    book.add_limit_order(LimitOrder(1, 1, 'S', 10000, 100))
+    book.add_limit_order(LimitOrder(2, 2, 'S', 10100, 100))
+    book.add_limit_order(LimitOrder(3, 3, 'S', 10300, 200))
+    version = book.version
+    execution = book.match_limit_order_for_user(UserMarketOrder(4, -1, 'B', 300))
+    assert execution.price == int((100 * 10000 + 100 * 10100 + 100 * 10300) / 300)
+    assert execution.shares == 300
+    assert book.version == version
+    assert book.get_depth(3) == [(10000, 100), (10100, 100), (10300, 200)]
+
+
+def test_level_pool():
+    """ Removed price levels should be recycled clean """
+    book = Book('S', None, pool_size=1)
+    book.add_limit_order(LimitOrder(1, 1, 'S', 10000, 100))
+    book.add_limit_order(LimitOrder(2, 2, 'S', 10100, 100))
+    book.add_user_limit_order(UserLimitOrder(3, -1, 'S', 10100, 100))
+    book.add_limit_order(LimitOrder(4, 3, 'S', 10100, 50))
+    level = book.price_levels[10100]
+    assert (book.levels_allocated, book.levels_reused) == (2, 0)
+
+    book.delete_user_order()
+    book.delete_order(DeleteOrder(5, 2))
+    book.delete_order(DeleteOrder(6, 3))
+    book.delete_order(DeleteOrder(7, 1))  # Pool is full. Level is discarded
+    assert book.empty
+
+    book.add_limit_order(LimitOrder(8, 4, 'S', 9900, 30))
+    assert book.price_levels[9900] is level
+    assert (level.price, level.shares, level.length, level.behind) == (9900, 30, 1, {})
+    book.add_limit_order(LimitOrder(9, 5, 'S', 10000, 30))
+    assert (book.levels_allocated, book.levels_reused) == (3, 1)
+    assert book.level_reuse_rate == 0.25
+    assert book.get_depth(5) == [(9900, 30), (10000, 30)]
+
+
+def test_multiple_user_orders():
+    """
+    Test user order ladder
+    * Oldest user order is replaced when the book is full
+    * Real order runs over several user orders at once
+    * Real order crosses several user orders at once
+    """
+    book = Book('B', key_func=lambda x: -x, max_user_orders=3)
+    book.add_limit_order(LimitOrder(1, 1, 'B', 10000, 100))
+    book.add_user_limit_order(UserLimitOrder(2, -1, 'B', 10000, 100))
+    book.add_user_limit_order(UserLimitOrder(3, -2, 'B', 10100, 100))
+    book.add_user_limit_order(UserLimitOrder(4, -3, 'B', 10200, 200))
+    assert book.user_orders == {-1: 10000, -2: 10100, -3: 10200}
+    assert book.user_order_info[0] == 10200
+    assert book.quote == 10000
+    assert book.get_depth(1) == [(10000, 100)]
+
+    # Replace the oldest
+    book.add_user_limit_order(UserLimitOrder(5, -4, 'B', 9900, 100))
+    assert book.user_orders == {-2: 10100, -3: 10200, -4: 9900}
+    assert book.prices == [10200, 10100, 10000, 9900]
+
+    # Run over both user orders in front
+    exhausted, execution = book.match_limit_order(MarketOrder(6, 1, 'S', 50))
+    assert not exhausted
+    assert execution == Execution(-3, 10167, 300)  # Rounded from 10166.67
+    assert book.fills == [Execution(-3, 10200, 200), Execution(-2, 10100, 100)]
+    assert book.user_orders == {-4: 9900}
+    assert book.quote == 10000
+
+    # Cross user orders inside the market
+    book.add_user_limit_order(UserLimitOrder(7, -5, 'B', 10300, 100))
+    book.add_user_limit_order(UserLimitOrder(7, -6, 'B', 10400, 100))
+    execution = book.resolve_book_crossing_on_user_order(10300)
+    assert execution == Execution(-6, 10350, 200)
+    assert [fill.id for fill in book.fills] == [-6, -5]
+    assert book.user_orders == {-4: 9900}
+
+    # Delete single user order
+    book.add_user_limit_order(UserLimitOrder(8, -7, 'B', 9800, 100))
+    book.delete_user_order(-4)
+    assert book.user_orders == {-7: 9800}
+    book.delete_user_order()
+    assert book.prices == [10000]
@@ -0,0 +1,81 @@
+"""
+Tests for rlmarket/market/fork.py
+"""
+from copy import deepcopy
+import pytest
+
+from rlmarket.market import OrderBook, LimitOrder, MarketOrder, CancelOrder, DeleteOrder
+from rlmarket.market import UserLimitOrder
+from rlmarket.market.fork import CopyOnWriteDict
+
+
+def test_copy_on_write_dict():
+    """ Writes and deletions should not reach the base """
+    base = {1: 'a', 2: 'b'}
+    overlay = CopyOnWriteDict(base)
+    overlay[3] = 'c'
+    overlay[1] = 'x'
+    del overlay[2]
+    assert dict(overlay) == {1: 'x', 3: 'c'}
+    assert len(overlay) == 2
+    assert base == {1: 'a', 2: 'b'}
+    with pytest.raises(KeyError):
+        _ = overlay[2]
+
+
+@pytest.mark.parametrize('lean', [False, True])
+def test_fork(lean):
+    """ Fork should behave as a deep copy while leaving its parent untouched """
+    book = OrderBook(lean=lean)
+    book.add_limit_order(LimitOrder(1, 1, 'B', 10000, 100))
+    book.add_limit_order(LimitOrder(2, 2, 'B', 9900, 100))
+    book.add_limit_order(LimitOrder(3, 3, 'S', 10100, 100))
+    book.add_user_limit_order(UserLimitOrder(4, -1, 'B', 10000, 100))
+    book.add_limit_order(LimitOrder(5, 4, 'B', 10000, 50))
+    depth = book.get_depth()
+
+    events = [
+        CancelOrder(6, 1, 40),
+        MarketOrder(7, 1, 'S', 60),
+        LimitOrder(8, 5, 'B', 9900, 30),
+        DeleteOrder(9, 2),
+        MarketOrder(10, 4, 'S', 10),  # User bid is at the head. Execute
+        DeleteOrder(11, 3),
+        UserLimitOrder(12, -2, 'S', 10200, 100),
+        LimitOrder(13, 6, 'B', 10200, 100),  # Cross user ask
+    ]
+
+    fork, reference = book.fork(), deepcopy(book)
+    for event in events:
+        results = []
+        for target in (fork, reference):
+            event_copy = deepcopy(event)
+            if isinstance(event_copy, UserLimitOrder):
+                results.append(target.add_user_limit_order(event_copy))
+            elif isinstance(event_copy, LimitOrder):
+                results.append(target.add_limit_order(event_copy))
+            elif isinstance(event_copy, MarketOrder):
+                results.append(target.match_limit_order(event_copy))
+            elif isinstance(event_copy, CancelOrder):
+                results.append(target.cancel_order(event_copy))
+            else:
+                results.append(target.delete_order(event_copy))
+        assert results[0] == results[1]
+        assert fork.get_depth() == reference.get_depth()
+
+    assert fork.get_depth() == ([(10200, 100), (10000, 40), (9900, 30)], [])
+    assert len(fork.order_pool) == 3
+
+    # Parent is untouched
+    assert book.get_depth() == depth
+    assert book.user_shares_ahead == (100, None)
+    assert book.bid_book.user_order_info[1].price == 10000
+    assert len(book.order_pool) == 4
+
+    # Fork of fork
+    child = fork.fork()
+    child.delete_order(DeleteOrder(14, 6))
+    child.delete_order(DeleteOrder(15, 4))
+    child.match_limit_order(MarketOrder(16, 5, 'S', 30))
+    assert child.empty
+    assert fork.get_depth() == ([(10200, 100), (10000, 40), (9900, 30)], [])
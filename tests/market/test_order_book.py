@@ -1,10 +1,12 @@
 """
 Tests for rlmarket/market/order_book.py
 """
+from copy import copy
 import pytest
 
+from rlmarket.market.book import LeanBook
 from rlmarket.market import OrderBook, LimitOrder, MarketOrder, CancelOrder, DeleteOrder, UpdateOrder
-from rlmarket.market import UserLimitOrder, UserMarketOrder
+from rlmarket.market import UserLimitOrder, UserMarketOrder, Execution
 
 
 def test_order_book():
@@ -183,3 +185,119 @@ def test_user_order():
     assert execution.price == 10000
     assert execution.shares == 50
     assert len(book.order_pool) == 1
+    assert book.fills == [execution]
+
+
+def test_lean_order_book():
+    """ Lean book should produce the same depth and executions as the full book """
+    events = [
+        LimitOrder(1, 1, 'B', 10000, 100),
+        LimitOrder(2, 2, 'B', 10000, 50),
+        LimitOrder(3, 3, 'S', 10200, 100),
+        LimitOrder(4, 4, 'B', 9900, 100),
+        UserLimitOrder(5, -1, 'B', 10000, 100),
+        UserLimitOrder(5, -2, 'S', 10300, 100),
+        LimitOrder(6, 5, 'B', 10000, 80),
+        MarketOrder(7, 1, 'S', 60),
+        CancelOrder(8, 2, 20),
+        DeleteOrder(9, 2),
+        MarketOrder(10, 1, 'S', 40),
+        MarketOrder(11, 5, 'S', 30),  # User bid is at the head. Execute
+        UserLimitOrder(12, -3, 'B', 9900, 100),
+        UserLimitOrder(12, -4, 'S', 10300, 100),
+        UpdateOrder(13, 6, 4, 9800, 100),  # User bid becomes the only order at 9900
+        LimitOrder(14, 7, 'S', 10300, 100),
+        MarketOrder(15, 5, 'S', 50),
+        MarketOrder(16, 6, 'S', 50),  # Run over user bid at 9900
+        UserLimitOrder(17, -5, 'S', 10100, 100),
+        LimitOrder(18, 8, 'B', 10100, 100),  # Cross user ask
+    ]
+
+    full, lean = OrderBook(), OrderBook(lean=True)
+    for book in (full, lean):
+        assert isinstance(book.bid_book, LeanBook) == (book is lean)
+
+    executions = {id(full): [], id(lean): []}
+    for event in events:
+        for book in (full, lean):
+            if isinstance(event, LimitOrder):
+                execution = book.add_limit_order(copy(event))
+            elif isinstance(event, MarketOrder):
+                execution = book.match_limit_order(event)
+            elif isinstance(event, CancelOrder):
+                execution = book.cancel_order(event)
+            elif isinstance(event, DeleteOrder):
+                execution = book.delete_order(event)
+            elif isinstance(event, UpdateOrder):
+                execution = book.modify_order(event)
+            else:
+                execution = book.add_user_limit_order(copy(event))
+            executions[id(book)].append(execution)
+        assert full.get_depth() == lean.get_depth()
+        assert full.quote == lean.quote
+
+    assert executions[id(full)] == executions[id(lean)]
+    assert [execution.id for execution in executions[id(lean)] if execution] == [-1, -3, -5]
+
+
+def test_preview_market_order():
+    """ Preview should match the execution of user MarketOrder """
+    book = OrderBook()
+    book.add_limit_order(LimitOrder(1, 1, 'B', 9900, 100))
+    book.add_limit_order(LimitOrder(2, 2, 'B', 9800, 100))
+    book.add_limit_order(LimitOrder(3, 3, 'S', 10000, 100))
+
+    assert book.preview_market_order('S', 150) == 9866
+    assert book.preview_market_order('B', 100) == 10000
+    assert book.preview_market_order('B', 101) is None
+    assert book.match_limit_order_for_user(UserMarketOrder(4, -1, 'S', 150)).price == 9866
+
+    with pytest.raises(ValueError, match='Unrecognized side X'):
+        book.preview_market_order('X', 100)
+
+
+def test_subscribe():
+    """ Real order operations should publish the new state of the touched levels """
+    book = OrderBook()
+    deltas = []
+    book.subscribe(deltas.append)
+    book.add_limit_order(LimitOrder(1, 1, 'B', 10000, 100))
+    book.add_limit_order(LimitOrder(2, 2, 'B', 10000, 50))
+    book.add_user_limit_order(UserLimitOrder(3, -1, 'S', 10200, 100))  # User orders do not publish
+    book.match_limit_order(MarketOrder(4, 1, 'S', 100))
+    book.cancel_order(CancelOrder(5, 2, 20))
+    book.modify_order(UpdateOrder(6, 3, 2, 9900, 30))
+    book.delete_order(DeleteOrder(7, 3))
+    assert [tuple(delta) for delta in deltas] == [
+        (1, 'B', 10000, 100, 'A'),
+        (2, 'B', 10000, 150, 'A'),
+        (4, 'B', 10000, 50, 'E'),
+        (5, 'B', 10000, 30, 'X'),
+        (6, 'B', 10000, 0, 'U'),
+        (6, 'B', 9900, 30, 'U'),
+        (7, 'B', 9900, 0, 'D'),
+    ]
+
+    book.unsubscribe(deltas.append)
+    book.add_limit_order(LimitOrder(8, 4, 'S', 10100, 100))
+    assert len(deltas) == 7
+
+
+def test_user_order_ladder():
+    """ Several user orders per side should be filled in one replay with individual fills kept """
+    book = OrderBook(max_user_orders=2)
+    book.add_limit_order(LimitOrder(1, 1, 'B', 10000, 100))
+    book.add_limit_order(LimitOrder(2, 2, 'S', 10300, 100))
+    book.add_user_limit_order(UserLimitOrder(3, -1, 'S', 10100, 100))
+    book.add_user_limit_order(UserLimitOrder(3, -2, 'S', 10200, 50))
+    book.add_user_limit_order(UserLimitOrder(3, -3, 'B', 10000, 100))
+    assert book.quote == (10000, 10300)
+
+    with pytest.raises(RuntimeError, match='User order crosses another user order'):
+        book.add_user_limit_order(UserLimitOrder(4, -4, 'B', 10100, 100))
+
+    execution = book.add_limit_order(LimitOrder(5, 3, 'B', 10200, 100))  # Cross both user asks
+    assert execution == Execution(-1, 10133, -150)
+    assert book.fills == [Execution(-1, 10100, -100), Execution(-2, 10200, -50)]
+    assert book.bid_book.user_order_info is None  # User order on the other side is cleaned up
+    assert book.quote == (10200, 10300)
@@ -3,7 +3,7 @@ Tests for rlmarket/market/price_level.py
 """
 import pytest
 
-from rlmarket.market.price_level import PriceLevel
+from rlmarket.market.price_level import PriceLevel, LeanPriceLevel
 from rlmarket.market import LimitOrder, MarketOrder, CancelOrder, DeleteOrder
 from rlmarket.market import UserLimitOrder, UserMarketOrder
 
@@ -127,3 +127,94 @@ def test_user_order():
     assert price_level.match_limit_order_for_user(UserMarketOrder(8, -5, 'S', 180)) == 30
     assert price_level.user_order_id is None
     assert tuple(price_level.queue.keys()) == (2, 3)
+
+
+def test_lean_price_level():
+    """
+    Test LeanPriceLevel only materializes queue while user order is present
+    * Orders in front of user order are tracked by shares_ahead
+    * User order is executed once it is at the head and the order right behind it is matched
+    """
+    orders = {}
+    price_level = LeanPriceLevel(10000, orders)
+
+    for order in [LimitOrder(1, 1, 'B', 10000, 100), LimitOrder(2, 2, 'B', 10000, 200)]:
+        orders[order.id] = order
+        price_level.add_limit_order(order)
+    assert price_level.shares == 300
+    assert price_level.length == 2
+    assert not price_level.queue
+
+    # User order joins at the back
+    price_level.add_user_limit_order(UserLimitOrder(3, -1, 'B', 10000, 100))
+    assert price_level.shares_ahead == 300
+    assert tuple(price_level.queue.keys()) == (-1,)
+
+    orders[3] = LimitOrder(4, 3, 'B', 10000, 50)
+    price_level.add_limit_order(orders[3])
+    assert tuple(price_level.queue.keys()) == (-1,)
+    assert tuple(price_level.behind.keys()) == (3,)
+    assert price_level.length == 4
+
+    # Orders in front are consumed
+    _, exhausted, user_order = price_level.match_limit_order(MarketOrder(5, 1, 'S', 100))
+    assert exhausted
+    assert user_order is None
+    assert price_level.shares_ahead == 200
+    del orders[1]
+
+    price_level.cancel_order(CancelOrder(6, 2, 150))
+    assert price_level.shares_ahead == 50
+    price_level.delete_order(DeleteOrder(7, 2))
+    assert price_level.shares_ahead == 0
+    del orders[2]
+
+    # Order behind user order is matched
+    _, exhausted, user_order = price_level.match_limit_order(MarketOrder(8, 3, 'S', 20))
+    assert not exhausted
+    assert user_order.id == -1
+    assert price_level.shares == 30
+    assert price_level.length == 1
+    assert not price_level.queue
+    assert not price_level.behind
+
+    with pytest.raises(RuntimeError, match='Market order shares 50 is more than limit order shares 30'):
+        price_level.match_limit_order(MarketOrder(9, 3, 'S', 50))
+
+
+def test_shares_ahead():
+    """
+    Test shares in front of user order are updated on execution, cancellation and deletion
+    * Orders behind user order do not change shares ahead
+    """
+    price_level = PriceLevel(10000)
+    price_level.add_limit_order(LimitOrder(1, 1, 'S', 10000, 100))
+    price_level.add_limit_order(LimitOrder(2, 2, 'S', 10000, 100))
+    price_level.add_user_limit_order(UserLimitOrder(3, -1, 'S', 10000, 100))
+    price_level.add_limit_order(LimitOrder(4, 3, 'S', 10000, 100))
+    assert price_level.shares_ahead == 200
+    assert tuple(price_level.behind.keys()) == (3,)
+
+    price_level.match_limit_order(MarketOrder(5, 1, 'B', 30))
+    assert price_level.shares_ahead == 170
+    price_level.cancel_order(CancelOrder(6, 2, 50))
+    assert price_level.shares_ahead == 120
+    price_level.cancel_order(CancelOrder(7, 3, 50))
+    assert price_level.shares_ahead == 120
+    price_level.delete_order(DeleteOrder(8, 1))
+    assert price_level.shares_ahead == 50
+
+    # Not at the head yet
+    _, _, user_order = price_level.match_limit_order(MarketOrder(9, 3, 'B', 10))
+    assert user_order is None
+
+    _, exhausted, user_order = price_level.match_limit_order(MarketOrder(10, 2, 'B', 50))
+    assert exhausted
+    assert user_order is None
+    assert price_level.shares_ahead == 0
+
+    _, _, user_order = price_level.match_limit_order(MarketOrder(11, 3, 'B', 10))
+    assert user_order.id == -1
+    assert price_level.shares_ahead == 0
+    assert not price_level.behind
+    assert tuple(price_level.queue.keys()) == (3,)
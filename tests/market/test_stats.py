@@ -0,0 +1,32 @@
+"""
+Tests for rlmarket/market/stats.py
+"""
+from rlmarket.market import OrderBook, LimitOrder, DeleteOrder, UserLimitOrder
+from rlmarket.market.stats import BookStatsSampler
+
+
+def test_book_stats_sampler():
+    """ Sampler should record stats every n operations and keep high-water marks """
+    book = OrderBook()
+    sampler = BookStatsSampler(book, every=2)
+    book.add_limit_order(LimitOrder(1, 1, 'B', 10000, 100))
+    book.add_limit_order(LimitOrder(2, 2, 'B', 10000, 100))
+    book.add_limit_order(LimitOrder(3, 3, 'B', 9900, 100))
+    book.add_user_limit_order(UserLimitOrder(4, -1, 'B', 9900, 100))
+    book.delete_order(DeleteOrder(5, 1))
+    book.delete_order(DeleteOrder(6, 3))
+
+    assert [timestamp for timestamp, _ in sampler.samples] == [2, 5]
+    stats = sampler.samples[1][1]
+    assert (stats['bid_orders'], stats['bid_levels'], stats['bid_user_orders']) == (2, 2, 1)
+    assert stats['bid_max_queue_length'] == 2  # Real order and user order
+
+    stats = book.get_stats()
+    assert (stats['bid_orders'], stats['bid_levels'], stats['ask_orders']) == (1, 2, 0)
+    assert (stats['bid_peak_orders'], stats['bid_peak_levels']) == (3, 2)
+    assert 0 < stats['total_bytes'] < stats['peak_bytes']
+
+    sampler.close()
+    book.delete_order(DeleteOrder(7, 2))
+    book.add_limit_order(LimitOrder(8, 4, 'B', 10000, 100))
+    assert len(sampler.samples) == 2